@@ -1,5 +1,6 @@
 import serial
 import socket
+import errno
 import time
 import struct
 import select
@@ -24,82 +25,119 @@ FESC  = 0xDB
 TFEND = 0xDC
 TFESC = 0xDD
 
-TNC_DEBUG = True
+TNC_DEBUG = False
 
-def kiss_escape_frame(frame):
-    escaped = ""
-
-    for char in frame:
-        if ord(char) == FEND:
-            escaped += chr(FESC)
-            escaped += chr(TFEND)
-        elif ord(char) == FESC:
-            escaped += chr(FESC)
-            escaped += chr(TFESC)
-        else:
-            escaped += char
+_FEND  = chr(FEND)
+_FESC  = chr(FESC)
+_TFEND = chr(TFEND)
+_TFESC = chr(TFESC)
 
-    return escaped
+class KISSCodec(object):
+    """Frames and deframes KISS data.  Received data is fed in as it is
+    read, and partial frames are kept until the rest arrives."""
 
-def kiss_send_frame(frame, port=0):
-    cmd = (port & 0x0F) << 4
+    def __init__(self, port=0, debug=None):
+        self.port = port
+        if debug is None:
+            debug = TNC_DEBUG
+        self.debug = debug
+        self._buf = bytearray()
+        self._inframe = False
 
-    frame = kiss_escape_frame(frame)
-    buf = struct.pack("BB", FEND, cmd) + frame + struct.pack("B", FEND)
+    def _dump(self, msg, data):
+        if self.debug:
+            print "[TNC] %s:" % msg
+            utils.hexprint(str(data))
 
-    if TNC_DEBUG:
-        print "[TNC] Sending:"
-        utils.hexprint(buf)
+    def escape(self, frame):
+        if _FESC in frame:
+            frame = frame.replace(_FESC, _FESC + _TFESC)
+        if _FEND in frame:
+            frame = frame.replace(_FEND, _FESC + _TFEND)
 
-    return buf
+        return frame
 
-def kiss_buf_has_frame(buf):
-    return buf.count(chr(FEND)) >=2
+    def unescape(self, frame):
+        if _FESC not in frame:
+            return frame
 
-def kiss_recv_frame(buf):
-    if not buf:
-        return "", ""
+        good = frame.count(_FESC + _TFEND) + frame.count(_FESC + _TFESC)
+        if frame.count(_FESC) != good:
+            raise ValueError("Bad escape sequence in frame")
 
-    data = ""
-    inframe = False
+        return frame.replace(_FESC + _TFEND,
+                             _FEND).replace(_FESC + _TFESC, _FESC)
 
-    _buf = ""
-    _lst = "0" # Make sure we don't choke trying to ord() this
-    for char in buf:
-        if ord(char) == FEND:
-            if not inframe:
-                inframe = True
-            else:
-                data += _buf[1:]
-                _buf = ""
-                inframe = False
-        elif ord(char) == FESC:
-            pass # Ignore this and wait for the next character
-        elif ord(_lst) == FESC:
-            if ord(char) == TFEND:
-                _buf += chr(FEND)
-            elif ord(char) == TFESC:
-                _buf += chr(FESC)
-            else:
-                print "[TNC] Bad escape of 0x%x" % ord(char)
+    def encode(self, frame, port=None):
+        if port is None:
+            port = self.port
+        cmd = (port & 0x0F) << 4
+
+        buf = _FEND + chr(cmd) + self.escape(frame) + _FEND
+        self._dump("Sending", buf)
+
+        return buf
+
+    def feed(self, data):
+        """Returns the list of (port, data) for each complete data frame"""
+        self._buf += data
+        frames = []
+
+        pos = 0
+        while True:
+            if not self._inframe:
+                start = self._buf.find(_FEND, pos)
+                if start < 0:
+                    if pos < len(self._buf):
+                        self._dump("Out-of-frame garbage", self._buf[pos:])
+                    pos = len(self._buf)
+                    break
+                elif start > pos:
+                    self._dump("Out-of-frame garbage", self._buf[pos:start])
+                pos = start + 1
+                self._inframe = True
+
+            end = self._buf.find(_FEND, pos)
+            if end < 0:
                 break
-        elif inframe:
-            _buf += char
-        else:
-            print "[TNC] Out-of-frame garbage: 0x%x" % ord(char)
-        _lst = char
 
-    if TNC_DEBUG:
-        print "[TNC] Data:"
-        utils.hexprint(data)
+            # The FEND that ends this frame also starts the next one, so
+            # we stay in a frame
+            raw = str(self._buf[pos:end])
+            pos = end + 1
+            if not raw:
+                continue
+
+            cmd = ord(raw[0])
+            if cmd & 0x0F:
+                # Not a data frame (TXDELAY, etc)
+                continue
+
+            try:
+                frame = self.unescape(raw[1:])
+            except ValueError, e:
+                print "[TNC] Dropping frame: %s" % e
+                continue
+
+            self._dump("Data", frame)
+            frames.append((cmd >> 4, frame))
+
+        del self._buf[:pos]
+
+        return frames
+
+    def feed_port(self, data):
+        """Like feed(), but returns only the payload of frames for our port"""
+        return [f for p, f in self.feed(data) if p == self.port]
 
-    if not inframe and _buf:
-        # There was not a partial frame started at the end of the data
-        print "[TNC] Dumping non-frame data trailer"
-        utils.hexprint(_buf)
-        _buf = ""
+    def pending(self):
+        return len(self._buf)
 
-    return data, _buf
+def kiss_escape_frame(frame):
+    return KISSCodec().escape(frame)
+
+def kiss_send_frame(frame, port=0):
+    return KISSCodec(port).encode(frame)
 
 class TNCSerial(serial.Serial):
     def __init__(self, **kwargs):
@@ -110,28 +148,30 @@ class TNCSerial(serial.Serial):
             self.__tncport = 0
         serial.Serial.__init__(self, **kwargs)
 
-        self.__buffer = ""
-        self.__tstamp = 0
+        self.__codec = KISSCodec(self.__tncport)
 
     def reconnect(self):
         pass
 
     def write(self, data):
-        serial.Serial.write(self, kiss_send_frame(data, self.__tncport))
-
-    def read(self, size):
-        if self.__buffer:
-            print "Buffer is %i before read" % len(self.__buffer)
-        self.__buffer += serial.Serial.read(self, 1024)
-
-        framedata = ""
-        if kiss_buf_has_frame(self.__buffer):
-            framedata, self.__buffer = kiss_recv_frame(self.__buffer)
-        elif len(self.__buffer) > 0:
-            print "[TNC] Buffer partially-filled (%i b)" % len(self.__buffer)
+        serial.Serial.write(self, self.__codec.encode(data))
+
+    def read_frames(self, block=True):
+        # Wait (up to the timeout) for something to arrive, then take
+        # whatever else is already waiting.  From the shared I/O loop we
+        # must not wait, so only take what is there.
+        if block:
+            data = serial.Serial.read(self, 1)
+        else:
+            data = ""
+        waiting = self.inWaiting()
+        if waiting:
+            data += serial.Serial.read(self, waiting)
 
-        return framedata
+        return self.__codec.feed_port(data)
 
+    def read(self, size):
+        return "".join(self.read_frames())
 
 class SWFSerial(serial.Serial):
     __swf_debug = False
@@ -225,15 +265,34 @@ class DataPath(object):
     def read(self, count):
         raise DataPathIOError("Can't read from base class")
 
+    def readinto(self, buf):
+        """Appends whatever input is waiting to the caller's bytearray,
+        and returns the number of bytes added"""
+        data = self.read_all_waiting()
+        buf += data
+        return len(data)
+
     def write(self, buf):
         raise DataPathIOError("Can't write to base class")
 
+    def write_some(self, buf):
+        """Writes as much of buf as can go without blocking, and returns
+        the number of bytes written.  Paths that can't tell just write
+        it all (serial writes are bounded by the write timeout)."""
+        self.write(buf)
+        return len(buf)
+
     def flush(self, buf):
         raise DataPathIOError("Can't flush the base class")
 
     def is_connected(self):
         return False
 
+    def fileno(self):
+        """Returns a descriptor that select() can wait on for input, or
+        None if this path must be polled from its own thread"""
+        return None
+
     def __str__(self):
         return "--"
 
@@ -275,6 +334,11 @@ class AGWDataPath(DataPath):
     def get_agw_connection(self):
         return self._agw
 
+    def fileno(self):
+        if self._agw:
+            return self._agw._s.fileno()
+        return None
+
     def read_all_waiting(self):
         return agw.receive_data(self._agw)
 
@@ -333,6 +397,12 @@ class SerialDataPath(DataPath):
     def flush(self):
         self._serial.flush()
 
+    def fileno(self):
+        try:
+            return self._serial.fileno()
+        except Exception:
+            return None
+
     def __str__(self):
         return "[SERIAL %s@%s]" % (self.port, self.baud)
 
@@ -356,6 +426,17 @@ class TNCDataPath(SerialDataPath):
             utils.log_exception()
             raise DataPathNotConnectedError("Unable to open serial port")
 
+    def _read_frames(self, block=True):
+        try:
+            return self._serial.read_frames(block)
+        except Exception, e:
+            print "Serial read exception: %s" % e
+            utils.log_exception()
+            raise DataPathIOError("Failed to read from serial port")
+
+    def read_all_waiting(self):
+        return "".join(self._read_frames(False))
+
     def __str__(self):
         return "[TNC %s@%s]" % (self.port, self.baud)
 
@@ -395,7 +476,7 @@ fcstab = [
     0x7bc7, 0x6a4e, 0x58d5, 0x495c, 0x3de3, 0x2c6a, 0x1ef1, 0x0f78
     ]
 
-def compute_fcs(data):
+def compute_fcs_table(data):
     fcs = 0xffff
 
     for byte in data:
@@ -403,45 +484,82 @@ def compute_fcs(data):
     
     return (~fcs) & 0xffff
 
+# The AX.25 FCS is the bit-reflected form of the CCITT CRC that
+# binascii.crc_hqx() computes in C, so reverse the bits of each byte on
+# the way in and of the result on the way out
+_BITREV = [int("{0:08b}".format(i)[::-1], 2) for i in range(256)]
+_BITREV_TABLE = "".join([chr(i) for i in _BITREV])
+
+try:
+    from binascii import crc_hqx as _crc_hqx
+except ImportError:
+    _crc_hqx = None
+
+def compute_fcs(data):
+    if not _crc_hqx:
+        return compute_fcs_table(data)
+
+    crc = _crc_hqx(data.translate(_BITREV_TABLE), 0xFFFF)
+    crc = (_BITREV[crc & 0xFF] << 8) | _BITREV[crc >> 8]
+
+    return (~crc) & 0xffff
+
+def ax25_encode_path(dcall, spath):
+    c, s = agw.ssid(dcall)
+    dst = "".join([chr(ord(x) << 1) for x in c])
+    dst += agw.encode_ssid(s)
+
+    src = ""
+    for scall in spath:
+        c, s = agw.ssid(scall)
+        src += "".join([chr(ord(x) << 1) for x in c])
+        src += agw.encode_ssid(s, spath[-1] == scall)
+
+    return struct.pack("7s%isBB" % len(src),
+                       dst,     # Dest call
+                       src,     # Source path
+                       0x03,    # Control
+                       0xF0)    # PID: No layer 3
+
+def ax25_strip_header(frame):
+    # Each address is seven bytes, and the last one has the low bit of
+    # its SSID byte set.  Control and PID follow
+    for i in range(6, min(len(frame), 7 * 10), 7):
+        if ord(frame[i]) & 0x01:
+            return frame[i+3:]
+
+    return frame
+
 class TNCAX25DataPath(TNCDataPath):
     def __init__(self, pathspec, **kwargs):
         (port, rate, self.__call, self.__path) = pathspec
 
         self.__buffer = ""
+        self.__header = None
         TNCDataPath.__init__(self, (port, rate), **kwargs)
 
     def __str__(self):
         return "[TNC-AX25 %s@%s>%s]" % (self.port, self.baud, self.__path)
 
     def write(self, buf):
-        spath = [self.__call,] + self.__path.split(",")
-        src = ""
-        for scall in spath:
-            c, s = agw.ssid(scall)
-            src += "".join([chr(ord(x) << 1) for x in c])
-            src += agw.encode_ssid(s, spath[-1] == scall)
-        
-
-        c, s = agw.ssid("DRATS")
-        dst = "".join([chr(ord(x) << 1) for x in c])
-        dst += agw.encode_ssid(s)
-
-        hdr = struct.pack("7s%isBB" % len(src),
-                          dst,     # Dest call
-                          src,     # Source path
-                          0x03,    # Control
-                          0xF0)    # PID: No layer 3
-
-        fcs = compute_fcs(hdr + buf)
-        data = hdr + buf + struct.pack(">H", fcs)
+        if not self.__header:
+            spath = [self.__call,] + self.__path.split(",")
+            self.__header = ax25_encode_path("DRATS", spath)
+
+        data = self.__header + buf
+        data += struct.pack(">H", compute_fcs(data))
 
         #print "Transmitting AX.25 Frame:"
         #utils.hexprint(data)
         TNCDataPath.write(self, data)
 
+    def _read_payload(self, block=True):
+        frames = self._read_frames(block)
+        return "".join([ax25_strip_header(f) for f in frames])
+
     def read(self, count):
         while len(self.__buffer) < count:
-            chunk = TNCDataPath.read(self, 1)
+            chunk = self._read_payload()
             if not chunk:
                 break
             self.__buffer += chunk
@@ -450,6 +568,34 @@ class TNCAX25DataPath(TNCDataPath):
         self.__buffer = self.__buffer[count:]
         return data
 
+    def read_all_waiting(self):
+        data = self.__buffer + self._read_payload(False)
+        self.__buffer = ""
+        return data
+
+RECV_CHUNK = 4096
+_ZEROS = bytearray(RECV_CHUNK)
+
+def socket_recv_into(sock, buf, size=RECV_CHUNK):
+    """Receives up to size bytes from sock onto the end of bytearray buf,
+    and returns the number of bytes received (0 on EOF)"""
+    # Grow the caller's buffer and let the kernel copy straight into
+    # the new space, rather than building and concatenating strings
+    size = min(size, RECV_CHUNK)
+    start = len(buf)
+    buf.extend(_ZEROS[:size])
+    view = memoryview(buf)
+    try:
+        n = sock.recv_into(view[start:], size)
+    except:
+        del view
+        del buf[start:]
+        raise
+    del view
+    del buf[start + n:]
+
+    return n
+
 class SocketDataPath(DataPath):
     def __init__(self, pathspec, timeout=0.25):
         DataPath.__init__(self, pathspec, timeout)
@@ -553,7 +699,7 @@ class SocketDataPath(DataPath):
         self._socket = None
 
     def read(self, count):
-        data = ""
+        data = bytearray()
         end = time.time() + self.timeout
 
         if not self._socket:
@@ -563,28 +709,30 @@ class SocketDataPath(DataPath):
         self._socket.settimeout(self.timeout)
 
         while len(data) < count:
-
             try:
-                x = time.time()
-                inp = self._socket.recv(count - len(data))
+                n = self._recv_into(data, count - len(data))
             except socket.timeout:
                 if time.time() > end:
                     break
                 else:
                     continue
+            except DataPathIOError:
+                raise
             except Exception, e:
                 raise DataPathIOError("Socket error: %s" % e)
 
-            if inp == "":
-                raise DataPathIOError("Socket disconnected")
-
             end = time.time() + self.timeout
-            data += inp
 
+        return str(data)
 
-        return data
+    def _recv_into(self, buf, size):
+        n = socket_recv_into(self._socket, buf, size)
+        if n == 0:
+            raise DataPathIOError("Socket disconnected")
 
-    def read_all_waiting(self):
+        return n
+
+    def readinto(self, buf):
         if not self._socket:
             raise DataPathIOError("Socket disconnected")
 
@@ -592,19 +740,23 @@ class SocketDataPath(DataPath):
 
         r, w, x = select.select([self._socket], [], [], self.timeout)
         if not r:
-            return ""
+            return 0
 
-        data = ""
+        total = 0
         while True:
             try:
-                d = self._socket.recv(4096)
+                total += self._recv_into(buf, RECV_CHUNK)
+            except DataPathIOError:
+                raise
             except Exception, e:
                 break
-            if not d:
-                raise DataPathIOError("Socket disconnected")
-            data += d
 
-        return data
+        return total
+
+    def read_all_waiting(self):
+        data = bytearray()
+        self.readinto(data)
+        return str(data)
 
     def write(self, buf):
         try:
@@ -614,10 +766,28 @@ class SocketDataPath(DataPath):
             raise DataPathIOError("Socket write failed")
 
         return
+
+    def write_some(self, buf):
+        if not self._socket:
+            raise DataPathIOError("Socket disconnected")
+
+        self._socket.setblocking(False)
+        try:
+            return self._socket.send(buf)
+        except socket.error, e:
+            if e[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return 0
+            print "Socket write failed: %s" % e
+            raise DataPathIOError("Socket write failed")
             
     def is_connected(self):
         return self._socket != None
 
+    def fileno(self):
+        if self._socket:
+            return self._socket.fileno()
+        return None
+
     def flush(self):
         pass
 
@@ -627,3 +797,80 @@ class SocketDataPath(DataPath):
             return "[NET %s:%i]" % (addr, port)
         except:
             return "[NET closed]"
+
+def test_kiss_codec():
+    import os
+    import random
+
+    def check(name, result, expected):
+        if result != expected:
+            print "FAIL: %s: %s != %s" % (name, repr(result), repr(expected))
+            return False
+        return True
+
+    codec = KISSCodec()
+    ok = True
+
+    ok &= check("escape FEND", codec.escape("a\xC0b"), "a\xDB\xDCb")
+    ok &= check("escape FESC", codec.escape("a\xDBb"), "a\xDB\xDDb")
+    ok &= check("escape FESC,TFEND", codec.escape("\xDB\xDC"),
+                "\xDB\xDD\xDC")
+    ok &= check("escape FEND,FESC", codec.escape("\xC0\xDB"),
+                "\xDB\xDC\xDB\xDD")
+    ok &= check("encode", codec.encode("\xC0", 2), "\xC0\x20\xDB\xDC\xC0")
+
+    for data in ["", "\xC0", "\xDB", "\xDB\xDC", "\xDB\xDD", "\xDC\xDD",
+                 "\xC0\xC0\xDB\xDB", "plain"]:
+        ok &= check("round trip %s" % repr(data),
+                    KISSCodec().feed(codec.encode(data)),
+                    [(0, data)])
+
+    frames = [os.urandom(random.randint(1, 300)) for i in range(50)]
+    stream = "".join([codec.encode(f) for f in frames])
+    for chunk in [1, 2, 3, 7, 64, len(stream)]:
+        c = KISSCodec()
+        out = []
+        for i in range(0, len(stream), chunk):
+            out += c.feed_port(stream[i:i+chunk])
+        ok &= check("chunked by %i" % chunk, out, frames)
+        ok &= check("nothing pending after %i" % chunk, c.pending(), 0)
+
+    stream = "junk" + codec.encode("one") + "\xC0\xC0" + \
+        codec.encode("two", 1) + codec.encode("three", 3) + \
+        "\xC0\x01\x10\xC0" + \
+        "\xC0\x00bad\xDB\x41\xC0" + codec.encode("four")
+    ok &= check("ports and garbage", KISSCodec().feed(stream),
+                [(0, "one"), (1, "two"), (3, "three"), (0, "four")])
+    ok &= check("port filter", KISSCodec(3).feed_port(stream), ["three"])
+
+    shared = codec.encode("one") + codec.encode("two")[1:]
+    ok &= check("shared FEND", KISSCodec().feed(shared),
+                [(0, "one"), (0, "two")])
+    c = KISSCodec()
+    ok &= check("shared FEND split", c.feed(shared[:6]) + c.feed(shared[6:]),
+                [(0, "one"), (0, "two")])
+
+    c = KISSCodec()
+    ok &= check("partial", c.feed("\xC0\x00abc\xDB"), [])
+    ok &= check("partial rest", c.feed("\xDCdef\xC0"), [(0, "abc\xC0def")])
+
+    if ok:
+        print "PASS"
+    return ok
+
+def test_fcs(count=500):
+    import os
+    import random
+
+    for i in range(count):
+        data = os.urandom(random.randint(0, 400))
+        if compute_fcs(data) != compute_fcs_table(data):
+            print "FAIL: FCS mismatch for %s" % repr(data)
+            return False
+
+    print "PASS"
+    return True
+
+if __name__ == "__main__":
+    test_kiss_codec()
+    test_fcs()
@@ -134,6 +134,14 @@ _DEF_SETTINGS = {
     "delete_from" : "",
     "remote_admin_passwd" : "",
     "expire_stations" : "60",
+    "shared_io_thread" : "False",
+    "ddt_congestion" : "aimd",
+    "ddt_max_window" : "4096",
+    "ddt_max_window_net" : "16384",
+    "ddt_cache_size" : "32",
+    "ddt_max_xfers" : "2",
+    "ddt_compress_level" : "6",
+    "ddt_compress_dict" : "True",
 }
 
 _DEF_STATE = {
@@ -1072,6 +1080,38 @@ class DratsTransfersPanel(DratsPanel):
         val.add_numeric(-32, 32, 1)
         self.mv(_("Force transmission delay"), val)
 
+        val = DratsConfigWidget(config, "settings", "shared_io_thread")
+        val.add_bool()
+        self.mv(_("Share one I/O thread between ports"), val)
+
+        val = DratsConfigWidget(config, "settings", "ddt_congestion")
+        val.add_combo(["aimd", "legacy"])
+        self.mv(_("Window control"), val)
+
+        val = DratsConfigWidget(config, "settings", "ddt_max_window", True)
+        val.add_numeric(512, 65536, 512)
+        self.mv(_("Max bytes in flight (radio)"), val)
+
+        val = DratsConfigWidget(config, "settings", "ddt_max_window_net", True)
+        val.add_numeric(512, 65536, 512)
+        self.mv(_("Max bytes in flight (network)"), val)
+
+        val = DratsConfigWidget(config, "settings", "ddt_cache_size", True)
+        val.add_numeric(0, 4096, 8)
+        self.mv(_("Transfer cache size (MB)"), val)
+
+        val = DratsConfigWidget(config, "settings", "ddt_max_xfers", True)
+        val.add_numeric(1, 16, 1)
+        self.mv(_("Simultaneous outgoing transfers"), val)
+
+        val = DratsConfigWidget(config, "settings", "ddt_compress_level", True)
+        val.add_numeric(1, 9, 1)
+        self.mv(_("Compression level"), val)
+
+        val = DratsConfigWidget(config, "settings", "ddt_compress_dict")
+        val.add_bool()
+        self.mv(_("Compress with preset dictionary"), val)
+
         val = DratsConfigWidget(config, "settings", "delete_from")
         val.add_text()
         self.mv(_("Allow file deletes from"), val)
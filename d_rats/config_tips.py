@@ -30,6 +30,14 @@ TIPS_SETTINGS = {
     "warmup_length" : _("Amount of fake data to send during a warmup cycle"),
     "warmup_timeout" : _("Length of time between transmissions that must pass before we send a warmup block to open the power-save circuits on handhelds"),
     "force_delay" : _("Amount of time to wait between transmissions in seconds (a positive number is a fixed delay, a negative value means 'randomly choose between 0 and X')"),
+    "shared_io_thread" : _("Service all network, serial and AGWPE ports from a single thread instead of one thread per port.  Queued blocks are sent immediately instead of at the next poll.  Takes effect when a port is (re)started"),
+    "ddt_congestion" : _("How stateful transfers size their window and retry timeout: 'aimd' adapts both to the measured round trip time and losses, 'legacy' is the original fixed scheme"),
+    "ddt_max_window" : _("Largest amount of unacknowledged data a transfer may have outstanding on a serial or TNC port"),
+    "ddt_max_window_net" : _("Largest amount of unacknowledged data a transfer may have outstanding on a network port"),
+    "ddt_cache_size" : _("Space kept for copies of transferred files, so that a file already received is not sent again and one sent before is not compressed again.  Zero turns this off"),
+    "ddt_max_xfers" : _("Number of outgoing file and form transfers that may run at once on a port.  Any more wait their turn, with forms going first"),
+    "ddt_compress_level" : _("How hard to compress what is sent, from 1 (fastest) to 9 (smallest).  Anything that does not get smaller is sent as it is"),
+    "ddt_compress_dict" : _("Compress with a dictionary of common D-RATS text when talking to stations that support it.  Turn this off if you talk through an older repeater that drops such frames"),
     "delete_from" : _("Comma-separated list of callsigns that may delete files remotely"),
     "remote_admin_passwd" : _("Password required for remote administration tasks (blank for none)"),
     "ping_info" : _("Text string to return in response to a ping.") + "\n" + \
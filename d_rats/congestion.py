@@ -0,0 +1,226 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+POLICY_LEGACY = "legacy"
+POLICY_AIMD   = "aimd"
+
+class PathProfile(object):
+    """The window and timeout limits for one path, plus the round-trip
+    estimates last measured on it.  Every stateful session on a path
+    shares the profile, so a new session starts from what the previous
+    one learned instead of from scratch."""
+
+    def __init__(self, max_window=4096, min_rto=1.0, max_rto=120.0,
+                 initial_rto=12.0, policy=POLICY_AIMD):
+        self.max_window = max_window
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.initial_rto = initial_rto
+        self.policy = policy
+
+        self.srtt = None
+        self.rttvar = None
+
+    def remember(self, srtt, rttvar):
+        self.srtt = srtt
+        self.rttvar = rttvar
+
+    def make_controller(self, bsize, outlimit):
+        if self.policy == POLICY_LEGACY:
+            return LegacyController(self, bsize, outlimit)
+        else:
+            return AIMDController(self, bsize, outlimit)
+
+class LegacyController(object):
+    """The original window logic: the block limit is nudged by a count of
+    consecutive full (or partial) acks, capped at 4KB outstanding, and
+    the timeout is the time to send the pending data at the measured
+    rate with a 12 second floor"""
+
+    fast_retransmit = False
+    time_from_burst_end = False
+
+    def __init__(self, profile, bsize, outlimit):
+        self.bsize = bsize
+        self.outlimit = outlimit
+        self.full_acks = 0
+
+    def window(self):
+        limit = self.outlimit + self.full_acks
+
+        hardlimit = (1 << 12) / self.bsize
+
+        if limit < 2:
+            limit = 2
+        elif limit > hardlimit:
+            limit = hardlimit
+
+        return limit
+
+    def sent(self, start, size, retransmit):
+        pass
+
+    def acked(self, size, full):
+        if full:
+            if self.full_acks >= 0:
+                self.full_acks += 1
+            else:
+                self.full_acks = 0
+        else:
+            if self.full_acks > 0:
+                self.full_acks = 0
+            else:
+                self.full_acks -= 1
+
+    def timed_out(self):
+        if self.full_acks > 0:
+            self.full_acks = 0
+        else:
+            self.full_acks -= 1
+
+    def timeout(self, pending_size, rate):
+        if not rate:
+            # No measured rate yet so assume the minimum rate
+            rate = 80
+
+        timeout = (pending_size / rate) * 1.5
+        if timeout < 12:
+            # Don't allow small outgoing buffers to fool us into thinking
+            # there is no turnaround delay
+            timeout = 12
+
+        return timeout
+
+    def ack_timeout(self, attempts):
+        return 4 + (attempts * 4)
+
+    def get_stats(self):
+        return {"cwnd" : self.window() * self.bsize}
+
+class AIMDController(object):
+    """A byte window that doubles each round trip until the first loss,
+    then grows by one block per fully-acked round trip and halves on a
+    partial ack.  A round trip with no ack at all drops it to two blocks.
+    The retransmit timeout comes from smoothed round-trip time and
+    variance estimates (Jacobson/Karels), backed off exponentially while
+    acks are missing.  Bursts that contained retransmitted blocks are not
+    sampled (Karn's algorithm)."""
+
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+
+    fast_retransmit = True
+
+    # Round trips are timed from when the last block of a burst has gone
+    # out, so time spent sharing a busy port with other sessions doesn't
+    # look like a slow path and set off the retransmit timer early
+    time_from_burst_end = True
+
+    def __init__(self, profile, bsize, outlimit):
+        self.profile = profile
+        self.bsize = bsize
+
+        self.min_window = 2 * bsize
+        self.cwnd = min(max(outlimit * bsize, self.min_window),
+                        self.profile.max_window)
+        self.ssthresh = self.profile.max_window
+
+        self.srtt = profile.srtt
+        self.rttvar = profile.rttvar
+        if self.srtt is None:
+            self.rto = profile.initial_rto
+        else:
+            self.rto = self.srtt + (self.K * self.rttvar)
+        self.backoff = 1
+
+        self._sent_at = 0
+        self._sent_size = 0
+        self._sampling = False
+
+        self.losses = 0
+        self.timeouts = 0
+
+    def _clamp(self):
+        self.cwnd = max(self.min_window,
+                        min(self.cwnd, self.profile.max_window))
+
+    def _sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = ((1 - self.BETA) * self.rttvar) + \
+                (self.BETA * abs(self.srtt - rtt))
+            self.srtt = ((1 - self.ALPHA) * self.srtt) + (self.ALPHA * rtt)
+
+        self.rto = self.srtt + (self.K * self.rttvar)
+        self.profile.remember(self.srtt, self.rttvar)
+
+    def window(self):
+        return max(2, min(self.cwnd, self.profile.max_window) / self.bsize)
+
+    def sent(self, start, size, retransmit):
+        self._sent_at = start
+        self._sent_size = size
+        self._sampling = not retransmit
+
+    def acked(self, size, full):
+        if self._sampling:
+            self._sample(time.time() - self._sent_at)
+        self._sampling = False
+        self.backoff = 1
+
+        if not full:
+            self.losses += 1
+            self.ssthresh = max(self.cwnd / 2, self.min_window)
+            self.cwnd = self.ssthresh
+        elif self.cwnd < self.ssthresh:
+            self.cwnd += size
+        else:
+            self.cwnd += self.bsize
+
+        self._clamp()
+
+    def timed_out(self):
+        self.timeouts += 1
+        self._sampling = False
+        self.ssthresh = max(self.cwnd / 2, self.min_window)
+        self.cwnd = self.min_window
+        self.backoff = min(self.backoff * 2, 64)
+
+    def get_rto(self):
+        return max(self.profile.min_rto,
+                   min(self.rto * self.backoff, self.profile.max_rto))
+
+    def timeout(self, pending_size, rate):
+        # The burst is already out, so its size doesn't matter
+        return self.get_rto()
+
+    def ack_timeout(self, attempts):
+        return self.get_rto()
+
+    def get_stats(self):
+        return {"cwnd"     : self.cwnd,
+                "srtt"     : self.srtt or 0.0,
+                "rttvar"   : self.rttvar or 0.0,
+                "rto"      : self.get_rto(),
+                "losses"   : self.losses,
+                "timeouts" : self.timeouts,
+                }
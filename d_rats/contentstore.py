@@ -0,0 +1,218 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import struct
+import shutil
+import threading
+
+# Each cached record is stored behind its chunk index and length
+RECORD_FORMAT = "!II"
+RECORD_HDR_SIZE = struct.calcsize(RECORD_FORMAT)
+
+class ChunkCache(object):
+    """The compressed chunk records of one file, kept on disk so that
+    sending the same file again doesn't mean compressing it again.
+    Records are appended in whatever order they were made, and found
+    again through an index of their offsets built when it is opened."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._offsets = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+
+        f = file(self.filename, "rb")
+        offset = 0
+        while True:
+            header = f.read(RECORD_HDR_SIZE)
+            if len(header) < RECORD_HDR_SIZE:
+                break
+            i, size = struct.unpack(RECORD_FORMAT, header)
+            f.seek(size, 1)
+            if f.tell() != offset + RECORD_HDR_SIZE + size:
+                break
+            self._offsets[i] = (offset + RECORD_HDR_SIZE, size)
+            offset += RECORD_HDR_SIZE + size
+        f.close()
+
+        if offset != os.path.getsize(self.filename):
+            # Drop a record that was cut short
+            f = file(self.filename, "r+b")
+            f.truncate(offset)
+            f.close()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def get(self, i):
+        """Returns the record for chunk i, or None if we don't have it"""
+        self._lock.acquire()
+        try:
+            if i not in self._offsets:
+                return None
+
+            offset, size = self._offsets[i]
+            f = file(self.filename, "rb")
+            f.seek(offset - RECORD_HDR_SIZE)
+            header = f.read(RECORD_HDR_SIZE)
+            record = f.read(size)
+            f.close()
+        except IOError, e:
+            print "Unable to read chunk cache %s: %s" % (self.filename, e)
+            return None
+        finally:
+            self._lock.release()
+
+        # The store may have thrown the file out from under us
+        if header != struct.pack(RECORD_FORMAT, i, size) or \
+                len(record) != size:
+            return None
+
+        return record
+
+    def put(self, i, record):
+        self._lock.acquire()
+        try:
+            if i in self._offsets:
+                return
+
+            f = file(self.filename, "ab")
+            f.seek(0, 2)
+            offset = f.tell()
+            f.write(struct.pack(RECORD_FORMAT, i, len(record)) + record)
+            f.close()
+
+            self._offsets[i] = (offset + RECORD_HDR_SIZE, len(record))
+        finally:
+            self._lock.release()
+
+class ContentStore(object):
+    """Files we have received, filed by their SHA-1, so that a file
+    offered to us again can be taken from here instead of over the air.
+    It also holds the chunk caches of the files we send.  The least
+    recently used entries are thrown out to keep it under max_size
+    bytes, and a max_size of zero turns it off."""
+
+    def __init__(self, path, max_size=32 << 20):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def set_max_size(self, max_size):
+        self.max_size = max_size
+        self.trim()
+
+    def is_enabled(self):
+        return self.max_size > 0
+
+    def _path(self, digest, suffix=""):
+        return os.path.join(self.path, digest.encode("hex") + suffix)
+
+    def _touch(self, filename):
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+    def lookup(self, digest):
+        """Returns the path of the file with this hash, or None"""
+        if not self.is_enabled():
+            return None
+
+        filename = self._path(digest)
+        if not os.path.exists(filename):
+            return None
+
+        self._touch(filename)
+        return filename
+
+    def add(self, filename, digest):
+        """Files a copy of filename, whose hash is digest"""
+        if not self.is_enabled() or self.lookup(digest):
+            return
+
+        if os.path.getsize(filename) > self.max_size:
+            return
+
+        # Copy, rather than link, because the original may be changed
+        # after we have filed it (forms get their path updated)
+        dest = self._path(digest)
+        try:
+            shutil.copyfile(filename, dest + ".tmp")
+            os.rename(dest + ".tmp", dest)
+        except Exception, e:
+            print "Unable to add %s to the content store: %s" % (filename, e)
+            return
+
+        self.trim()
+
+    def get_chunk_cache(self, digest, chunk_size, codec=None):
+        """Returns the ChunkCache for the file with this hash when sent in
+        chunks of chunk_size (compressed with codec, if the chunks say
+        which), or None if the store is turned off"""
+        if not self.is_enabled():
+            return None
+
+        if codec is None:
+            suffix = "-%i.chunks" % chunk_size
+        else:
+            suffix = "-%i-%02x.chunks" % (chunk_size, codec)
+        filename = self._path(digest, suffix)
+        self._touch(filename)
+
+        return ChunkCache(filename)
+
+    def get_size(self):
+        size = 0
+        for name in os.listdir(self.path):
+            size += os.path.getsize(os.path.join(self.path, name))
+
+        return size
+
+    def trim(self):
+        """Removes the least recently used entries until we fit"""
+        self._lock.acquire()
+        try:
+            entries = []
+            total = 0
+            for name in os.listdir(self.path):
+                filename = os.path.join(self.path, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filename))
+                total += st.st_size
+
+            entries.sort()
+            while entries and total > self.max_size:
+                mtime, size, filename = entries.pop(0)
+                try:
+                    os.remove(filename)
+                except OSError, e:
+                    print "Unable to remove %s: %s" % (filename, e)
+                total -= size
+        finally:
+            self._lock.release()
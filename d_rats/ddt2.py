@@ -46,7 +46,7 @@ def update_crc(c, crc):
 
     return crc & 0xFFFF
 
-def calc_checksum(data):
+def calc_checksum_bitwise(data):
     checksum = 0
     for i in data:
         checksum = update_crc(ord(i), checksum)
@@ -56,13 +56,235 @@ def calc_checksum(data):
 
     return checksum
 
+def _make_crc_table():
+    # Feeding a byte through update_crc() with the two trailing zero
+    # bytes is equivalent to a plain (non-augmented) CCITT CRC, so the
+    # table is the usual MSB-first 0x1021 one
+    table = []
+    for i in range(0, 256):
+        crc = i << 8
+        for _ in range(0, 8):
+            if crc & 0x8000:
+                crc = (crc << 1) ^ 0x1021
+            else:
+                crc <<= 1
+        table.append(crc & 0xFFFF)
+
+    return table
+
+CRC_TABLE = _make_crc_table()
+
+def calc_checksum_table(data):
+    checksum = 0
+    table = CRC_TABLE
+    for i in data:
+        checksum = ((checksum << 8) & 0xFF00) ^ \
+            table[(checksum >> 8) ^ ord(i)]
+
+    return checksum
+
+try:
+    from binascii import crc_hqx as _crc_hqx
+    def calc_checksum_native(data):
+        return _crc_hqx(data, 0)
+except ImportError:
+    calc_checksum_native = None
+
+CHECKSUM_ENGINES = {
+    "bitwise" : calc_checksum_bitwise,
+    "table"   : calc_checksum_table,
+    }
+if calc_checksum_native:
+    CHECKSUM_ENGINES["native"] = calc_checksum_native
+    _checksum_engine = calc_checksum_native
+else:
+    _checksum_engine = calc_checksum_table
+
+def set_checksum_engine(name):
+    global _checksum_engine
+
+    try:
+        _checksum_engine = CHECKSUM_ENGINES[name]
+    except KeyError:
+        raise ValueError("Unknown checksum engine `%s'" % name)
+
+def get_checksum_engines():
+    return sorted(CHECKSUM_ENGINES.keys())
+
+def calc_checksum(data):
+    return _checksum_engine(data)
+
+# Frame codecs.  The codec a frame was packed with is carried in its
+# magic byte, so the receiver always knows how to unpack it.  Stations
+# that predate codecs only know CODEC_ZLIB and CODEC_NONE, so the others
+# are only used with stations that have said they speak them
+CODEC_NONE  = 0x22
+CODEC_ZLIB  = 0xDD
+CODEC_ZDICT = 0xD1 # zlib primed with ZDICT
+
+CODECS = {
+    CODEC_NONE  : "none",
+    CODEC_ZLIB  : "zlib",
+    CODEC_ZDICT : "zdict",
+    }
+
+# The preset dictionary of CODEC_ZDICT: strings that turn up all the time
+# in forms, RPC calls and position reports, the most common last, where
+# they are cheapest to refer back to.  Every station must have exactly
+# the same one, so this can never be changed, only replaced by another
+# codec.
+ZDICT = \
+    "RPCDeleteFileJob\x1dRPCCheckMail\x1dhost\x1fuser\x1fpasw\x1fport" \
+    "\x1fssl\x1fRPCTransferQueue\x1dRPCGetVersion\x1dversion\x1f" \
+    "os\x1fpyver\x1fpygtkver\x1fgtkver\x1eRPCPositionReport\x1dst\x1f" \
+    "RPCFileListJob\x1dRPCFormListJob\x1dRPCPullFileJob\x1dfn\x1f" \
+    "RPCPullFormJob\x1dfn\x1frc\x1fFile not found\x1erc\x1fOK\x1e" \
+    "$GPRMC,,A,,N,,W,,E,,S,,*$GPGGA,,1,,0,,M,0,M,,*" \
+    "Routine Welfare Priority Emergency Incident Name Precedence " \
+    "Originating station location Recipient Sender Signature Reply " \
+    "Number Date Time Message Subject the and to of for in is on that " \
+    "<field id=\"precedence\">\n<caption>Precedence</caption>\n" \
+    "<entry type=\"choice\">\n<choice set=\"y\">Routine</choice>\n" \
+    "<choice set=\"n\">Welfare</choice>\n<choice set=\"n\">" \
+    "<entry type=\"toggle\">False</entry>\n</field>\n" \
+    "<entry type=\"numeric\">1</entry>\n</field>\n" \
+    "<?xml version=\"1.0\"?>\n<xml>\n  <form id=\"email\">\n" \
+    "<title>Email Message</title>\n<path>" \
+    "<src></src><dst></dst><e></e></path>\n" \
+    "<field id=\"_auto_number\">\n<caption>Number</caption>\n" \
+    "<field id=\"sender\">\n<caption>Sender</caption>\n" \
+    "<field id=\"recip\">\n<caption>Recipient</caption>\n" \
+    "<field id=\"date\">\n<caption>Date</caption>\n" \
+    "<entry type=\"date\">" \
+    "<field id=\"time\">\n<caption>Time</caption>\n" \
+    "<entry type=\"time\">" \
+    "<field id=\"subject\">\n<caption>Subject</caption>\n" \
+    "<field id=\"message\">\n<caption>Message</caption>\n" \
+    "<entry type=\"multiline\">" \
+    "</entry>\n</field>\n<field id=\"" \
+    "\">\n<caption></caption>\n<entry type=\"text\">" \
+    "</entry>\n    </field>\n  </form>\n</xml>\n"
+
+_compress_level = 6
+
+def set_compress_level(level):
+    global _compress_level
+
+    if level < 1 or level > 9:
+        raise ValueError("Compression level must be 1-9, not %i" % level)
+
+    _compress_level = level
+
+def get_compress_level():
+    return _compress_level
+
+# This zlib can't be given a preset dictionary, so CODEC_ZDICT gets the
+# same effect with raw deflate streams that have been fed the dictionary
+# first and flushed: what follows refers back into it just the same.
+# Compressors are primed once per level and copied for each frame.  Any
+# stream that inflates to ZDICT primes the decompressor, so it doesn't
+# care what level the sender used.
+_zdict_compressors = {}
+_zdict_decompressor = None
+_zdict_lock = threading.Lock()
+
+def _zdict_compressor():
+    _zdict_lock.acquire()
+    try:
+        z = _zdict_compressors.get(_compress_level, None)
+        if not z:
+            z = zlib.compressobj(_compress_level, zlib.DEFLATED,
+                                 -zlib.MAX_WBITS)
+            z.compress(ZDICT)
+            z.flush(zlib.Z_SYNC_FLUSH)
+            _zdict_compressors[_compress_level] = z
+        return z.copy()
+    finally:
+        _zdict_lock.release()
+
+def _zdict_decompressobj():
+    global _zdict_decompressor
+
+    _zdict_lock.acquire()
+    try:
+        if not _zdict_decompressor:
+            c = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+            primer = c.compress(ZDICT) + c.flush(zlib.Z_SYNC_FLUSH)
+            z = zlib.decompressobj(-zlib.MAX_WBITS)
+            z.decompress(primer)
+            _zdict_decompressor = z
+        return _zdict_decompressor.copy()
+    finally:
+        _zdict_lock.release()
+
+def compress(data, codec):
+    """Compresses data with codec, at the current compression level"""
+    if codec == CODEC_NONE:
+        return data
+    elif codec == CODEC_ZLIB:
+        return zlib.compress(data, _compress_level)
+    elif codec == CODEC_ZDICT:
+        z = _zdict_compressor()
+        return z.compress(data) + z.flush()
+    else:
+        raise ValueError("Unknown codec 0x%02X" % codec)
+
+def compress_smaller(data, codec):
+    """Compresses data with codec unless that doesn't make it smaller.
+    Returns the codec actually used and the result."""
+    if codec != CODEC_NONE and data:
+        zdata = compress(data, codec)
+        if len(zdata) < len(data):
+            return codec, zdata
+
+    return CODEC_NONE, data
+
+def decompress(data, codec, max_length=0):
+    """Undoes compress().  If max_length is given, raises zlib.error
+    rather than return more than that."""
+    if codec == CODEC_NONE:
+        result = data
+    elif codec == CODEC_ZLIB and not max_length:
+        return zlib.decompress(data)
+    elif codec in [CODEC_ZLIB, CODEC_ZDICT]:
+        if codec == CODEC_ZLIB:
+            z = zlib.decompressobj()
+        else:
+            z = _zdict_decompressobj()
+        if max_length:
+            result = z.decompress(data, max_length + 1)
+        else:
+            result = z.decompress(data) + z.flush()
+    else:
+        raise ValueError("Unknown codec 0x%02X" % codec)
+
+    if max_length and len(result) > max_length:
+        raise zlib.error("More than %i bytes" % max_length)
+
+    return result
+
 def encode(data):
-    return yencode.yencode_buffer(data)
+    return yencode.yencode_fast(data)
 
 def decode(data):
-    return yencode.ydecode_buffer(data)
+    return yencode.ydecode_fast(data)
+
+# Guards the making of a frame's events, which only happens for the few
+# frames that somebody waits on
+_event_lock = threading.Lock()
 
 class DDT2Frame(object):
+    """One frame.  There are a great many of these (every block received,
+    and a copy of every block for each port a repeater sends it out of),
+    so they have no __dict__, and the events a sender waits on are only
+    made when someone asks for them.  The wire form is kept once built
+    (or as received), and copies share it until they are changed."""
+
+    __slots__ = ("seq", "session", "type", "d_station", "s_station",
+                 "data", "priority", "compress", "codec",
+                 "_sent", "_sent_ev", "_ackd", "_ackd_ev", "_wire",
+                 "_xmit_s", "_xmit_e", "_xmit_z")
+
     format = "!BHBBHH8s8s"
     cso = 6
     csl = 2
@@ -74,17 +296,74 @@ class DDT2Frame(object):
         self.d_station = ""
         self.s_station = ""
         self.data = ""
-        self.magic = 0xDD
+        self.priority = None
 
-        self.sent_event = threading.Event()
-        self.ackd_event = threading.Event()
+        self._sent = self._ackd = False
+        self._sent_ev = self._ackd_ev = None
 
         self.compress = True
+        # None leaves it to the session manager, which knows what the
+        # destination speaks
+        self.codec = None
+
+        # The key the wire form was built for, and the wire form
+        self._wire = None
 
         self._xmit_s = 0
         self._xmit_e = 0
         self._xmit_z = 0
 
+    def _get_event(self, flag, name):
+        ev = getattr(self, name)
+        if ev is None:
+            _event_lock.acquire()
+            try:
+                ev = getattr(self, name)
+                if ev is None:
+                    ev = threading.Event()
+                    setattr(self, name, ev)
+                    # Publish the event before looking at the flag, the
+                    # reverse of set_sent(), so one of us always sets it
+                    if getattr(self, flag):
+                        ev.set()
+            finally:
+                _event_lock.release()
+
+        return ev
+
+    @property
+    def sent_event(self):
+        return self._get_event("_sent", "_sent_ev")
+
+    @property
+    def ackd_event(self):
+        return self._get_event("_ackd", "_ackd_ev")
+
+    def set_sent(self):
+        """Marks the frame sent, without making an event nobody waits on"""
+        self._sent = True
+        ev = self._sent_ev
+        if ev is not None:
+            ev.set()
+
+    def clear_sent(self):
+        self._sent = False
+        ev = self._sent_ev
+        if ev is not None:
+            ev.clear()
+
+    def is_sent(self):
+        ev = self._sent_ev
+        if ev is not None:
+            return ev.isSet()
+        return self._sent
+
+    def set_ackd(self):
+        self._ackd = True
+        ev = self._ackd_ev
+        if ev is not None:
+            ev.set()
+
     def get_xmit_bps(self):
         if not self._xmit_e:
             print "Block not sent, can't determine BPS!"
@@ -98,12 +377,40 @@ class DDT2Frame(object):
     def set_compress(self, compress=True):
         self.compress = compress
 
-    def get_packed(self):
-        if self.compress:
-            data = zlib.compress(self.data, 9)
+    def set_codec(self, codec):
+        self.codec = codec
+
+    def get_codec(self):
+        """Returns the codec this frame will be compressed with"""
+        if not self.compress:
+            return CODEC_NONE
+        elif self.codec is None:
+            return CODEC_ZLIB
         else:
-            data = self.data
-            self.magic = (~self.magic) & 0xFF
+            return self.codec
+
+    def _wire_key(self):
+        # Everything the wire form depends on.  The data is compared by
+        # identity first, so this is cheap for copies of the same frame.
+        return (self.seq, self.session, self.type,
+                self.s_station, self.d_station, self.data,
+                self.get_codec(), _compress_level)
+
+    def get_packed(self):
+        key = self._wire_key()
+        wire = self._wire
+        if wire is None or wire[0] != key:
+            wire = (key, self._pack())
+            self._wire = wire
+
+        self._xmit_z = len(wire[1])
+
+        return wire[1]
+
+    def _pack(self):
+        # Frames that don't get any smaller (already compressed data,
+        # tiny acks) go as they are, which every station understands
+        magic, data = compress_smaller(self.data, self.get_codec())
 
         length = len(data)
         
@@ -111,7 +418,7 @@ class DDT2Frame(object):
         d_station = self.d_station.ljust(8, "~")
 
         val = struct.pack(self.format,
-                          self.magic,
+                          magic,
                           self.seq,
                           self.session,
                           self.type,
@@ -123,7 +430,7 @@ class DDT2Frame(object):
         checksum = calc_checksum(val + data)
 
         val = struct.pack(self.format,
-                          self.magic,
+                          magic,
                           self.seq,
                           self.session,
                           self.type,
@@ -132,20 +439,20 @@ class DDT2Frame(object):
                           s_station,
                           d_station)
 
-        self._xmit_z = len(val) + len(data)
-
         return val + data
 
     def unpack(self, val):
         magic = ord(val[0])
-        if magic == 0xDD:
-            self.compress = True
-        elif magic == 0x22:
-            self.compress = False
-        else:
+        if magic not in CODECS:
             print "Magic 0x%X not recognized" % magic
             return False
 
+        self.compress = magic != CODEC_NONE
+        if self.compress:
+            self.codec = magic
+        else:
+            self.codec = None
+
         header = val[:25]
         data = val[25:]
 
@@ -172,13 +479,22 @@ class DDT2Frame(object):
             print "Checksum failed: %s != %s" % (checksum, _checksum)
             return False
 
-        if self.compress:
-            self.data = zlib.decompress(data)
-        else:
-            self.data = data
+        try:
+            self.data = decompress(data, magic)
+        except zlib.error, e:
+            print "Unable to decompress frame: %s" % e
+            return False
+
+        # What we received is as good a wire form as any we would build,
+        # so copies sent on (by a repeater) don't have to pack it again
+        self._set_wire(val)
 
         return True
 
+    def _set_wire(self, val):
+        self._wire = (self._wire_key(), val)
+        self._xmit_z = len(val)
+
     def __str__(self):
         if self.compress:
             c = "+"
@@ -204,12 +520,23 @@ class DDT2Frame(object):
         f.s_station = self.s_station
         f.d_station = self.d_station
         f.data = self.data
-        f.set_compress(self.compress)
+        f.priority = self.priority
+        f.compress = self.compress
+        f.codec = self.codec
+        f._wire = self._wire
         return f
 
+    def get_prepacked(self):
+        """Returns a copy of this frame with its wire form built, which
+        further copies share"""
+        self.get_packed()
+        return self.get_copy()
+
 class DDT2EncodedFrame(DDT2Frame):
-    def get_packed(self):
-        raw = DDT2Frame.get_packed(self)
+    __slots__ = ()
+
+    def _pack(self):
+        raw = DDT2Frame._pack(self)
 
         encoded = encode(raw)
 
@@ -217,7 +544,8 @@ class DDT2EncodedFrame(DDT2Frame):
 
     def unpack(self, val):
         try:
-            h = val.index(ENCODED_HEADER) + len(ENCODED_TRAILER)
+            s = val.index(ENCODED_HEADER)
+            h = s + len(ENCODED_HEADER)
             t = val.rindex(ENCODED_TRAILER)
             payload = val[h:t]
         except Exception, e:
@@ -230,9 +558,19 @@ class DDT2EncodedFrame(DDT2Frame):
             print "Unable to decode frame: %s" % e
             return False
 
-        return DDT2Frame.unpack(self, decoded)
+        if not DDT2Frame.unpack(self, decoded):
+            return False
+
+        end = t + len(ENCODED_TRAILER)
+        if s != 0 or end != len(val):
+            val = val[s:end]
+        self._set_wire(val)
+
+        return True
 
 class DDT2RawData(DDT2Frame):
+    __slots__ = ()
+
     def get_packed(self):
         return self.data
 
@@ -268,7 +606,150 @@ def test_crap():
     except Exception, e:
         print "PASS"
 
+def test_prepacked():
+    for compress in [True, False]:
+        f = DDT2EncodedFrame()
+        f.s_station = "FOO"
+        f.d_station = "CQCQCQ"
+        f.data = "This is a test"
+        f.set_compress(compress)
+
+        ref = f.get_copy().get_packed()
+        p = f.get_prepacked()
+        copies = [p.get_copy() for i in range(0, 3)]
+        if [c.get_packed() for c in copies + [p]] != [ref] * 4:
+            print "FAIL: prepacked frame differs (compress=%s)" % compress
+            return False
+
+        fout = DDT2EncodedFrame()
+        if not fout.unpack(copies[0].get_packed()) or fout.data != f.data:
+            print "FAIL: prepacked frame does not unpack"
+            return False
+
+    print "PASS: prepacked frames"
+    return True
+
+def test_codecs():
+    import os
+
+    samples = ["", "x", "This is a test" * 20, os.urandom(1000),
+               "<?xml version=\"1.0\"?>\n<xml>\n  <form id=\"email\">\n"]
+    for codec in sorted(CODECS.keys()):
+        for level in [1, 9]:
+            set_compress_level(level)
+            for data in samples:
+                if decompress(compress(data, codec), codec) != data:
+                    print "FAIL: %s at level %i" % (CODECS[codec], level)
+                    return False
+
+                used, zdata = compress_smaller(data, codec)
+                if len(zdata) > len(data) or \
+                        decompress(zdata, used) != data:
+                    print "FAIL: %s made data bigger" % CODECS[codec]
+                    return False
+
+        try:
+            decompress(compress("A" * 100, codec), codec, 99)
+            print "FAIL: %s ignored max_length" % CODECS[codec]
+            return False
+        except zlib.error:
+            pass
+
+    set_compress_level(6)
+
+    for codec in [None] + sorted(CODECS.keys()):
+        f = DDT2EncodedFrame()
+        f.data = "This is a test " * 10
+        f.set_codec(codec)
+
+        # Packing it twice (to retransmit it) must give the same frame
+        p = f.get_packed()
+        if f.get_packed() != p:
+            print "FAIL: frame changed when packed again (%s)" % codec
+            return False
+
+        fout = DDT2EncodedFrame()
+        if not fout.unpack(p) or fout.data != f.data or \
+                fout.get_codec() != f.get_codec():
+            print "FAIL: frame with codec %s does not unpack" % codec
+            return False
+
+    print "PASS: codecs"
+    return True
+
+def test_frame_state():
+    f = DDT2EncodedFrame()
+    f.s_station = "FOO"
+    f.d_station = "BAR"
+    f.data = "This is a test " * 10
+
+    # Nobody waited, so no event was made, but it still reads as sent
+    f.set_sent()
+    if f._sent_ev is not None or not f.sent_event.isSet():
+        print "FAIL: sent state lost"
+        return False
+    f.clear_sent()
+    if f.is_sent() or f.sent_event.isSet():
+        print "FAIL: sent state not cleared"
+        return False
+
+    p = f.get_packed()
+    c = f.get_copy()
+    if c.get_packed() is not p:
+        print "FAIL: copy packed the frame again"
+        return False
+
+    c.seq = 5
+    fout = DDT2EncodedFrame()
+    if c.get_packed() == p or not fout.unpack(c.get_packed()) or \
+            fout.seq != 5:
+        print "FAIL: changed copy kept the old wire form"
+        return False
+
+    # A frame passed on as received goes out as it came in
+    if fout.get_copy().get_packed() is not c.get_packed():
+        print "FAIL: received frame packed again"
+        return False
+
+    print "PASS: frame state"
+    return True
+
+def test_checksum_engines(count=500):
+    import os
+    import random
+
+    for i in range(0, count):
+        data = os.urandom(random.randint(0, 1100))
+        ref = calc_checksum_bitwise(data)
+        for name, fn in CHECKSUM_ENGINES.items():
+            if fn(data) != ref:
+                print "FAIL: %s gave 0x%04x, expected 0x%04x (len %i)" % (\
+                    name, fn(data), ref, len(data))
+                return False
+
+    print "PASS: %s agree on %i buffers" % (", ".join(get_checksum_engines()),
+                                            count)
+    return True
+
+def benchmark_checksum(size=1024, count=200):
+    import os
+    import time
+
+    data = os.urandom(size)
+    for name in get_checksum_engines():
+        fn = CHECKSUM_ENGINES[name]
+        start = time.time()
+        for i in range(0, count):
+            fn(data)
+        elapsed = time.time() - start
+        print "%-8s %10.1f KB/s" % (name, (size * count / 1024.0) / elapsed)
+
 if __name__ == "__main__":
+    test_checksum_engines()
+    benchmark_checksum()
     test_symmetric()
     test_symmetric(False)
     test_crap()
+    test_prepacked()
+    test_codecs()
+    test_frame_state()
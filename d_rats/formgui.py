@@ -33,6 +33,8 @@ from utils import run_or_error
 from ui.main_common import ask_for_confirmation
 import platform
 import spell
+import msgindex
+from formheader import xml_escapes, xml_escape, xml_unescape
 
 test = """
 <xml>
@@ -54,12 +56,6 @@ test = """
 
 """
 
-xml_escapes = [("<", "&lt;"),
-               (">", "&gt;"),
-               ("&", "&amp;"),
-               ('"', "&quot;"),
-               ("'", "&apos;")]
-
 RESPONSE_SEND     = -900
 RESPONSE_SAVE     = -901
 RESPONSE_REPLY    = -902
@@ -73,52 +69,6 @@ STYLE_BRIGHT_INSENSITIVE = style
 del style
 del i
 
-def xml_escape(string):
-    d = {}
-    for char, esc in xml_escapes:
-        d[char] = esc
-
-    out = ""
-    for i in string:
-        out += d.get(i, i)
-
-    return out
-
-def xml_unescape(string):
-    d = {}
-    for char, esc in xml_escapes:
-        d[esc] = char
-
-    out = ""
-    i = 0
-    while i < len(string):
-        if string[i] != "&":
-            out += string[i]
-            i += 1
-        else:
-            try:
-                semi = string[i:].index(";") + i + 1
-            except:
-                print "XML Error: & with no ;"
-                i += 1
-                continue
-
-            esc = string[i:semi]
-
-            if not esc:
-                print "No escape: %i:%i" % (i, semi)
-                i += 1
-                continue
-
-            if d.has_key(string[i:semi]):
-                out += d[esc]
-            else:
-                print "XML Error: No such escape: `%s'" % esc
-                
-            i += len(esc)
-
-    return out
-
 class FormWriter(object):
     def write(self, formxml, outfile):
         doc = libxml2.parseMemory(formxml, len(formxml))
@@ -629,6 +579,7 @@ class FormFile(object):
         f = file(filename, "w")
         print >>f, self.doc.serialize()
         f.close()
+        msgindex.message_saved(filename, self)
 
     def export_to_string(self):
         w = HTMLFormWriter(self.id, self.xsl_dir)
@@ -640,14 +591,16 @@ class FormFile(object):
     def process_form(self, doc):
         ctx = doc.xpathNewContext()
         forms = ctx.xpathEval("//form")
+        ctx.xpathFreeContext()
         if len(forms) != 1:
             raise Exception("%i forms in document" % len(forms))
 
-        form = forms[0]
-        
-        self.id = form.prop("id")
+        self.__form = forms[0]
+        self.id = self.__form.prop("id")
+
+        self.__index_form()
 
-        titles = ctx.xpathEval("//form/title")
+        titles = self.__children.get("title", [])
         if len(titles) != 1:
             raise Exception("%i titles in document" % len(titles))
 
@@ -655,7 +608,7 @@ class FormFile(object):
 
         self.title_text = title.children.getContent().strip()
 
-        logos = ctx.xpathEval("//form/logo")
+        logos = self.__children.get("logo", [])
         if len(logos) > 1:
             raise Exception("%i logos in document" % len(logos))
         elif len(logos) == 1:
@@ -664,7 +617,44 @@ class FormFile(object):
         else:
             self.logo_path = None
 
-        ctx.xpathFreeContext()
+    def __index_form(self):
+        """Finds the fields, path and attachments of the form in one walk
+        over it, so that getting and setting them doesn't mean searching
+        the document every time.  The index holds nodes, not their
+        content, so it only goes stale when nodes are added or removed"""
+        self.__children = {}
+        self.__entries = {}
+        self.__captions = {}
+        self.__path_els = {}
+        self.__atts = {}
+
+        def elements(node):
+            child = node.children
+            while child:
+                if child.type == "element":
+                    yield child
+                child = child.next
+
+        for child in elements(self.__form):
+            self.__children.setdefault(child.name, []).append(child)
+            if child.name == "field":
+                id = child.prop("id")
+                for node in elements(child):
+                    if node.name == "entry":
+                        self.__entries.setdefault(id, []).append(node)
+                    elif node.name == "caption":
+                        self.__captions.setdefault(id, []).append(node)
+            elif child.name == "path":
+                for node in elements(child):
+                    self.__path_els.setdefault(node.name, []).append(node)
+            elif child.name == "att":
+                self.__atts.setdefault(child.prop("name"), []).append(child)
+
+        self.__indexed = True
+
+    def __index(self):
+        if not self.__indexed:
+            self.__index_form()
 
     def __set_content(self, node, content):
         child = node.children
@@ -674,25 +664,19 @@ class FormFile(object):
             child = child.next
         node.addContent(content)
 
-    def __get_xpath(self, path):
-        ctx = self.doc.xpathNewContext()
-        result = ctx.xpathEval(path)
-        ctx.xpathFreeContext()
-        return result
-
     def get_path(self):
+        self.__index()
         pathels = []
-        for element in self.__get_xpath("//form/path/e"):
+        for element in self.__path_els.get("e", []):
             pathels.append(element.getContent().strip())
         return pathels
     
     def __get_path(self):
-        els = self.__get_xpath("//form/path")
+        self.__index()
+        els = self.__children.get("path", [])
         if not els:
-            ctx = self.doc.xpathNewContext()
-            form, = ctx.xpathEval("//form")
-            ctx.xpathFreeContext()
-            return form.newChild(None, "path", None)
+            self.__indexed = False
+            return self.__form.newChild(None, "path", None)
         else:
             return els[0]
 
@@ -701,11 +685,13 @@ class FormFile(object):
 
         if append:
             path.newChild(None, name, element)
+            self.__indexed = False
             return
 
-        els = self.__get_xpath("//form/path/%s" % name)
+        els = self.__path_els.get(name, [])
         if not els:
             path.newChild(None, name, element)
+            self.__indexed = False
             return
 
         self.__set_content(els[0], element)
@@ -723,7 +709,8 @@ class FormFile(object):
         self.__add_path_element("mid", mid)
 
     def __get_path_element(self, name):
-        els = self.__get_xpath("//form/path/%s" % name)
+        self.__index()
+        els = self.__path_els.get(name, [])
         if els:
             return els[0].getContent().strip()
         else:
@@ -738,26 +725,36 @@ class FormFile(object):
     def get_path_mid(self):
         return self.__get_path_element("mid")
 
-    def get_field_value(self, id):
-        els = self.__get_xpath("//form/field[@id='%s']/entry" % id)
+    def __get_field_node(self, kind, id):
+        self.__index()
+        if kind == "caption":
+            els = self.__captions.get(id, [])
+        else:
+            els = self.__entries.get(id, [])
         if len(els) == 1:
-            return xml_unescape(els[0].getContent().strip())
+            return els[0]
         elif len(els) > 1:
             raise Exception("More than one id=%s node!" % id)
         else:
             return None
 
+    def get_field_value(self, id):
+        el = self.__get_field_node("entry", id)
+        if el is not None:
+            return xml_unescape(el.getContent().strip())
+        else:
+            return None
+
     def get_field_caption(self, id):
-        els = self.__get_xpath("//form/field[@id='%s']/caption" % id)
-        if len(els) == 1:
-            return xml_unescape(els[0].getContent().strip())
-        elif len(els) > 1:
-            raise Exception("More than one id=%s node!" % id)
+        el = self.__get_field_node("caption", id)
+        if el is not None:
+            return xml_unescape(el.getContent().strip())
         else:
             return None
 
     def set_field_value(self, id, value):
-        els = self.__get_xpath("//form/field[@id='%s']/entry" % id)
+        self.__index()
+        els = self.__entries.get(id, [])
         print "Setting %s to %s (%i)" % (id, value, len(els))
         if len(els) == 1:
             if els[0].prop("type") == "multiline":
@@ -798,9 +795,9 @@ class FormFile(object):
             return self._try_get_fields("_auto_sender", "sender")
 
     def get_attachments(self):
+        self.__index()
         atts = []
-        els = self.__get_xpath("//form/att")
-        for el in els:
+        for el in self.__children.get("att", []):
             name = el.prop("name")
             data = el.getContent()
             atts.append((name, len(data)))
@@ -808,7 +805,8 @@ class FormFile(object):
         return atts
 
     def get_attachment(self, name):
-        els = self.__get_xpath("//form/att[@name='%s']" % name)
+        self.__index()
+        els = self.__atts.get(name, [])
         if len(els) == 1:
             data = els[0].getContent()
             data = base64.b64decode(data)
@@ -826,18 +824,19 @@ class FormFile(object):
         if att is not None:
             raise Exception("Already have an attachment named `%s'" % name)
 
-        els = self.__get_xpath("//form")
-        if len(els) == 1:
-            attnode = els[0].newChild(None, "att", None)
-            attnode.setProp("name", name)
-            data = zlib.compress(data, 9)
-            data = base64.b64encode(data)
-            self.__set_content(attnode, data)
+        attnode = self.__form.newChild(None, "att", None)
+        attnode.setProp("name", name)
+        data = zlib.compress(data, 9)
+        data = base64.b64encode(data)
+        self.__set_content(attnode, data)
+        self.__indexed = False
 
     def del_attachment(self, name):
-        els = self.__get_xpath("//form/att[@name='%s']" % name)
+        self.__index()
+        els = self.__atts.get(name, [])
         if len(els) == 1:
             els[0].unlinkNode()
+            self.__indexed = False
 
 class FormDialog(FormFile, gtk.Dialog):
     def save_to(self, *args):
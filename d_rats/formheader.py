@@ -0,0 +1,320 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import xml.parsers.expat
+
+xml_escapes = [("<", "&lt;"),
+               (">", "&gt;"),
+               ("&", "&amp;"),
+               ('"', "&quot;"),
+               ("'", "&apos;")]
+
+def xml_escape(string):
+    d = {}
+    for char, esc in xml_escapes:
+        d[char] = esc
+
+    out = ""
+    for i in string:
+        out += d.get(i, i)
+
+    return out
+
+def xml_unescape(string):
+    d = {}
+    for char, esc in xml_escapes:
+        d[esc] = char
+
+    out = ""
+    i = 0
+    while i < len(string):
+        if string[i] != "&":
+            out += string[i]
+            i += 1
+        else:
+            try:
+                semi = string[i:].index(";") + i + 1
+            except:
+                print "XML Error: & with no ;"
+                i += 1
+                continue
+
+            esc = string[i:semi]
+
+            if not esc:
+                print "No escape: %i:%i" % (i, semi)
+                i += 1
+                continue
+
+            if d.has_key(string[i:semi]):
+                out += d[esc]
+            else:
+                print "XML Error: No such escape: `%s'" % esc
+                
+            i += len(esc)
+
+    return out
+
+# The fields that the subject, sender and recipient strings come from
+HEADER_FIELDS = ["_auto_subject", "subject", "_auto_number",
+                 "_auto_sender", "sender",
+                 "_auto_recip", "recip", "recipient"]
+
+class _HeaderDone(Exception):
+    pass
+
+class FormHeader(object):
+    """The id, title and routing details of a form, and the fields its
+    subject, sender and recipient come from, with the same accessors
+    as FormFile for them"""
+    __slots__ = ["id", "title_text", "src", "dst", "mid", "path", "fields"]
+
+    def __init__(self):
+        self.id = None
+        self.title_text = None
+        self.src = ""
+        self.dst = ""
+        self.mid = ""
+        self.path = []
+        # id : value, or None if there is more than one such field
+        self.fields = {}
+
+    def get_path(self):
+        return self.path
+
+    def get_path_src(self):
+        return self.src
+
+    def get_path_dst(self):
+        return self.dst
+
+    def get_path_mid(self):
+        return self.mid
+
+    def get_field_value(self, id):
+        if id not in HEADER_FIELDS:
+            raise Exception("Field %s is not part of the header" % id)
+        elif self.fields.has_key(id) and self.fields[id] is None:
+            raise Exception("More than one id=%s node!" % id)
+        return self.fields.get(id, None)
+
+    def _try_get_fields(self, *names):
+        for field in names:
+            val = self.fields.get(field, None)
+            if val is not None:
+                return val
+        return "Unknown"
+
+    def get_subject_string(self):
+        subj = self._try_get_fields("_auto_subject", "subject")
+        if subj != "Unknown":
+            return subj.replace("\r", "").replace("\n", "")
+
+        return "%s#%s" % (self.get_path_src(),
+                          self._try_get_fields("_auto_number"))
+
+    def get_recipient_string(self):
+        dst = self.get_path_dst()
+        if dst:
+            return dst
+        else:
+            return self._try_get_fields("_auto_recip", "recip", "recipient")
+
+    def get_sender_string(self):
+        src = self.get_path_src()
+        if src:
+            return src
+        else:
+            return self._try_get_fields("_auto_sender", "sender")
+
+class FormHeaderParser(object):
+    """Picks the header out of a form as it streams past, and stops
+    reading once it has the path and a subject, or gets to the
+    attachments, whichever comes first"""
+
+    def __init__(self):
+        self.header = FormHeader()
+        self._stack = []
+        self._text = None
+        self._field = None
+        self._have_path = False
+
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.returns_unicode = False
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+
+    def _have_subject(self):
+        return "_auto_subject" in self.header.fields or \
+            "subject" in self.header.fields
+
+    def _start(self, name, attrs):
+        parent = self._stack and self._stack[-1] or None
+        self._stack.append(name)
+
+        if parent == "form":
+            if name == "field":
+                self._field = attrs.get("id", None)
+            elif name == "title":
+                self._text = []
+            elif name == "att":
+                # These only ever come at the end, and can be large
+                raise _HeaderDone()
+        elif name == "form" and parent == "xml":
+            self.header.id = attrs.get("id", None)
+        elif parent == "field" and name == "entry" and \
+                self._field in HEADER_FIELDS:
+            self._text = []
+        elif parent == "path" and len(self._stack) == 4:
+            self._text = []
+
+    def _end(self, name):
+        self._stack.pop()
+        parent = self._stack and self._stack[-1] or None
+
+        if self._text is None:
+            pass
+        elif parent == "form" and name == "title":
+            self.header.title_text = "".join(self._text).strip()
+            self._text = None
+        elif parent == "field" and name == "entry":
+            value = xml_unescape("".join(self._text).strip())
+            if self.header.fields.has_key(self._field):
+                value = None
+            self.header.fields[self._field] = value
+            self._text = None
+        elif parent == "path":
+            value = "".join(self._text).strip()
+            if name == "e":
+                self.header.path.append(value)
+            elif name in ["src", "dst", "mid"] and \
+                    not getattr(self.header, name):
+                setattr(self.header, name, value)
+            self._text = None
+
+        if parent == "form" and name == "path":
+            self._text = None
+            self._have_path = True
+        if parent == "form" and name == "field":
+            self._field = None
+        if self._have_path and self._have_subject():
+            raise _HeaderDone()
+
+    def _data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def feed(self, data):
+        """Parses some more of the form, returning True once it has seen
+        all it needs to"""
+        try:
+            self._parser.Parse(data, not data)
+        except _HeaderDone:
+            return True
+
+        return not data
+
+def read_header(filename, blocksize=4096):
+    """Returns the FormHeader of the form in filename"""
+    parser = FormHeaderParser()
+
+    f = file(filename)
+    try:
+        data = f.read(blocksize)
+        if not data:
+            raise Exception("Form file %s is empty!" % filename)
+        while not parser.feed(data):
+            data = f.read(blocksize)
+    finally:
+        f.close()
+
+    if parser.header.id is None:
+        raise Exception("No form in %s" % filename)
+
+    return parser.header
+
+def test_header():
+    import tempfile
+
+    form = """<?xml version="1.0"?>
+<xml>
+  <form id="memo">
+    <title>Memo</title>
+    <field id="_auto_subject">
+      <caption>Subject</caption>
+      <entry type="text">Net &amp;amp; shelter
+ status</entry>
+    </field>
+    <field id="_auto_sender">
+      <caption>From</caption>
+      <entry type="text">Sally</entry>
+    </field>
+    <field id="message">
+      <caption>Message</caption>
+      <entry type="multiline">Lots of words</entry>
+    </field>
+    <path>
+      <src>KK7DS</src>
+      <dst>KE7JSS</dst>
+      <mid>KK7DS.1.2</mid>
+      <e>KK7DS</e>
+      <e>W7ABC</e>
+    </path>
+    <att name="big">%s</att>
+  </form>
+</xml>
+""" % ("A" * 65536)
+
+    fd, fn = tempfile.mkstemp()
+    os.write(fd, form)
+    os.close(fd)
+    try:
+        header = read_header(fn, 512)
+    finally:
+        os.remove(fn)
+
+    assert header.id == "memo"
+    assert header.title_text == "Memo"
+    assert header.get_path() == ["KK7DS", "W7ABC"]
+    assert header.get_path_mid() == "KK7DS.1.2"
+    assert header.get_subject_string() == "Net & shelter status", \
+        header.get_subject_string()
+    assert header.get_sender_string() == "KK7DS"
+    assert header.get_recipient_string() == "KE7JSS"
+
+    # Without a subject, we read on to be sure
+    head = form[:form.index("<att")]
+    parser = FormHeaderParser()
+    assert not parser.feed(head.replace("_auto_subject", "x"))
+    parser = FormHeaderParser()
+    assert parser.feed(head)
+
+    parser = FormHeaderParser()
+    parser.feed(form.replace("_auto_sender", "_auto_subject"))
+    try:
+        parser.header.get_field_value("_auto_subject")
+        raise AssertionError("Duplicate field not noticed")
+    except Exception, e:
+        if isinstance(e, AssertionError):
+            raise
+    assert parser.header.get_subject_string() == "KK7DS#Unknown"
+
+if __name__ == "__main__":
+    test_header()
@@ -29,6 +29,7 @@ import re
 
 from d_rats import utils
 from d_rats import msgrouting
+from d_rats import msgindex
 from d_rats import emailgw
 
 def mkmsgid(callsign):
@@ -210,12 +211,15 @@ class DRATS_POP3Handler(POP3Handler):
             d = os.path.join(self.__config.form_store_dir(), "Outbox")
             allmsg = False
 
-        files = glob(os.path.join(d, "*.xml"))
+        index = msgindex.get_index(self.__config.form_store_dir())
+        for info in index.sync_folder(d):
+            f = info.filename
+            if not f.endswith(".xml"):
+                continue
+            elif not allmsg and info.dst != user.upper():
+                continue
 
-        for f in files:
             msg = msgrouting.form_to_email(self.__config, f)
-            if not allmsg and msg["To"] != user.upper():
-                continue
 
             name, addr = email.utils.parseaddr(msg["From"])
             if addr == "DO_NOT_REPLY@d-rats.com":
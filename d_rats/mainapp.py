@@ -54,12 +54,18 @@ import mapdisplay
 import map_sources
 import comm
 import sessionmgr
+import transport
+import congestion
+import contentstore
+import ddt2
 import session_coordinator
 import emailgw
 import formgui
+import formheader
 import station_status
 import pluginsrv
 import msgrouting
+import msgindex
 import wl2k
 import inputdialog
 import version
@@ -252,9 +258,23 @@ class MainApp(object):
             "msg_fn" : transport_msg,
             }
 
+        if self.config.getboolean("settings", "shared_io_thread"):
+            transport_args["loop"] = transport.get_shared_loop()
+
         if not self.sm.has_key(name):
             sm = sessionmgr.SessionManager(path, call, **transport_args)
 
+            if isinstance(path, comm.SocketDataPath):
+                window = self.config.getint("settings", "ddt_max_window_net")
+            else:
+                window = self.config.getint("settings", "ddt_max_window")
+            policy = self.config.get("settings", "ddt_congestion")
+            sm.set_path_profile(congestion.PathProfile(max_window=window,
+                                                       policy=policy))
+            sm.set_content_store(self.content_store)
+            sm.set_preset_dict(self.config.getboolean("settings",
+                                                      "ddt_compress_dict"))
+
             chat_session = sm.start_session("chat",
                                             dest="CQCQCQ",
                                             cls=chat.ChatSession)
@@ -506,11 +526,23 @@ class MainApp(object):
         proxy = self.config.get("settings", "http_proxy") or None
         mapdisplay.set_proxy(proxy)
 
+        ddt2.set_compress_level(self.config.getint("settings",
+                                                   "ddt_compress_level"))
+
+        self._refresh_content_store()
         self._refresh_comms()
         self._refresh_gps()
         self._refresh_mail_threads()
 
             
+    def _refresh_content_store(self):
+        size = self.config.getint("settings", "ddt_cache_size") << 20
+        if self.content_store:
+            self.content_store.set_max_size(size)
+        else:
+            path = platform.get_platform().config_file("cache")
+            self.content_store = contentstore.ContentStore(path, size)
+
     def _refresh_location(self):
         fix = self.get_position()
 
@@ -596,6 +628,9 @@ class MainApp(object):
     def __user_send_form(self, object, station, port, fname, sname):
         self.sc(port).send_form(station, fname, sname)
 
+    def __user_send_forms(self, object, station, port, fnames, sname):
+        self.sc(port).send_forms(station, fnames, sname)
+
     def __user_send_file(self, object, station, port, fname, sname):
         self.sc(port).send_file(station, fname, sname)
 
@@ -633,6 +668,9 @@ class MainApp(object):
     def __get_message_list(self, object, station):
         return self.mainwindow.tabs["messages"].get_shared_messages(station)
 
+    def __get_transfer_queue(self, object, port):
+        return self.sc(port).get_transfer_queue()
+
     def __submit_rpc_job(self, object, job, port):
         self.rpc_session(port).submit(job)
 
@@ -758,6 +796,13 @@ class MainApp(object):
     def __session_status_update(self, object, id, msg, port):
         self.__session_started(object, id, msg, port)
 
+    def __transfer_queue_update(self, object, id, msg, final, port):
+        event = main_events.FileEvent("xfer_%i_%s" % (id, port),
+                                      "[%s] %s" % (port, msg))
+        if final:
+            event.set_as_final()
+        self.mainwindow.tabs["event"].event(event)
+
     def __session_ended(self, object, id, msg, restart_info, port):
         # Don't register Control, Chat, RPC, Sniff
         if id <= 4:
@@ -778,7 +823,7 @@ class MainApp(object):
             id = "%s_%s" % (id, port)
 
         print "[NEWFORM %s]: %s" % (id, fn)
-        f = formgui.FormFile(fn)
+        f = formheader.read_header(fn)
 
         msg = '%s "%s" %s %s' % (_("Message"),
                                  f.get_subject_string(),
@@ -898,6 +943,7 @@ class MainApp(object):
             "user-stop-session" : self.__user_stop_session,
             "user-cancel-session" : self.__user_cancel_session,
             "user-send-form" : self.__user_send_form,
+            "user-send-forms" : self.__user_send_forms,
             "user-send-file" : self.__user_send_file,
             "rpc-send-form" : self.__user_send_form,
             "rpc-send-file" : self.__user_send_file,
@@ -906,6 +952,7 @@ class MainApp(object):
             "outgoing-chat-message" : self.__outgoing_chat_message,
             "get-station-list" : self.__get_station_list,
             "get-message-list" : self.__get_message_list,
+            "get-transfer-queue" : self.__get_transfer_queue,
             "submit-rpc-job" : self.__submit_rpc_job,
             "event" : self.__event,
             "notice" : False,
@@ -926,6 +973,7 @@ class MainApp(object):
             "form-received" : self.__form_received,
             "file-sent" : self.__file_sent,
             "form-sent" : self.__form_sent,
+            "transfer-queue-update" : self.__transfer_queue_update,
             "get-chat-port" : self.__get_chat_port,
             "trigger-msg-router" : self.__trigger_msg_router,
             "register-object" : self.__register_object,
@@ -942,6 +990,7 @@ class MainApp(object):
         self.__unused_pipes = {}
         self.__pipes = {}
         self.pop3srv = None
+        self.content_store = None
 
         self.config = config.DratsConfig(self)
         self._refresh_lang()
@@ -1033,6 +1082,7 @@ class MainApp(object):
         for lock in glob.glob(path):
             print "Removing stale message lock %s" % lock
             os.remove(lock)        
+        msgindex.get_index(self.config.form_store_dir()).clear_locks()
 
     def main(self):
         # Copy default forms before we start
@@ -0,0 +1,613 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+from ConfigParser import ConfigParser
+
+import formheader
+
+try:
+    import sqlite3
+except ImportError:
+    # Python 2.4
+    from pysqlite2 import dbapi2 as sqlite3
+
+INDEX_FILE = ".msgindex.sqlite"
+
+# Bump this when the table changes, and old indexes will be rebuilt
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE messages (
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    src TEXT,
+    dst TEXT,
+    mid TEXT,
+    path TEXT,
+    subject TEXT,
+    type TEXT,
+    sender TEXT,
+    recip TEXT,
+    mtime REAL,
+    read INTEGER NOT NULL DEFAULT 0,
+    locked INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (folder, name)
+);
+CREATE INDEX messages_dst ON messages (folder, dst);
+"""
+
+# The columns that come from the form itself, as opposed to the ones
+# that record what we've done with it
+FORM_COLUMNS = ["src", "dst", "mid", "path", "subject", "type",
+                "sender", "recip"]
+COLUMNS = ["folder", "name"] + FORM_COLUMNS + ["mtime", "read", "locked"]
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+def lockfile_for(fn):
+    """Returns the name of the file that marks fn as in use"""
+    return os.path.join(os.path.dirname(fn), ".lock.%s" % os.path.basename(fn))
+
+class MessageInfo(object):
+    """What the index knows about one message"""
+    __slots__ = ["filename"] + COLUMNS
+
+    def __init__(self, filename=None, **kwargs):
+        self.filename = filename
+        for name in COLUMNS:
+            setattr(self, name, kwargs.get(name, None))
+
+    def __repr__(self):
+        return "<MessageInfo %s %s->%s `%s'>" % (self.filename,
+                                                 self.src, self.dst,
+                                                 self.subject)
+
+def read_message(filename):
+    """Reads the routing and display details of a message from its form"""
+    return info_from_form(formheader.read_header(filename))
+
+def info_from_form(form):
+    return MessageInfo(src=form.get_path_src(),
+                       dst=form.get_path_dst(),
+                       mid=form.get_path_mid(),
+                       path=form.get_path(),
+                       subject=form.get_subject_string(),
+                       type=form.id,
+                       sender=form.get_sender_string(),
+                       recip=form.get_recipient_string())
+
+class MessageIndex(object):
+    """An index of the messages in every folder under a message store,
+    kept in a database at its root so that the router and the message
+    list don't have to parse every form to find out where it is going
+    or what it is called.  The folders are the real thing: anything
+    that changes them tells the index, and sync_folder() catches up
+    with whatever didn't by looking at the file times."""
+
+    def __init__(self, root, reader=read_message):
+        self.root = os.path.abspath(root)
+        self.filename = os.path.join(self.root, INDEX_FILE)
+        self._reader = reader
+        self._lock = threading.RLock()
+        self._db = None
+
+        try:
+            self._open(self.filename)
+        except sqlite3.DatabaseError, e:
+            print "Message index %s is damaged (%s), starting over" % (\
+                self.filename, e)
+            # connect() itself may be what failed
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+            try:
+                os.remove(self.filename)
+            except OSError:
+                # Nothing we can start over from; report what was wrong
+                raise e
+            self._open(self.filename)
+
+    def _open(self, filename):
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.text_factory = str
+        # It can always be rebuilt from the folders, so don't wait for
+        # the disk on every change
+        self._db.execute("PRAGMA synchronous = OFF")
+
+        version, = self._db.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            self._db.execute("DROP TABLE IF EXISTS messages")
+            self._db.executescript(SCHEMA)
+            self._db.execute("PRAGMA user_version = %i" % SCHEMA_VERSION)
+            self._db.commit()
+            self.rebuild()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
+
+    def _split(self, filename):
+        """Returns the (folder, name) of filename in the index, or None
+        if it isn't in our message store"""
+        filename = os.path.abspath(filename)
+        if not filename.startswith(self.root + os.sep):
+            return None
+
+        folder, name = os.path.split(filename[len(self.root) + 1:])
+        if not folder:
+            return None
+
+        return folder, name
+
+    def _info(self, row):
+        info = MessageInfo(os.path.join(self.root, row[0], row[1]))
+        for name, value in zip(COLUMNS, row):
+            setattr(info, name, value)
+        info.path = info.path and info.path.split(";") or []
+        info.read = bool(info.read)
+        info.locked = bool(info.locked)
+
+        return info
+
+    def _select(self, where, args):
+        sql = "SELECT %s FROM messages WHERE %s" % (", ".join(COLUMNS), where)
+        return [self._info(row) for row in self._db.execute(sql, args)]
+
+    def _read(self, filename):
+        try:
+            mtime = os.stat(filename).st_mtime
+            info = self._reader(filename)
+        except Exception, e:
+            # Most likely still being written; try again next time
+            print "Unable to index message %s: %s" % (filename, e)
+            mtime = None
+            info = MessageInfo()
+        info.mtime = mtime
+
+        return info
+
+    def _store(self, folder, name, info, read=None):
+        """Records the form details in info, keeping what we knew about
+        whether it has been read"""
+        values = [getattr(info, col) for col in FORM_COLUMNS]
+        values[FORM_COLUMNS.index("path")] = ";".join(info.path or [])
+        values.append(info.mtime)
+        locked = os.path.exists(lockfile_for(os.path.join(self.root,
+                                                           folder, name)))
+
+        sets = ", ".join(["%s = ?" % col for col in FORM_COLUMNS])
+        cur = self._db.execute("UPDATE messages SET %s, mtime = ?, " \
+                                   "locked = ? " \
+                                   "WHERE folder = ? AND name = ?" % sets,
+                               values + [locked, folder, name])
+        if cur.rowcount == 0:
+            self._db.execute("INSERT INTO messages (%s) " \
+                                 "VALUES (%s)" % (\
+                    ", ".join(COLUMNS), ", ".join(["?"] * len(COLUMNS))),
+                             [folder, name] + values + [bool(read), locked])
+
+    def _legacy_read_flags(self, folder):
+        """The read flags kept by older versions in each folder"""
+        flags = {}
+        regpath = os.path.join(self.root, folder, ".db")
+        if not os.path.exists(regpath):
+            return flags
+
+        try:
+            reg = ConfigParser()
+            reg.read(regpath)
+            for name in reg.sections():
+                if reg.has_option(name, "read"):
+                    flags[name] = reg.get(name, "read") == "True"
+        except Exception, e:
+            print "Unable to read old folder registry %s: %s" % (regpath, e)
+
+        return flags
+
+    def _folders(self):
+        folders = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # Hidden ones (like where batches are unpacked) aren't folders
+            dirnames[:] = sorted([d for d in dirnames
+                                  if not d.startswith(".")])
+            if dirpath != self.root:
+                folders.append(dirpath[len(self.root) + 1:])
+
+        return folders
+
+    def _sync(self, folder, flags=None):
+        path = os.path.join(self.root, folder)
+        on_disk = {}
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                fn = os.path.join(path, name)
+                if name.startswith(".") or not os.path.isfile(fn):
+                    continue
+                on_disk[name] = os.stat(fn).st_mtime
+
+        known = {}
+        for name, mtime in self._db.execute("SELECT name, mtime " \
+                                                "FROM messages " \
+                                                "WHERE folder = ?", (folder,)):
+            known[name] = mtime
+
+        gone = [(folder, name) for name in known if name not in on_disk]
+        self._db.executemany("DELETE FROM messages " \
+                                 "WHERE folder = ? AND name = ?", gone)
+
+        if flags is None:
+            flags = {}
+        legacy = None
+        for name, mtime in on_disk.items():
+            if known.get(name, None) == mtime:
+                continue
+            read = flags.get((folder, name), None)
+            if name not in known and read is None:
+                if legacy is None:
+                    legacy = self._legacy_read_flags(folder)
+                read = legacy.get(name, None)
+            info = self._read(os.path.join(path, name))
+            self._store(folder, name, info, read)
+
+    def rebuild(self):
+        """Reads every message in the store again, keeping only which
+        ones have been read"""
+        self._lock.acquire()
+        try:
+            flags = {}
+            for folder, name, read in self._db.execute("SELECT folder, " \
+                                                           "name, read " \
+                                                           "FROM messages"):
+                flags[(folder, name)] = bool(read)
+            self._db.execute("DELETE FROM messages")
+            for folder in self._folders():
+                self._sync(folder, flags)
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def sync_folder(self, folder):
+        """Brings the index up to date with what is in folder (a path
+        relative to the store, or an absolute one), reading only the
+        messages that are new or have changed.  Returns a MessageInfo
+        for each of them"""
+        folder = os.path.join(self.root, folder)[len(self.root) + 1:]
+
+        self._lock.acquire()
+        try:
+            self._sync(folder)
+            self._db.commit()
+            return self._select("folder = ? ORDER BY name", (folder,))
+        finally:
+            self._lock.release()
+
+    def get(self, filename):
+        """Returns the MessageInfo for filename, reading it first if it
+        is new to us, or None if it isn't a message in the store"""
+        key = self._split(filename)
+        if not key:
+            return None
+
+        self._lock.acquire()
+        try:
+            infos = self._select("folder = ? AND name = ?", key)
+            if not infos and os.path.isfile(filename):
+                self._store(key[0], key[1], self._read(filename))
+                self._db.commit()
+                infos = self._select("folder = ? AND name = ?", key)
+        finally:
+            self._lock.release()
+
+        return infos and infos[0] or None
+
+    def query(self, folder, dst=None):
+        """Returns the messages in folder, or just the ones for dst"""
+        folder = os.path.join(self.root, folder)[len(self.root) + 1:]
+
+        self._lock.acquire()
+        try:
+            if dst is None:
+                return self._select("folder = ? ORDER BY name", (folder,))
+            else:
+                return self._select("folder = ? AND dst = ? ORDER BY name",
+                                    (folder, dst))
+        finally:
+            self._lock.release()
+
+    def find(self, mid):
+        """Returns the messages in any folder with this message id"""
+        self._lock.acquire()
+        try:
+            return self._select("mid = ? ORDER BY folder, name", (mid,))
+        finally:
+            self._lock.release()
+
+    def update(self, filename, info=None):
+        """Records a new or changed message, reading it unless info
+        already has what it says"""
+        key = self._split(filename)
+        if not key:
+            return
+
+        if info is None:
+            info = self._read(filename)
+        else:
+            try:
+                info.mtime = os.stat(filename).st_mtime
+            except OSError:
+                return
+
+        self._lock.acquire()
+        try:
+            self._store(key[0], key[1], info)
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def set_fields(self, filename, **fields):
+        """Changes what we know about a message, such as its subject or
+        whether it has been read"""
+        if not self.get(filename):
+            return
+        folder, name = self._split(filename)
+
+        for col in fields.keys():
+            if col not in COLUMNS[2:]:
+                raise Exception("No such message field `%s'" % col)
+
+        self._lock.acquire()
+        try:
+            self._db.execute("UPDATE messages SET %s " \
+                                 "WHERE folder = ? AND name = ?" % \
+                                 ", ".join(["%s = ?" % col
+                                            for col in fields.keys()]),
+                             fields.values() + [folder, name])
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def set_locked(self, filename, locked):
+        key = self._split(filename)
+        if not key:
+            return
+
+        self._lock.acquire()
+        try:
+            self._db.execute("UPDATE messages SET locked = ? " \
+                                 "WHERE folder = ? AND name = ?",
+                             (bool(locked),) + key)
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def clear_locks(self):
+        self._lock.acquire()
+        try:
+            self._db.execute("UPDATE messages SET locked = 0")
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def remove(self, filename):
+        key = self._split(filename)
+        if not key:
+            return
+
+        self._lock.acquire()
+        try:
+            self._db.execute("DELETE FROM messages " \
+                                 "WHERE folder = ? AND name = ?", key)
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def move(self, old, new):
+        """Records that a message has moved from old to new, taking
+        what we knew about it along"""
+        okey = self._split(old)
+        nkey = self._split(new)
+        if not nkey:
+            self.remove(old)
+            return
+        elif not okey:
+            self.update(new)
+            return
+
+        self._lock.acquire()
+        try:
+            self._db.execute("DELETE FROM messages " \
+                                 "WHERE folder = ? AND name = ?", nkey)
+            self._db.execute("UPDATE messages SET folder = ?, name = ? " \
+                                 "WHERE folder = ? AND name = ?", nkey + okey)
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def move_folder(self, old, new):
+        """Records that a folder (and its subfolders) has been renamed"""
+        old = os.path.join(self.root, old)[len(self.root) + 1:]
+        new = os.path.join(self.root, new)[len(self.root) + 1:]
+
+        self._lock.acquire()
+        try:
+            self._db.execute("UPDATE messages " \
+                                 "SET folder = ? || substr(folder, ?) " \
+                                 "WHERE folder = ? OR " \
+                                 "substr(folder, 1, ?) = ?",
+                             (new, len(old) + 1, old,
+                              len(old) + 1, old + os.sep))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+def get_index(root):
+    """Returns the index of the message store at root, opening it (and
+    building it, if need be) the first time"""
+    root = os.path.abspath(root)
+
+    _INDEXES_LOCK.acquire()
+    try:
+        if root not in _INDEXES:
+            _INDEXES[root] = MessageIndex(root)
+        return _INDEXES[root]
+    finally:
+        _INDEXES_LOCK.release()
+
+def find_index(filename):
+    """Returns the open index that covers filename, or None"""
+    filename = os.path.abspath(filename)
+    for root, index in _INDEXES.items():
+        if filename.startswith(root + os.sep):
+            return index
+
+    return None
+
+def message_saved(filename, form=None):
+    """Tells the index covering filename that it has been written, by
+    someone who may have the form at hand already"""
+    index = find_index(filename)
+    if index:
+        index.update(filename, form and info_from_form(form))
+
+def message_moved(old, new):
+    index = find_index(new) or find_index(old)
+    if index:
+        index.move(old, new)
+
+def message_removed(filename):
+    index = find_index(filename)
+    if index:
+        index.remove(filename)
+
+def message_locked(filename, locked):
+    index = find_index(filename)
+    if index:
+        index.set_locked(filename, locked)
+
+def test_index():
+    import tempfile
+    import shutil
+
+    def reader(filename):
+        src, dst, subject = file(filename).read().split(",")
+        return MessageInfo(src=src, dst=dst, mid=None, path=[src],
+                           subject=subject, type="email",
+                           sender=src, recip=dst)
+
+    def write(folder, name, src, dst, subject):
+        fn = os.path.join(tmp, folder, name)
+        f = file(fn, "w")
+        f.write("%s,%s,%s" % (src, dst, subject))
+        f.close()
+        return fn
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for folder in ["Inbox", "Outbox", "Sent"]:
+            os.mkdir(os.path.join(tmp, folder))
+
+        a = write("Outbox", "a.xml", "KK7DS", "KE7JSS", "Hello")
+        b = write("Outbox", "b.xml", "KK7DS", "W7ABC", "Status")
+        c = write("Inbox", "c.xml", "W7ABC", "KK7DS", "Re: Status")
+        reg = ConfigParser()
+        reg.add_section("c.xml")
+        reg.set("c.xml", "read", "True")
+        reg.write(file(os.path.join(tmp, "Inbox", ".db"), "w"))
+
+        index = MessageIndex(tmp, reader)
+        outbox = index.sync_folder("Outbox")
+        assert [i.dst for i in outbox] == ["KE7JSS", "W7ABC"]
+        assert index.get(c).read, "Old read flag was lost"
+        assert not index.get(a).read
+        assert [i.filename for i in index.query("Outbox", "W7ABC")] == [b]
+
+        # Moves keep the read flag and don't read the message again
+        index.set_fields(a, read=True)
+        newfn = os.path.join(tmp, "Sent", "a.xml")
+        shutil.move(a, newfn)
+        index.move(a, newfn)
+        assert [i.filename for i in index.query("Outbox")] == [b]
+        assert index.get(newfn).read
+
+        # Changes made behind our back are caught by a sync
+        os.remove(b)
+        d = write("Outbox", "d.xml", "KK7DS", "N7XYZ", "New")
+        assert [i.filename for i in index.sync_folder("Outbox")] == [d]
+
+        file(lockfile_for(d), "w").close()
+        index.update(d)
+        assert index.get(d).locked
+        index.clear_locks()
+        assert not index.get(d).locked
+
+        index.set_fields(d, mid="1f2e3d4c")
+        assert [i.filename for i in index.find("1f2e3d4c")] == [d]
+        assert not index.find("nosuchmid")
+        index.close()
+
+        # It survives being opened again, and can be rebuilt from scratch
+        index = MessageIndex(tmp, reader)
+        assert index.get(newfn).read
+        index.rebuild()
+        assert index.get(newfn).read, "Rebuild lost the read flag"
+        assert len(index.sync_folder("Inbox")) == 1
+
+        os.rename(os.path.join(tmp, "Sent"), os.path.join(tmp, "Old"))
+        index.move_folder("Sent", "Old")
+        assert index.get(os.path.join(tmp, "Old", "a.xml")).read
+        index.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_damaged():
+    import tempfile
+    import shutil
+
+    tmp = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmp, "Inbox"))
+        fn = os.path.join(tmp, "Inbox", "a.xml")
+        file(fn, "w").write("KK7DS,KE7JSS,Hello")
+
+        # A corrupt index is thrown away and rebuilt
+        file(os.path.join(tmp, INDEX_FILE), "w").write("\xff" * 4096)
+        index = MessageIndex(tmp, lambda f: MessageInfo(subject="Hello"))
+        assert len(index.sync_folder("Inbox")) == 1
+        index.close()
+
+        # One that can't be opened at all reports why
+        os.remove(os.path.join(tmp, INDEX_FILE))
+        os.mkdir(os.path.join(tmp, INDEX_FILE))
+        try:
+            MessageIndex(tmp)
+            assert False, "Opened an index that is a directory"
+        except sqlite3.DatabaseError:
+            pass
+    finally:
+        shutil.rmtree(tmp)
+
+    print "Damaged index OK"
+
+if __name__ == "__main__":
+    test_index()
+    test_damaged()
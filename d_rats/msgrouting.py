@@ -37,6 +37,7 @@ except ImportError:
 import gobject
 
 import formgui
+import msgindex
 import signals
 import emailgw
 import utils
@@ -46,12 +47,21 @@ import traceback
 
 CALL_TIMEOUT_RETRY = 300
 
+# The most we send a station in one batch.  The forms in a batch get
+# there (or don't) together, so this bounds how much one bad transfer
+# holds up
+BATCH_MAX_FORMS = 20
+BATCH_MAX_SIZE = 64 << 10
+
+# How long to trust a routing decision that nothing has invalidated,
+# in case it depended on something we don't watch (like the email
+# access list)
+ROUTE_CACHE_TIME = 300
+
 MSG_LOCK_LOCK = threading.Lock()
 
 def __msg_lockfile(fn):
-    name = os.path.basename(fn)
-    path = os.path.dirname(fn)
-    return os.path.join(path, ".lock.%s" % name)
+    return msgindex.lockfile_for(fn)
 
 def msg_is_locked(fn):
     return os.path.exists(__msg_lockfile(fn))
@@ -62,6 +72,7 @@ def msg_lock(fn):
         lf = file(__msg_lockfile(fn), "w")
         traceback.print_stack(file=lf)
         lf.close()
+        msgindex.message_locked(fn, True)
         success = True
     else:
         lf = file(__msg_lockfile(fn), "r")
@@ -78,6 +89,7 @@ def msg_unlock(fn):
     MSG_LOCK_LOCK.acquire()
     try:
         os.remove(__msg_lockfile(fn))
+        msgindex.message_locked(fn, False)
     except OSError:
         utils.log_exception()
         success = False
@@ -188,6 +200,7 @@ def move_to_folder(config, msg, folder):
                          os.path.basename(msg))
     msg_lock(newfn)
     shutil.move(msg, newfn)
+    msgindex.message_moved(msg, newfn)
     msg_unlock(newfn)
 
 def move_to_outgoing(config, msg):
@@ -197,10 +210,64 @@ class MessageRoute(object):
     def __init__(self, line):
         self.dest, self.gw, self.port = line.split()
 
+class RouteCache(object):
+    """Remembers the next hop chosen for a message, along with the
+    stations that the choice depended on, until one of them changes
+    (is heard, fails, gets pinged) or the choice expires"""
+
+    MISS = object()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._users = {}
+        self._version = 0
+
+    def version(self):
+        return self._version
+
+    def get(self, key, now):
+        self._lock.acquire()
+        try:
+            route, deps, expires = self._routes.get(key, (None, [], 0))
+            if expires > now:
+                return route
+            return self.MISS
+        finally:
+            self._lock.release()
+
+    def put(self, key, route, deps, expires, version):
+        """Records a decision, unless something was invalidated since
+        @version, when it was started"""
+        self._lock.acquire()
+        try:
+            if version != self._version:
+                return
+            self._routes[key] = (route, deps, expires)
+            for call in deps:
+                self._users.setdefault(call, set()).add(key)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, call=None):
+        """Forgets the decisions that depended on @call, or all of them"""
+        self._lock.acquire()
+        try:
+            self._version += 1
+            if call is None:
+                self._routes = {}
+                self._users = {}
+                return
+            for key in self._users.pop(call, []):
+                self._routes.pop(key, None)
+        finally:
+            self._lock.release()
+
 class MessageRouter(gobject.GObject):
     __gsignals__ = {
         "get-station-list" : signals.GET_STATION_LIST,
         "user-send-form" : signals.USER_SEND_FORM,
+        "user-send-forms" : signals.USER_SEND_FORMS,
         "form-sent" : signals.FORM_SENT,
         "form-received" : signals.FORM_RECEIVED,
         "ping-station" : signals.PING_STATION,
@@ -227,20 +294,42 @@ class MessageRouter(gobject.GObject):
         self.__sent_call = {}
         self.__sent_port = {}
         self.__file_to_call = {}
+        self.__call_files = {}
+        self.__call_ok = {}
         self.__failed_stations = {}
         self.__pinged_stations = {}
 
+        self.__routes = {}
+        self.__routes_mtime = -1
+        self.__heard = {}
+        self.__route_cache = RouteCache()
+        self.__stats = {"passes" : 0,
+                        "duration" : 0.0,
+                        "messages" : 0,
+                        "destinations" : 0,
+                        "resolved" : 0,
+                        "cached" : 0,
+                        }
+
         self.__thread = None
         self.__enabled = False
 
     def _get_routes(self):
         rf = self.__config.platform.config_file("routes.txt")
+        try:
+            mtime = os.stat(rf).st_mtime
+        except OSError:
+            mtime = None
+
+        if mtime == self.__routes_mtime:
+            return self.__routes
+
         try:
             f = file(rf)
             lines = f.readlines()
             f.close()
         except IOError:
-            return {}
+            lines = []
 
         routes = {}
 
@@ -253,8 +342,32 @@ class MessageRouter(gobject.GObject):
             except Exception, e:
                 print "Error parsing line '%s': %s" % (line, e)
 
+        self._p("Loaded %i static routes" % len(routes))
+        self.__routes = routes
+        self.__routes_mtime = mtime
+        self.__route_cache.invalidate()
+
         return routes
 
+    def _update_heard(self, slist):
+        """Forgets the routing decisions that depended on stations that
+        have been heard (or lost, or moved port) since the last pass"""
+        heard = {}
+        for call, station in slist.items():
+            heard[call] = (station.get_heard(), station.get_port())
+
+        for call in set(heard.keys() + self.__heard.keys()):
+            if heard.get(call, None) != self.__heard.get(call, None):
+                self.__route_cache.invalidate(call)
+
+        self.__heard = heard
+
+    def get_stats(self):
+        """Returns the number of routing passes, and the duration,
+        messages, destinations, decisions made and decisions remembered
+        in the last one"""
+        return dict(self.__stats)
+
     def _sleep(self):
         t = self.__config.getint("settings", "msg_flush")
         time.sleep(t)
@@ -267,32 +380,36 @@ class MessageRouter(gobject.GObject):
     def _get_queue(self):
         queue = {}
 
-        qd = os.path.join(self.__config.form_store_dir(), "Outbox")
-        fl = glob(os.path.join(qd, "*.xml"))
-        for f in fl:
-            if not msg_lock(f):
+        index = msgindex.get_index(self.__config.form_store_dir())
+        for info in index.sync_folder("Outbox"):
+            f = info.filename
+            call = info.dst
+            if not call or not f.endswith(".xml"):
+                continue
+            elif not msg_lock(f):
                 print "Message %s is locked, skipping" % f
                 continue
 
-            form = formgui.FormFile(f)
-            call = form.get_path_dst()
-            del form
-
-            if not call:
-                msg_unlock(f)
-                continue
-            elif not queue.has_key(call):
+            if not queue.has_key(call):
                 queue[call] = [f]
             else:
                 queue[call].append(f)
         
         return queue
 
-    def _send_form(self, call, port, filename):
+    def _send_forms(self, call, port, filenames):
         self.__sent_call[call] = time.time()
         self.__sent_port[port] = time.time()
-        self.__file_to_call[filename] = call
-        self._emit("user-send-form", call, port, filename, "Foo")
+        self.__call_files[call] = list(filenames)
+        self.__call_ok[call] = False
+        for filename in filenames:
+            self.__file_to_call[filename] = call
+
+        if len(filenames) == 1:
+            self._emit("user-send-form", call, port, filenames[0], "Foo")
+        else:
+            self._emit("user-send-forms", call, port, filenames,
+                       "%i forms" % len(filenames))
 
     def _sent_recently(self, call):
         if self.__sent_call.has_key(call):
@@ -302,7 +419,7 @@ class MessageRouter(gobject.GObject):
     def _port_free(self, port):
         return not self.__sent_port.has_key(port)
 
-    def _route_msg(self, src, dst, path, slist, routes):
+    def _route_msg(self, src, dst, path, slist, routes, deps=None):
         invalid = []
 
         def old(call):
@@ -359,6 +476,9 @@ class MessageRouter(gobject.GObject):
             else:
                 break # We have a route to try
 
+        if deps is not None:
+            deps += [x for x in [dst, route] + invalid if x]
+
         if not route:
             self._p("No route for station %s" % dst)
         elif old(route) and "@" not in route and ":" not in route:
@@ -376,6 +496,33 @@ class MessageRouter(gobject.GObject):
 
         return route
 
+    def _resolve(self, src, dst, path, slist, routes):
+        """Returns the next hop for a message, working it out only if
+        we haven't already since anything it depends on changed"""
+        key = (src, dst, tuple(path))
+        now = time.time()
+
+        route = self.__route_cache.get(key, now)
+        if route is not RouteCache.MISS:
+            self.__stats["cached"] += 1
+            return route
+
+        version = self.__route_cache.version()
+        deps = []
+        route = self._route_msg(src, dst, path, slist, routes, deps)
+        self.__stats["resolved"] += 1
+
+        ttl = self.__config.getint("settings", "station_msg_ttl")
+        expires = now + ROUTE_CACHE_TIME
+        for call in deps:
+            station = slist.get(call, None)
+            if station and (station.get_heard() + ttl) > now:
+                # The choice changes when this one goes stale
+                expires = min(expires, station.get_heard() + ttl)
+        self.__route_cache.put(key, route, deps, expires, version)
+
+        return route
+
     def _form_to_wl2k_em(self, dst, msgfn):
         form = formgui.FormFile(msgfn)
 
@@ -427,21 +574,40 @@ class MessageRouter(gobject.GObject):
 
         return True
 
-    def _route_via_station(self, call, route, slist, msg):
+    def _make_batch(self, msgs):
+        """Returns as many of msgs (at least one) as fit in a batch"""
+        batch = []
+        size = 0
+        for msg in msgs[:BATCH_MAX_FORMS]:
+            try:
+                size += os.path.getsize(msg)
+            except OSError:
+                continue
+            if batch and size > BATCH_MAX_SIZE:
+                break
+            batch.append(msg)
+
+        return batch
+
+    def _route_via_station(self, route, slist, msgs):
+        """Sends a batch of msgs, which are all going via route.
+        Returns the ones that were sent"""
         if self._sent_recently(route):
             self._p("Call %s is busy" % route)
-            return False
+            return []
 
         print slist
         port = slist[route].get_port()
         if not self._port_free(port):
             self._p("I think port %s is busy" % port)
-            return False # likely already a transfer going here so skip it
+            return [] # likely already a transfer going here so skip it
 
-        self._p("Sending %s to %s (via %s)" % (msg, call, route))
-        self._send_form(route, port, msg)
+        batch = self._make_batch(msgs)
+        if batch:
+            self._p("Sending %s via %s" % (", ".join(batch), route))
+            self._send_forms(route, port, batch)
 
-        return True
+        return batch
 
     def _route_via_wl2k(self, src, dst, msgfn):
         foo, addr = dst.split(":")
@@ -462,16 +628,21 @@ class MessageRouter(gobject.GObject):
 
         return True
 
-    def _route_message(self, msg, slist, routes):
-        form = formgui.FormFile(msg)
-        path = form.get_path()
+    def _route_message(self, msg, slist, routes, decided=None, batches=None):
+        info = msgindex.get_index(self.__config.form_store_dir()).get(msg)
+        path = info.path
         emok = path[-2:] != ["EMAIL", self.__config.get("user", "callsign")]
-        src = form.get_path_src()
-        dst = form.get_path_dst()
-        del form
+        src = info.src
+        dst = info.dst
+
+        if decided is None:
+            decided = {}
+        key = (src, dst, tuple(path))
+        if not decided.has_key(key):
+            decided[key] = self._resolve(src, dst, path, slist, routes)
 
         routed = False
-        route = self._route_msg(src, dst, path, slist, routes)
+        route = decided[key]
 
         if not route:
             pass
@@ -484,11 +655,20 @@ class MessageRouter(gobject.GObject):
             if emok:
                 routed = self._route_via_email(dst, msg)
         else:
-            routed = self._route_via_station(dst, route, slist, msg)
+            # Sent along with everything else going the same way once
+            # we have looked at the whole queue
+            if batches is None:
+                routed = bool(self._route_via_station(route, slist, [msg]))
+            else:
+                batches.setdefault(route, []).append(msg)
+                routed = True
 
         return routed
 
     def _run_one(self, queue):
+        start = time.time()
+        self.__stats["resolved"] = self.__stats["cached"] = 0
+
         plist = self.emit("get-station-list")
         slist = {}
 
@@ -498,17 +678,50 @@ class MessageRouter(gobject.GObject):
             for station in stations:
                 slist[str(station)] = station
 
+        self._update_heard(slist)
+
+        # Messages going the same way (most of a destination's queue)
+        # share one decision
+        decided = {}
+        batches = {}
+        count = 0
+
         for dst, callq in queue.items():
             for msg in callq:
+                count += 1
 
                 try:
-                    routed = self._route_message(msg, slist, routes)
+                    routed = self._route_message(msg, slist, routes,
+                                                 decided, batches)
                 except Exception:
                     utils.log_exception()
                     routed = False
     
                 if not routed:
                     msg_unlock(msg)
+
+        # Everything for one next hop goes in one transfer, rather than
+        # one message to it per pass
+        for route, msgs in batches.items():
+            try:
+                sent = self._route_via_station(route, slist, msgs)
+            except Exception:
+                utils.log_exception()
+                sent = []
+
+            for msg in msgs:
+                if msg not in sent:
+                    msg_unlock(msg)
+
+        self.__stats["passes"] += 1
+        self.__stats["duration"] = time.time() - start
+        self.__stats["messages"] = count
+        self.__stats["destinations"] = len(queue)
+        self._p("Routing pass: %i messages for %i destinations " \
+                    "(%i decided, %i remembered) in %.1f ms" % (\
+                count, len(queue),
+                self.__stats["resolved"], self.__stats["cached"],
+                self.__stats["duration"] * 1000))
     
     def _run(self):
         while self.__enabled:
@@ -554,10 +767,13 @@ class MessageRouter(gobject.GObject):
         form.save_to(fn)
 
     def _station_succeeded(self, call):
+        if self.__failed_stations.get(call, 0):
+            self.__route_cache.invalidate(call)
         self.__failed_stations[call] = 0
 
     def _station_failed(self, call):
         self.__failed_stations[call] = self.__failed_stations.get(call, 0) + 1
+        self.__route_cache.invalidate(call)
         print "Fail count for %s is %i" % (call, self.__failed_stations[call])
 
     def _is_station_failed(self, call):
@@ -565,9 +781,12 @@ class MessageRouter(gobject.GObject):
 
     def _station_pinged_incr(self, call):
         self.__pinged_stations[call] = self.__pinged_stations.get(call, 0) + 1
+        self.__route_cache.invalidate(call)
         return self.__pinged_stations[call]
 
     def _station_pinged_clear(self, call):
+        if self.__pinged_stations.get(call, 0):
+            self.__route_cache.invalidate(call)
         self.__pinged_stations[call] = 0
 
     def _station_pinged_out(self, call):
@@ -579,19 +798,28 @@ class MessageRouter(gobject.GObject):
         if fn and msg_is_locked(fn):
             msg_unlock(fn)
 
-        call = self.__file_to_call.get(fn, None)
+        call = self.__file_to_call.pop(fn, None)
+        pending = self.__call_files.get(call, [])
+        if fn in pending:
+            pending.remove(fn)
+
         if call and self.__sent_call.has_key(call):
-            # This callsign completed (or failed) a transfer
-            if failed:
-                self._station_failed(call)
-            else:
-                self._station_succeeded(call)
+            if not failed:
                 self._update_path(fn, call)
+                self.__call_ok[call] = True
+
+            if not pending:
+                # This callsign completed (or failed) a transfer, which
+                # counts once however many messages were in it
+                if self.__call_ok.pop(call, False):
+                    self._station_succeeded(call)
+                else:
+                    self._station_failed(call)
 
-            del self.__sent_call[call]
-            del self.__file_to_call[fn]
+                del self.__sent_call[call]
+                self.__call_files.pop(call, None)
 
-        if self.__sent_port.has_key(port):
+        if not pending and self.__sent_port.has_key(port):
             # This port is now open for another transfer
             del self.__sent_port[port]
 
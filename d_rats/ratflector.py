@@ -0,0 +1,387 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import errno
+import fcntl
+import socket
+import select
+import threading
+import collections
+
+import comm
+import ddt2
+import transport
+
+# Bytes of encoded frames that may be waiting for a single client before
+# we start dropping frames for it
+DEFAULT_QUEUE_LIMIT = 256 * 1024
+
+# Bytes a client may send before authenticating without ending a line;
+# anyone sending more isn't speaking the protocol and gets dropped
+MAX_AUTH_LINE = 1024
+
+class RatflectorClient(object):
+    """One network client of a RatflectorServer.  This quacks enough like
+    a transport.Transporter that the repeater can route frames to it."""
+
+    def __init__(self, server, sock, addr, queue_limit=DEFAULT_QUEUE_LIMIT):
+        self.server = server
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.addr = addr
+        self.name = "%s:%i" % addr
+        self.enabled = True
+        self.authenticated = False
+        self.inhandler = None
+
+        self.queue_limit = queue_limit
+        self.dropped = 0
+
+        self._scanner = transport.FrameScanner()
+        self._lock = threading.Lock()
+        self._outq = collections.deque()
+        self._outq_size = 0
+        self._out_offset = 0
+
+        self._linebuf = ""
+        self._username = None
+
+    def __str__(self):
+        return "[NET %s]" % self.name
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send_data(self, data):
+        """Queues data for the client without blocking.  Returns False if
+        the client isn't keeping up and the data was dropped."""
+        if not self.enabled:
+            return False
+
+        self._lock.acquire()
+        if self._outq and self._outq_size + len(data) > self.queue_limit:
+            self.dropped += 1
+            self._lock.release()
+            print "Client %s is %i bytes behind, dropping frame" % (\
+                self.name, self._outq_size)
+            return False
+
+        self._outq.append(data)
+        self._outq_size += len(data)
+        self._lock.release()
+
+        self.server.wakeup()
+        return True
+
+    def send_frame(self, frame):
+        if not self.enabled:
+            print "Refusing to queue block for dead client"
+            return
+        self.send_data(frame.get_packed())
+
+    def get_queued_size(self):
+        return self._outq_size
+
+    def wants_write(self):
+        return bool(self._outq)
+
+    def disable(self):
+        self.inhandler = None
+        self.enabled = False
+        self.server.wakeup()
+
+    def handle_write(self):
+        self._lock.acquire()
+        try:
+            while self._outq:
+                head = self._outq[0]
+                try:
+                    n = self.sock.send(buffer(head, self._out_offset))
+                except socket.error, e:
+                    if e[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                        break
+                    print "Write to %s failed: %s" % (self.name, e)
+                    self.enabled = False
+                    break
+
+                self._out_offset += n
+                if self._out_offset < len(head):
+                    break
+
+                self._outq.popleft()
+                self._outq_size -= len(head)
+                self._out_offset = 0
+        finally:
+            self._lock.release()
+
+    def handle_read(self):
+        if self.authenticated:
+            buf = self._scanner.get_buffer()
+        else:
+            buf = bytearray()
+
+        try:
+            n = comm.socket_recv_into(self.sock, buf, comm.RECV_CHUNK)
+        except socket.error, e:
+            if e[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return
+            print "Read from %s failed: %s" % (self.name, e)
+            n = 0
+
+        if n == 0:
+            print "Client %s disconnected" % self.name
+            self.enabled = False
+        elif self.authenticated:
+            self._scanner.fed()
+            self._handle_input()
+        else:
+            self._handle_auth(str(buf))
+
+    def _handle_input(self):
+        for kind, data in self._scanner.scan():
+            if kind == transport.FRAME_EVENT:
+                f = ddt2.DDT2EncodedFrame()
+                try:
+                    if not f.unpack(data):
+                        print "Found a broken block from %s" % self.name
+                        continue
+                except Exception, e:
+                    print "Failed to process block from %s: %s" % (\
+                        self.name, e)
+                    continue
+            elif kind == transport.GPS_EVENT:
+                f = transport.make_text_frame(data)
+            else:
+                print "### Unconverted data from %s: %s" % (self.name, data)
+                continue
+
+            if self.inhandler:
+                self.inhandler(f)
+
+    def _reject(self, line):
+        self.send_data(line)
+        self.authenticated = False
+        self.enabled = False
+
+    def start(self):
+        if self.server.auth:
+            greeting, required = self.server.auth.auth_greeting(self.addr[0])
+        else:
+            greeting, required = "100 Authentication not required\r\n", False
+
+        self.send_data(greeting)
+        if not required:
+            self._open()
+
+    def _open(self):
+        self.authenticated = True
+        self.server.client_authenticated(self)
+
+    def _handle_auth(self, data):
+        # The same USER/PASS exchange as the threaded repeater's
+        # auth_exchange()
+        self._linebuf += data
+        while "\r\n" in self._linebuf and self.enabled and \
+                not self.authenticated:
+            line, self._linebuf = self._linebuf.split("\r\n", 1)
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                cmd, value = line.split(" ", 1)
+            except Exception, e:
+                print "Unable to read auth command: `%s': %s" % (line, e)
+                self._reject("501 Invalid Syntax\r\n")
+                return
+
+            cmd = cmd.upper()
+            if cmd == "USER" and not self._username:
+                self._username = value
+                self.send_data("102 %s okay\r\n" % cmd)
+            elif cmd == "PASS" and self._username:
+                if self.server.auth.auth_check(self._username, value):
+                    self.send_data("200 Authorized\r\n")
+                    self._open()
+                else:
+                    self._reject("500 Not authorized\r\n")
+                    return
+            else:
+                self._reject("201 Protocol violation\r\n")
+                return
+
+        if not self.authenticated and len(self._linebuf) > MAX_AUTH_LINE:
+            print "Client %s sent %i bytes without authenticating" % (\
+                self.name, len(self._linebuf))
+            self._linebuf = ""
+            self.enabled = False
+            return
+
+        if self.authenticated and self._linebuf:
+            # The client didn't wait for our answer before sending data
+            self._scanner.feed(self._linebuf)
+            self._linebuf = ""
+            self._handle_input()
+
+class RatflectorServer(object):
+    """Serves any number of ratflector clients from a single thread.
+    Connections are accepted as soon as they arrive, and frames are
+    queued to each client independently, so a slow client only ever
+    delays itself.
+
+    The auth object, if any, provides auth_greeting(host), which returns
+    the greeting line and whether a USER/PASS exchange is required, and
+    auth_check(username, password)."""
+
+    def __init__(self, auth=None, on_client=None,
+                 queue_limit=DEFAULT_QUEUE_LIMIT):
+        self.auth = auth
+        self.on_client = on_client
+        self.queue_limit = queue_limit
+        self.enabled = True
+
+        self._listeners = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in [self._wake_r, self._wake_w]:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self.thread = None
+
+    def listen(self, sock):
+        """Accepts D-RATS clients on sock"""
+        self.add_listener(sock, self._accept_client)
+
+    def add_listener(self, sock, callback):
+        """Calls callback(sock, addr) for each connection accepted on sock"""
+        sock.setblocking(False)
+        self._lock.acquire()
+        self._listeners[sock.fileno()] = (sock, callback)
+        self._lock.release()
+        self.wakeup()
+
+    def get_clients(self):
+        self._lock.acquire()
+        clients = self._clients.values()
+        self._lock.release()
+
+        return clients
+
+    def wakeup(self):
+        try:
+            os.write(self._wake_w, "!")
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _accept_client(self, sock, addr):
+        print "Accepted new client %s:%i" % addr
+        client = RatflectorClient(self, sock, addr, self.queue_limit)
+        self._lock.acquire()
+        self._clients[client.fileno()] = client
+        self._lock.release()
+        client.start()
+
+    def client_authenticated(self, client):
+        if self.on_client:
+            self.on_client(client)
+
+    def _accept(self, lsock, callback):
+        while True:
+            try:
+                csock, addr = lsock.accept()
+            except socket.error, e:
+                break
+
+            try:
+                callback(csock, addr)
+            except Exception, e:
+                print "Failed to set up connection from %s: %s" % (addr, e)
+                csock.close()
+
+    def _drop_client(self, fd, client):
+        self._lock.acquire()
+        if fd in self._clients:
+            del self._clients[fd]
+        self._lock.release()
+
+        client.enabled = False
+        try:
+            # Let any last words (like an auth rejection) go out first
+            client.handle_write()
+            client.sock.close()
+        except socket.error:
+            pass
+
+    def _run(self):
+        while self.enabled:
+            self._lock.acquire()
+            listeners = dict(self._listeners)
+            clients = dict(self._clients)
+            self._lock.release()
+
+            for fd, client in clients.items():
+                if not client.enabled:
+                    self._drop_client(fd, client)
+                    del clients[fd]
+
+            rlist = listeners.keys() + clients.keys() + [self._wake_r]
+            wlist = [fd for fd, c in clients.items() if c.wants_write()]
+
+            try:
+                r, w, x = select.select(rlist, wlist, [], 1.0)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in r:
+                if fd == self._wake_r:
+                    try:
+                        while os.read(self._wake_r, 512):
+                            pass
+                    except OSError:
+                        pass
+                elif fd in listeners:
+                    self._accept(*listeners[fd])
+                elif fd in clients:
+                    clients[fd].handle_read()
+
+            for fd in w:
+                if fd in clients:
+                    clients[fd].handle_write()
+
+        self._lock.acquire()
+        clients = self._clients.items()
+        self._lock.release()
+        for fd, client in clients:
+            self._drop_client(fd, client)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.enabled = False
+        self.wakeup()
+        if self.thread:
+            self.thread.join()
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import threading
+import collections
+
+from utils import log_exception
+
+class TimerWheel(object):
+    """A hashed timing wheel.  Each timer is filed in the slot for the
+    tick it expires on, so arming, re-arming and cancelling are constant
+    time, and expiring only looks at the slots for the ticks that have
+    passed.  Timers further out than one turn of the wheel stay in their
+    slot until the turn they belong to comes around."""
+
+    def __init__(self, tick=0.05, size=1024):
+        self.tick = tick
+        self.size = size
+        self._slots = [[] for i in range(0, size)]
+        self._deadlines = {}
+        self._last = self._tick_of(time.time())
+
+        # No timer expires before this tick, so the search for the next
+        # one starts here instead of at the beginning every time
+        self._earliest = self._last + 1
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _tick_of(self, when):
+        return int(when / self.tick)
+
+    def schedule(self, key, when):
+        """Arms (or re-arms) the timer for key to expire at when"""
+        self._deadlines[key] = when
+        tick = max(self._tick_of(when), self._last + 1)
+        self._slots[tick % self.size].append((tick, when, key))
+        self._earliest = min(self._earliest, tick)
+
+    def cancel(self, key):
+        # The slot entry goes stale and is dropped when its slot comes up
+        self._deadlines.pop(key, None)
+
+    def get_deadline(self, key):
+        return self._deadlines.get(key, None)
+
+    def next_deadline(self):
+        """Returns when the next timer expires, or None if none is armed.
+        This walks forward from the earliest tick that might have one,
+        and remembers where it stopped, so it only looks at each slot
+        once as time passes."""
+        if not self._deadlines:
+            return None
+
+        start = max(self._earliest, self._last + 1)
+        best = None
+        for tick in range(start, start + self.size):
+            for entry in self._slots[tick % self.size]:
+                _tick, when, key = entry
+                if self._deadlines.get(key, None) != when:
+                    continue
+                if best is None or (_tick, when) < best:
+                    best = (_tick, when)
+
+            if best and best[0] <= tick:
+                break
+
+        # With timers armed, one turn of the wheel finds at least one
+        self._earliest = best[0]
+        return best[1]
+
+    def expire(self, now):
+        """Returns the keys of all the timers that are due at now"""
+        now_tick = self._tick_of(now)
+        fired = []
+
+        ticks = min(now_tick - self._last, self.size)
+        for i in range(1, ticks + 1):
+            slot = self._slots[(self._last + i) % self.size]
+            keep = []
+            for entry in slot:
+                tick, when, key = entry
+                if self._deadlines.get(key, None) != when:
+                    continue
+                elif tick <= now_tick:
+                    del self._deadlines[key]
+                    fired.append(key)
+                else:
+                    keep.append(entry)
+            slot[:] = keep
+
+        self._last = max(self._last, now_tick)
+
+        return fired
+
+class SessionScheduler(object):
+    """Runs the stateful sessions of a SessionManager from a single
+    thread.  A session is serviced when it is woken (a frame arrived for
+    it, data was written to it, or its state changed) and when one of its
+    named timers expires, by calling its service() method."""
+
+    def __init__(self, tick=0.05):
+        self._wheel = TimerWheel(tick)
+        self._cond = threading.Condition()
+        self._runnable = collections.OrderedDict()
+        self._timers = {}
+        self._service_lock = threading.Lock()
+        self.enabled = True
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def wake(self, session):
+        self._cond.acquire()
+        self._runnable[session] = True
+        self._cond.notify()
+        self._cond.release()
+
+    def set_timer(self, session, name, when):
+        self._cond.acquire()
+        self._wheel.schedule((session, name), when)
+        self._timers.setdefault(session, set()).add(name)
+        self._cond.notify()
+        self._cond.release()
+
+    def cancel_timer(self, session, name):
+        self._cond.acquire()
+        self._wheel.cancel((session, name))
+        self._cond.release()
+
+    def get_timer(self, session, name):
+        self._cond.acquire()
+        when = self._wheel.get_deadline((session, name))
+        self._cond.release()
+
+        return when
+
+    def remove(self, session):
+        """Forgets a session's wakeups and timers.  Unless called from the
+        scheduler itself, this waits for any service() of the session
+        that is running right now to finish."""
+        self._cond.acquire()
+        self._runnable.pop(session, None)
+        for name in self._timers.pop(session, []):
+            self._wheel.cancel((session, name))
+        self._cond.release()
+
+        if threading.currentThread() != self.thread:
+            self._service_lock.acquire()
+            self._service_lock.release()
+
+    def stop(self):
+        self._cond.acquire()
+        self.enabled = False
+        self._cond.notify()
+        self._cond.release()
+
+        if threading.currentThread() != self.thread:
+            self.thread.join()
+
+    def _get_due(self):
+        self._cond.acquire()
+        while self.enabled:
+            now = time.time()
+            due = self._runnable.keys()
+            self._runnable.clear()
+
+            for session, name in self._wheel.expire(now):
+                if session not in due:
+                    due.append(session)
+
+            if due:
+                break
+
+            deadline = self._wheel.next_deadline()
+            if deadline is None:
+                self._cond.wait()
+            else:
+                # Timers only expire a tick at a time, so there is no
+                # point waking up sooner than that
+                self._cond.wait(max(deadline - now, self._wheel.tick))
+        self._cond.release()
+
+        if not self.enabled:
+            return []
+        return due
+
+    def _run(self):
+        while self.enabled:
+            for session in self._get_due():
+                self._service_lock.acquire()
+                try:
+                    session.service()
+                except Exception, e:
+                    print "Exception servicing session %s: %s" % (\
+                        session.name, e)
+                    log_exception()
+                self._service_lock.release()
+
+        print "Session scheduler stopped"
+
+def test_wheel():
+    w = TimerWheel(tick=0.1, size=8)
+    now = time.time()
+
+    w.schedule("a", now + 0.15)
+    w.schedule("b", now + 5)    # More than a turn of the wheel away
+    w.schedule("c", now + 0.25)
+    w.cancel("c")
+    w.schedule("d", now + 0.3)
+    w.schedule("d", now + 0.45) # Re-armed
+
+    assert w.expire(now) == []
+    assert w.next_deadline() == now + 0.15
+    assert w.expire(now + 0.35) == ["a"]
+    assert w.next_deadline() == now + 0.45
+    w.schedule("e", now + 0.4) # Earlier than where the search stopped
+    assert w.next_deadline() == now + 0.4
+    w.cancel("e")
+    assert w.expire(now + 1.0) == ["d"]
+    assert w.next_deadline() == now + 5
+    assert w.expire(now + 4.9) == []
+    assert w.expire(now + 5.1) == ["b"]
+    assert len(w) == 0
+
+    print "Timer wheel OK"
+
+if __name__ == "__main__":
+    test_wheel()
@@ -23,9 +23,12 @@ import os
 import gobject
 
 import formgui
+import formheader
 import emailgw
 import signals
+import msgindex
 import msgrouting
+import xfersched
 from utils import run_safe, run_gtk_locked
 
 from d_rats.sessions import base, file, form, sock
@@ -144,11 +147,14 @@ class FileSendThread(FileBaseThread):
     progress_key = "sent_size"
 
     def worker(self, path):
-        if self.session.send_file(path):
-            self.completed("file %s" % os.path.basename(path))
-            self.coord.session_file_sent(self.session, path)
-        else:
-            self.failed((self.session.get_station(), path))
+        try:
+            if self.session.send_file(path):
+                self.completed("file %s" % os.path.basename(path))
+                self.coord.session_file_sent(self.session, path)
+            else:
+                self.failed((self.session.get_station(), path))
+        finally:
+            self.coord.transfer_done(self.session)
 
 class FormRecvThread(FileBaseThread):
     progress_key = "recv_size"
@@ -181,11 +187,89 @@ class FormSendThread(FileBaseThread):
     progress_key = "sent_size"
 
     def worker(self, path):
-        if self.session.send_file(path):
-            self.completed()
-            self.coord.session_form_sent(self.session, path)
+        try:
+            if self.session.send_file(path):
+                self.completed()
+                self.coord.session_form_sent(self.session, path)
+            else:
+                self.failed((self.session.get_station(), path))
+        finally:
+            self.coord.transfer_done(self.session)
+
+class FormBatchRecvThread(FileBaseThread):
+    progress_key = "recv_size"
+
+    def store_form(self, name, data):
+        """Files one form of the batch in the Inbox, as FormRecvThread
+        does with a single one.  One we already have (because the sender
+        didn't hear us take it last time) is taken but not filed again"""
+        store = self.coord.config.form_store_dir()
+
+        parser = formheader.FormHeaderParser()
+        parser.feed(data)
+        mid = parser.header.mid
+        if mid and msgindex.get_index(store).find(mid):
+            print "Already have message %s (%s), skipping it" % (mid, name)
+            return True
+
+        md = os.path.join(store, _("Inbox"))
+        stamp = time.strftime("form_%m%d%Y_%H%M%S")
+        i = 0
+        while os.path.exists(os.path.join(md, "%s_%02i.xml" % (stamp, i))):
+            i += 1
+        newfn = os.path.join(md, "%s_%02i.xml" % (stamp, i))
+        if not msgrouting.msg_lock(newfn):
+            print "AIEE! Unable to lock incoming new message file!"
+
+        try:
+            f = open(newfn, "wb")
+            f.write(data)
+            f.close()
+
+            form = formgui.FormFile(newfn)
+            form.add_path_element(self.coord.config.get("user", "callsign"))
+            form.save_to(newfn)
+        except Exception:
+            if os.path.exists(newfn):
+                os.remove(newfn)
+            msgrouting.msg_unlock(newfn)
+            raise
+
+        self.forms.append(newfn)
+        return True
+
+    def worker(self, path):
+        self.forms = []
+        count = self.session.recv_forms(path, self.store_form)
+
+        if count is None:
+            self.failed()
+            print "<--- Form batch transfer failed -->"
         else:
-            self.failed((self.session.get_station(), path))
+            self.completed("%i forms" % count)
+
+        for fn in self.forms:
+            self.coord.session_newform(self.session, fn)
+
+class FormBatchSendThread(FileBaseThread):
+    OUTGOING = True
+    progress_key = "sent_size"
+
+    def worker(self, paths):
+        station = self.session.get_station()
+        try:
+            sent = self.session.send_forms(paths, self.coord.batch_dir())
+            if sent:
+                self.completed("%i forms" % len(sent))
+
+            # Each form is done (or not) on its own
+            for path in paths:
+                if path in sent:
+                    self.coord.session_form_sent(self.session, path)
+                else:
+                    self.failed((station, path))
+        finally:
+            self.coord.transfer_done(self.session)
 
 class SocketThread(SessionThread):
     def status(self):
@@ -279,6 +363,7 @@ class SessionCoordinator(gobject.GObject):
         "form-received" : signals.FORM_RECEIVED,
         "file-sent" : signals.FILE_SENT,
         "form-sent" : signals.FORM_SENT,
+        "transfer-queue-update" : signals.TRANSFER_QUEUE_UPDATE,
         }
 
     _signals = __gsignals__
@@ -339,8 +424,10 @@ class SessionCoordinator(gobject.GObject):
             dd = self.config.get("prefs", "download_dir")
             self.sthreads[session._id] = FileRecvThread(self, session, dd)
         elif direction == "out":
-            of = self.outgoing_files.pop()
-            self.sthreads[session._id] = FileSendThread(self, session, of)
+            job = session.xfer_job
+            self.xfer_jobs[session._id] = job
+            self.sthreads[session._id] = FileSendThread(self, session,
+                                                        job.filename)
 
     def new_form_xfer(self, session, direction):
         msg = _("Message transfer of %s started with %s") % (session.name,
@@ -351,8 +438,24 @@ class SessionCoordinator(gobject.GObject):
             dd = self.config.form_store_dir()
             self.sthreads[session._id] = FormRecvThread(self, session, dd)
         elif direction == "out":
-            of = self.outgoing_forms.pop()
-            self.sthreads[session._id] = FormSendThread(self, session, of)
+            job = session.xfer_job
+            self.xfer_jobs[session._id] = job
+            self.sthreads[session._id] = FormSendThread(self, session,
+                                                        job.filename)
+
+    def new_batch_xfer(self, session, direction):
+        msg = _("Message batch transfer of %s started with %s") % (\
+            session.name, session._st)
+        self.emit("session-status-update", session._id, msg)
+
+        if direction == "in":
+            self.sthreads[session._id] = FormBatchRecvThread(self, session,
+                                                             self.batch_dir())
+        elif direction == "out":
+            job = session.xfer_job
+            self.xfer_jobs[session._id] = job
+            self.sthreads[session._id] = FormBatchSendThread(self, session,
+                                                             job.filename)
 
     def new_socket(self, session, direction):
         msg = _("Socket session %s started with %s") % (session.name,
@@ -402,7 +505,9 @@ class SessionCoordinator(gobject.GObject):
         print "New session (%s) of type: %s" % (direction, session.__class__)
         self.emit("session-started", session._id, type)
 
-        if isinstance(session, form.FormTransferSession):
+        if isinstance(session, form.FormBatchSession):
+            self.new_batch_xfer(session, direction)
+        elif isinstance(session, form.FormTransferSession):
             self.new_form_xfer(session, direction)
         elif isinstance(session, file.FileTransferSession):
             self.new_file_xfer(session, direction)
@@ -431,40 +536,95 @@ class SessionCoordinator(gobject.GObject):
         elif reason == "end":
             self.end_session(session._id)
 
+    def _start_transfer(self, job):
+        if job.kind == "form":
+            kwargs = {"cls" : form.FormTransferSession}
+        elif job.kind == "batch":
+            kwargs = {"cls" : form.FormBatchSession}
+        else:
+            bs = self.config.getint("settings", "ddt_block_size")
+            ol = self.config.getint("settings", "ddt_block_outlimit")
+            kwargs = {"cls"       : file.FileTransferSession,
+                      "blocksize" : bs,
+                      "outlimit"  : ol}
+
+        # Several jobs may be starting at once, and their sessions can
+        # get going in any order, so each carries its own job from the
+        # moment it is made
+        cls = kwargs["cls"]
+        def make_session(name, **args):
+            session = cls(name, **args)
+            session.xfer_job = job
+            return session
+
+        kwargs["cls"] = make_session
+        kwargs["name"] = job.name
+        kwargs["dest"] = job.dest
+
+        t = threading.Thread(target=self.sm.start_session, kwargs=kwargs)
+        t.setDaemon(True)
+        t.start()
+        print "Started %s session" % job.kind
+
+    def _transfer_changed(self, job):
+        if job.state == xfersched.JOB_QUEUED:
+            queue = self.xfers.get_queue()
+            ahead = job in queue and queue.index(job) or 0
+            msg = _("Queued %s %s for %s (%i ahead)") % (\
+                job.kind, job.name, job.dest, ahead)
+        elif job.state == xfersched.JOB_ACTIVE:
+            msg = _("Sending %s %s to %s") % (job.kind, job.name, job.dest)
+        else:
+            # The session reports how it went
+            return
+
+        self._emit("transfer-queue-update", job.id, msg,
+                   job.state != xfersched.JOB_QUEUED)
+
+    def transfer_done(self, session):
+        job = self.xfer_jobs.pop(session._id, None)
+        if job:
+            self.xfers.finished(job)
+
+    def _queue_transfer(self, kind, dest, filename, name, priority):
+        self.xfers.set_max_active(self.config.getint("settings",
+                                                     "ddt_max_xfers"))
+        self.xfers.submit(kind, dest, filename, name, priority)
+
     def send_file(self, dest, filename, name=None):
         if name is None:
             name = os.path.basename(filename)
 
-        self.outgoing_files.insert(0, filename)
-        print "Outgoing files: %s" % self.outgoing_files
+        self._queue_transfer("file", dest, filename, name,
+                             xfersched.PRI_FILE)
 
-        xfer = file.FileTransferSession
-        bs = self.config.getint("settings", "ddt_block_size")
-        ol = self.config.getint("settings", "ddt_block_outlimit")
-
-        t = threading.Thread(target=self.sm.start_session,
-                             kwargs={"name"      : name,
-                                     "dest"      : dest,
-                                     "cls"       : xfer,
-                                     "blocksize" : bs,
-                                     "outlimit"  : ol})
-        t.setDaemon(True)
-        t.start()
-        print "Started Session"
-        
     def send_form(self, dest, filename, name="Form"):
-        self.outgoing_forms.insert(0, filename)
-        print "Outgoing forms: %s" % self.outgoing_forms
+        self._queue_transfer("form", dest, filename, name,
+                             xfersched.PRI_FORM)
+
+    def send_forms(self, dest, filenames, name=None):
+        """Sends several forms to dest: in one batch if it can take
+        them that way, or else one at a time"""
+        if len(filenames) > 1 and \
+                self.sm.get_peer_proto(dest) >= base.PROTO_BATCH:
+            if name is None:
+                name = _("%i forms") % len(filenames)
+            self._queue_transfer("batch", dest, list(filenames), name,
+                                 xfersched.PRI_FORM)
+        else:
+            for filename in filenames:
+                self.send_form(dest, filename)
 
-        xfer = form.FormTransferSession
+    def batch_dir(self):
+        """Where batches of forms are packed and unpacked"""
+        path = os.path.join(self.config.form_store_dir(), ".batches")
+        if not os.path.isdir(path):
+            os.makedirs(path)
 
-        t = threading.Thread(target=self.sm.start_session,
-                             kwargs={"name" : name,
-                                     "dest" : dest,
-                                     "cls"  : xfer})
-        t.setDaemon(True)
-        t.start()
-        print "Started form session"
+        return path
+
+    def get_transfer_queue(self):
+        return self.xfers.get_queue()
 
     def __init__(self, config, sm):
         gobject.GObject.__init__(self)
@@ -474,8 +634,11 @@ class SessionCoordinator(gobject.GObject):
 
         self.sthreads = {}
 
-        self.outgoing_files = []
-        self.outgoing_forms = []
+        self.xfer_jobs = {}
+
+        self.xfers = xfersched.TransferScheduler(self._start_transfer,
+                                                 changed_fn=\
+                                                     self._transfer_changed)
 
         self.socket_listeners = {}
 
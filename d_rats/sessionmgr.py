@@ -21,8 +21,11 @@ import os
 import struct
 import socket
 
+import ddt2
 from ddt2 import DDT2EncodedFrame
 import transport
+import congestion
+import scheduler
 
 from sessions import base, control, stateful, stateless
 from sessions import file, form, sock, sniff
@@ -40,11 +43,50 @@ class SessionManager(object):
     def set_call(self, callsign):
         self.station = callsign
 
+    def set_path_profile(self, profile):
+        self.path_profile = profile
+
+    def set_content_store(self, store):
+        self.content_store = store
+
+    def set_preset_dict(self, enabled):
+        """Sets whether frames to stations that speak it are compressed
+        with the preset dictionary.  Repeaters that predate it drop such
+        frames."""
+        self.preset_dict = enabled
+
+    def set_peer_proto(self, station, proto):
+        self._peer_protos[station] = proto
+
+    def get_peer_proto(self, station):
+        """Returns the protocol version station last set up a session
+        with, or PROTO_LEGACY if we haven't had one with it yet"""
+        return self._peer_protos.get(station, base.PROTO_LEGACY)
+
+    def get_codec(self, station, session=None):
+        """Returns the codec to compress frames to station with"""
+        proto = self.get_peer_proto(station)
+        if session:
+            proto = max(proto, session._proto)
+
+        if self.preset_dict and proto >= base.PROTO_CODEC:
+            return ddt2.CODEC_ZDICT
+        else:
+            return ddt2.CODEC_ZLIB
+
     def __init__(self, pipe, station, **kwargs):
         self.pipe = self.tport = None
         self.station = station
 
         self.sniff_session = None
+        self.path_profile = congestion.PathProfile()
+        self.content_store = None
+        self.scheduler = scheduler.SessionScheduler()
+        self.preset_dict = True
+
+        # The newest protocol each station we've set up a session with
+        # has agreed to, so that we know what codecs it understands
+        self._peer_protos = {}
 
         self.last_frame = 0
         self.sessions = {}
@@ -93,6 +135,8 @@ class SessionManager(object):
         if not force:
             self.tport.disable()
 
+        self.scheduler.stop()
+
     def incoming(self, frame):
         self.last_frame = time.time()
 
@@ -148,6 +192,12 @@ class SessionManager(object):
         else:
             block.session = session._id
 
+        if block.priority is None:
+            block.priority = session.priority
+
+        if block.codec is None:
+            block.codec = self.get_codec(block.d_station, session)
+
         self.tport.send_frame(block)
 
     def _get_new_session_id(self):
@@ -175,6 +225,9 @@ class SessionManager(object):
         session._st = dest
         self.sessions[id] = session
 
+        # Let the session arm its timers now that it has a scheduler
+        session.notify()
+
         self.fire_session_cb(session, reason)
 
         return id
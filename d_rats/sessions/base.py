@@ -27,12 +27,22 @@ T_SOCKET    = 4
 T_FILEXFER  = 5
 T_FORMXFER  = 6
 T_RPC       = 7
+T_FORMBATCH = 8
 
 ST_OPEN     = 0
 ST_CLSD     = 1
 ST_CLSW     = 2
 ST_SYNC     = 3
 
+# Session protocol versions, agreed on by the control session when a
+# session is set up.  Peers that predate this only speak PROTO_LEGACY.
+PROTO_LEGACY  = 0 # 8-bit sequence numbers, one byte per block in acks
+PROTO_SACK16  = 1 # 16-bit sequence numbers, bitmap acks
+PROTO_STREAM  = 2 # File transfers compressed and sent as a stream
+PROTO_CODEC   = 3 # Frames and file chunks may use any ddt2 codec
+PROTO_BATCH   = 4 # Takes several forms at once in a T_FORMBATCH session
+PROTO_VERSION = PROTO_BATCH
+
 class SessionClosedError(Exception):
     pass
 
@@ -41,7 +51,9 @@ class Session(object):
     _id = None
     _st = None
     _rs = None
+    _proto = PROTO_LEGACY
     type = None
+    priority = transport.PRI_BULK
 
     def __init__(self, name):
         self.name = name
@@ -3,7 +3,7 @@ import time
 
 import gobject
 
-from d_rats import signals, platform, gps, utils, station_status
+from d_rats import signals, platform, gps, utils, station_status, transport
 from d_rats.version import DRATS_VERSION
 from d_rats.sessions import base, stateless
 from d_rats.ddt2 import DDT2EncodedFrame, DDT2RawData
@@ -25,6 +25,7 @@ class ChatSession(stateless.StatelessSession, gobject.GObject):
     __cb_data = None
 
     type = base.T_STATELESS
+    priority = transport.PRI_CHAT
 
     T_DEF = 0
     T_PNG_REQ = 1
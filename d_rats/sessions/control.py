@@ -17,6 +17,7 @@
 
 import struct
 
+from d_rats import transport
 from d_rats.utils import log_exception
 from d_rats.ddt2 import DDT2EncodedFrame
 from d_rats.sessions import base, stateful, stateless
@@ -29,11 +30,14 @@ T_NEW = 3
 
 class ControlSession(base.Session):
     stateless = True
+    priority = transport.PRI_CONTROL
 
-    def ack_req(self, dest, data):
+    def ack_req(self, dest, data, proto=base.PROTO_LEGACY):
         f = DDT2EncodedFrame()
         f.type = T_ACK
-        f.seq = 0
+        # Older peers ignore the sequence number of control frames, so it
+        # carries the protocol version for the session
+        f.seq = proto
         f.d_station = dest
         f.data = data
         self._sm.outgoing(self, f)
@@ -43,6 +47,8 @@ class ControlSession(base.Session):
             l, r = struct.unpack("BB", frame.data)
             session = self._sm.sessions[l]
             session._rs = r
+            session._proto = min(frame.seq, base.PROTO_VERSION)
+            self._sm.set_peer_proto(frame.s_station, session._proto)
             print "Signaled waiting session thread (l=%i r=%i)" % (l, r)
         except Exception, e:
             print "Failed to lookup new session event: %s" % e
@@ -95,16 +101,22 @@ class ControlSession(base.Session):
             print "Re-acking existing session %s:%i:%i" % (frame.s_station,
                                                            id,
                                                            exist._id)
-            self.ack_req(frame.s_station, struct.pack("BB", id, exist._id))
+            self.ack_req(frame.s_station, struct.pack("BB", id, exist._id),
+                         exist._proto)
             return
 
         print "ACK'ing session request for %i" % id
 
+        # The requester offers the highest version it speaks
+        proto = min(frame.seq, base.PROTO_VERSION)
+        self._sm.set_peer_proto(frame.s_station, proto)
+
         try:
             c = self.stypes[frame.type]
             print "Got type: %s" % c
             s = c(name)
             s._rs = id
+            s._proto = proto
             s.set_state(base.ST_OPEN)
         except Exception, e:
             log_exception()
@@ -114,7 +126,7 @@ class ControlSession(base.Session):
         num = self._sm._register_session(s, frame.s_station, "new,in")
 
         data = struct.pack("BB", id, num)
-        self.ack_req(frame.s_station, data)
+        self.ack_req(frame.s_station, data, proto)
 
     def ctl(self, frame):
         if frame.d_station != self._sm.station:
@@ -133,7 +145,7 @@ class ControlSession(base.Session):
     def new_session(self, session):
         f = DDT2EncodedFrame()
         f.type = T_NEW + session.type
-        f.seq = 0
+        f.seq = base.PROTO_VERSION
         f.d_station = session._st
         f.data = struct.pack("B", int(session._id)) + session.name
 
@@ -143,7 +155,7 @@ class ControlSession(base.Session):
             self._sm.outgoing(self, f)
 
             f.sent_event.wait(10)
-            f.sent_event.clear()
+            f.clear_sent()
 
             print "Sent request, blocking..."
             session.wait_for_state_change(wait_time)
@@ -157,7 +169,8 @@ class ControlSession(base.Session):
                 print "Waiting for synchronization"
                 wait_time = 15
             else:
-                print "Established session %i:%i" % (session._id, session._rs)
+                print "Established session %i:%i (protocol %i)" % (\
+                    session._id, session._rs, session._proto)
                 session.set_state(base.ST_OPEN)
                 return True
 
@@ -189,7 +202,7 @@ class ControlSession(base.Session):
             self._sm.outgoing(self, f)
 
             f.sent_event.wait(10)
-            f.sent_event.clear()
+            f.clear_sent()
 
             print "Sent, waiting for response"
             session.wait_for_state_change(15)
@@ -209,6 +222,7 @@ class ControlSession(base.Session):
         self.stypes = { T_NEW + base.T_GENERAL  : stateful.StatefulSession,
                         T_NEW + base.T_FILEXFER : file.FileTransferSession,
                         T_NEW + base.T_FORMXFER : form.FormTransferSession,
+                        T_NEW + base.T_FORMBATCH: form.FormBatchSession,
                         T_NEW + base.T_SOCKET   : sock.SocketSession,
                         }
 
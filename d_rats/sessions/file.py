@@ -3,9 +3,178 @@ import struct
 import os
 import time
 import zlib
+import hashlib
+import shutil
 
+from d_rats import ddt2
 from d_rats.sessions import base, stateful
 
+# Streamed transfers move the file in chunks of this size, each of which
+# is compressed, checked and (if the transfer breaks) resumed on its own
+CHUNK_SIZE = 16384
+
+# Offer: file size, chunk size and SHA-1 of the file, then its name
+OFFER_FORMAT = "!II20s"
+OFFER_SIZE = struct.calcsize(OFFER_FORMAT)
+
+# Chunk record: index, compressed size and SHA-1 of the chunk, then the
+# compressed chunk.  From PROTO_CODEC on, the compressed chunk starts with
+# the ddt2 codec it was compressed with.
+CHUNK_FORMAT = "!II20s"
+CHUNK_HDR_SIZE = struct.calcsize(CHUNK_FORMAT)
+
+class ChunkError(Exception):
+    pass
+
+def file_digest(filename):
+    f = file(filename, "rb")
+    h = hashlib.sha1()
+    while True:
+        data = f.read(1 << 16)
+        if not data:
+            break
+        h.update(data)
+    f.close()
+
+    return h.digest()
+
+def deflate(data):
+    """Compresses data for a remote that will inflate it whatever it
+    is, by storing it as it is if it doesn't compress"""
+    zdata = ddt2.compress(data, ddt2.CODEC_ZLIB)
+    if len(zdata) >= len(data):
+        zdata = zlib.compress(data, 0)
+
+    return zdata
+
+def offered_name(name):
+    """Returns the file name from a remote's offer with any directory
+    stripped off, or None if there is no usable name left"""
+    name = os.path.basename(name.replace("\\", "/"))
+    if name in ["", ".", ".."]:
+        return None
+
+    return name
+
+def chunk_count(size, chunk_size):
+    return max(1, (size + chunk_size - 1) / chunk_size)
+
+def bitmap_size(count):
+    return (count + 7) / 8
+
+def encode_bitmap(indexes, count):
+    bitmap = [0] * bitmap_size(count)
+    for i in indexes:
+        bitmap[i / 8] |= 1 << (i % 8)
+
+    return "".join([chr(x) for x in bitmap])
+
+def decode_bitmap(data, count):
+    return set([i for i in range(0, min(count, len(data) * 8))
+                if ord(data[i / 8]) & (1 << (i % 8))])
+
+class ChunkIndex(object):
+    """The record of which chunks of a .part file have been received and
+    verified, kept in a file next to it.  It names the file it belongs
+    to by size, chunk size and hash, so a .part left over from some other
+    file is never resumed."""
+
+    def __init__(self, filename, size, chunk_size, digest):
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.digest = digest
+        self.chunks = chunk_count(size, chunk_size)
+        self.have = set()
+
+    def _header(self):
+        return "%s %i %i" % (self.digest.encode("hex"),
+                             self.size,
+                             self.chunk_size)
+
+    def load(self):
+        try:
+            f = file(self.filename)
+            header = f.readline().strip()
+            bitmap = f.readline().strip().decode("hex")
+            f.close()
+        except Exception, e:
+            print "Unable to read chunk index %s: %s" % (self.filename, e)
+            return False
+
+        if header != self._header():
+            print "Chunk index %s is for another file" % self.filename
+            return False
+
+        self.have = decode_bitmap(bitmap, self.chunks)
+        return True
+
+    def save(self):
+        f = file(self.filename, "w")
+        print >>f, self._header()
+        print >>f, encode_bitmap(self.have, self.chunks).encode("hex")
+        f.close()
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def discard(self, partfilename):
+        self.have = set()
+        self.remove()
+        if os.path.exists(partfilename):
+            os.remove(partfilename)
+
+    def open_part(self, partfilename):
+        """Opens the .part file for writing, keeping what it has if this
+        index says it belongs to the same file"""
+        if not (os.path.exists(partfilename) and self.load()):
+            self.discard(partfilename)
+            file(partfilename, "wb").close()
+
+        return file(partfilename, "r+b")
+
+    def get_size(self):
+        """Returns the number of bytes of the file in the chunks we have"""
+        size = 0
+        for i in self.have:
+            size += min(self.chunk_size, self.size - (i * self.chunk_size))
+
+        return size
+
+    def is_complete(self):
+        return len(self.have) == self.chunks
+
+    def store(self, part, i, zchunk, digest, codec=ddt2.CODEC_ZLIB):
+        """Checks a compressed chunk and writes it into place in part.
+        Returns the number of bytes written."""
+        if i >= self.chunks:
+            raise ChunkError("No such chunk")
+        elif i in self.have:
+            return 0
+
+        expected = min(self.chunk_size, self.size - (i * self.chunk_size))
+
+        try:
+            chunk = ddt2.decompress(zchunk, codec, expected)
+        except (zlib.error, ValueError), e:
+            raise ChunkError("Unable to decompress: %s" % e)
+
+        if len(chunk) != expected:
+            raise ChunkError("Wrong size")
+        elif hashlib.sha1(chunk).digest() != digest:
+            raise ChunkError("Checksum mismatch")
+
+        part.seek(i * self.chunk_size)
+        part.write(chunk)
+        part.flush()
+
+        # Only claim the chunk once its data is safely in the file
+        self.have.add(i)
+        self.save()
+
+        return len(chunk)
+
 class NotifyDict(UserDict.UserDict):
     def __init__(self, cb, data={}):
         UserDict.UserDict.__init__(self)
@@ -18,6 +187,8 @@ class NotifyDict(UserDict.UserDict):
 
 class FileTransferSession(stateful.StatefulSession):
     type = base.T_FILEXFER
+    # What we send has been compressed already
+    compress = False
 
     def internal_status(self, vals):
         print "XFER STATUS: %s" % vals["msg"]
@@ -50,67 +221,82 @@ class FileTransferSession(stateful.StatefulSession):
         self.stats = NotifyDict(self.status_tick, self.stats)
         self.stats["total_size"] = 0
 
-    def get_file_data(self, filename):
-        f = file(filename, "rb")
-        data = f.read()
-        f.close()
-
-        return data
-
-    def put_file_data(self, filename, data):
-        f = file(filename, "wb")
-        f.write(data)
-        f.close()
-    
-    def send_file(self, filename):
-        data = self.get_file_data(filename)
-        if not data:
-            return False
-
-        try:
-            offer = struct.pack("I", len(data)) + os.path.basename(filename)
-            self.write(offer)
-        except base.SessionClosedError, e:
-            print "Session closed while sending file information"
-            return False
+    def get_content_store(self):
+        if self._sm:
+            return self._sm.content_store
+        else:
+            return None
 
-        self.filename = os.path.basename(filename)
+    def get_chunk_codec(self):
+        """Returns the codec to compress chunks with, or None if the
+        remote only takes plain zlib chunks"""
+        if self._proto < base.PROTO_CODEC:
+            return None
 
-        offset = None
+        return self._sm.get_codec(self._st, self)
 
+    def wait_for_start(self, resume_size=0):
+        """Waits for the remote's answer to our offer.  Returns the answer
+        ("OK", "HAVE", or "RESUME:" and at least resume_size bytes of what
+        to resume from), or None if it didn't give one."""
+        resp = ""
         for i in range(40):
             print "Waiting for start"
             try:
-                resp = self.read()
+                resp += self.read()
             except base.SessionClosedError, e:
                 print "Session closed while waiting for start ack"
-                return False
+                return None
 
             if not resp:
                 self.status(_("Waiting for response"))
-            elif resp == "OK":
+            elif resp in ["OK", "HAVE"]:
                 self.status(_("Negotiation Complete"))
-                offset = 0
-                break
+                return resp
             elif resp.startswith("RESUME:"):
-                resume, _offset = resp.split(":", 1)
-                print "Got RESUME request at %s" % _offset
-                try:
-                    offset = int(_offset)
-                except Exception, e:
-                    print "Unable to parse RESUME value: %s" % e
-                    offset = 0
-                self.status(_("Resuming at") + "%i" % offset)
-                break
+                if len(resp) - len("RESUME:") >= resume_size:
+                    return resp
             else:
                 print "Got unknown start: `%s'" % resp
+                resp = ""
 
             time.sleep(0.5)
 
-        if offset is None:
-            print "Did not get start response"
+        print "Did not get start response"
+        return None
+
+    def send_file(self, filename):
+        if self._proto >= base.PROTO_STREAM:
+            return self.send_file_stream(filename)
+
+        data = self.get_file_data(filename)
+        if not data:
+            return False
+
+        try:
+            offer = struct.pack("I", len(data)) + os.path.basename(filename)
+            self.write(offer)
+        except base.SessionClosedError, e:
+            print "Session closed while sending file information"
             return False
 
+        self.filename = os.path.basename(filename)
+
+        resp = self.wait_for_start(1)
+        if resp is None:
+            return False
+        elif resp == "OK":
+            offset = 0
+        else:
+            _offset = resp[len("RESUME:"):]
+            print "Got RESUME request at %s" % _offset
+            try:
+                offset = int(_offset)
+            except Exception, e:
+                print "Unable to parse RESUME value: %s" % e
+                offset = 0
+            self.status(_("Resuming at") + "%i" % offset)
+
         self.stats["total_size"] = len(data) + len(offer) - offset
         self.stats["start_time"] = time.time()
 
@@ -134,7 +320,164 @@ class FileTransferSession(stateful.StatefulSession):
             self.status(_("Complete"))
             return True
 
-    def recv_file(self, dir):
+    def send_file_stream(self, filename, close=True):
+        """Sends the file as a series of chunks, each compressed on its
+        own and tagged with its index and hash.  The offer carries the
+        size, chunk size and hash of the whole file, and the remote can
+        answer that it already has the file, or with a bitmap of the
+        chunks it already has, which are skipped.  Compressed chunks are
+        kept in the content store, so sending the file again doesn't
+        compress it again.  If close is False, the session is left open
+        for the caller to hear back from the remote."""
+        try:
+            size = os.path.getsize(filename)
+            digest = file_digest(filename)
+            f = file(filename, "rb")
+        except Exception, e:
+            print "Unable to open %s: %s" % (filename, e)
+            return False
+
+        chunks = chunk_count(size, CHUNK_SIZE)
+
+        try:
+            offer = struct.pack(OFFER_FORMAT, size, CHUNK_SIZE, digest) + \
+                os.path.basename(filename)
+            self.write(offer)
+        except base.SessionClosedError, e:
+            print "Session closed while sending file information"
+            f.close()
+            return False
+
+        self.filename = os.path.basename(filename)
+
+        resp = self.wait_for_start(bitmap_size(chunks))
+        if resp is None:
+            f.close()
+            return False
+        elif resp == "HAVE":
+            print "Remote already has %s" % self.filename
+            f.close()
+            if close:
+                self.close()
+            self.stats["sent_size"] = self.stats["total_size"] = size
+            self.status(_("Complete") + " (" + _("already there") + ")")
+            return True
+        elif resp == "OK":
+            have = set()
+        else:
+            have = decode_bitmap(resp[len("RESUME:"):], chunks)
+            print "Remote has %i of %i chunks" % (len(have), chunks)
+            self.status(_("Resuming at") + " %i/%i" % (len(have), chunks))
+
+        codec = self.get_chunk_codec()
+
+        # A file too big for the store would only push everything else
+        # out of it and then be trimmed itself
+        store = self.get_content_store()
+        if store and size <= store.max_size:
+            cache = store.get_chunk_cache(digest, CHUNK_SIZE, codec)
+        else:
+            cache = None
+
+        needed = [i for i in range(0, chunks) if i not in have]
+        remaining = sum([min(CHUNK_SIZE, size - (i * CHUNK_SIZE))
+                         for i in needed])
+        consumed = compressed = 0
+
+        # Until we have compressed all of it, guess the total from how well
+        # the file has compressed so far
+        self.stats["total_size"] = len(offer) + remaining
+        self.stats["start_time"] = time.time()
+        self.status(_("Sending"))
+
+        # Keep one chunk queued behind the one we are waiting on, so that
+        # the session never runs dry while we compress the next
+        pending = []
+        ok = True
+        try:
+            for i in needed:
+                record = None
+                if cache is not None:
+                    record = cache.get(i)
+                if record is None:
+                    record = self.make_chunk_record(f, i, codec)
+                    if cache is not None:
+                        cache.put(i, record)
+
+                consumed += min(CHUNK_SIZE, size - (i * CHUNK_SIZE))
+                compressed += len(record)
+
+                blocks = self.queue_write(record)
+                ok = self.wait_written(pending, timeout=120)
+                pending = blocks
+                if not ok:
+                    break
+
+                self.stats["total_size"] = len(offer) + \
+                    compressed * remaining / max(consumed, 1)
+
+            if ok:
+                self.wait_written(pending, timeout=120)
+        except base.SessionClosedError:
+            print "Session closed while doing write"
+            ok = False
+        f.close()
+
+        if store:
+            store.trim()
+
+        self.stats["total_size"] = len(offer) + compressed
+        sent = self.stats["sent_size"]
+
+        if close:
+            self.close()
+
+        if ok and sent == self.stats["total_size"]:
+            self.stats["sent_size"] = self.stats["total_size"] = size
+            self.status(_("Complete"))
+            return True
+        else:
+            self.status(_("Failed to send file (incomplete)"))
+            return False
+
+    def make_chunk_record(self, f, i, codec=None):
+        f.seek(i * CHUNK_SIZE)
+        chunk = f.read(CHUNK_SIZE)
+        if codec is None:
+            zchunk = deflate(chunk)
+        else:
+            codec, zchunk = ddt2.compress_smaller(chunk, codec)
+            zchunk = chr(codec) + zchunk
+
+        return struct.pack(CHUNK_FORMAT,
+                           i, len(zchunk),
+                           hashlib.sha1(chunk).digest()) + zchunk
+
+    def take_from_store(self, digest, filename):
+        """Copies the file with this hash out of the content store to
+        filename, if we have it there.  Returns True if we did."""
+        store = self.get_content_store()
+        cached = store and store.lookup(digest)
+        if not cached:
+            return False
+
+        try:
+            shutil.copyfile(cached, filename + ".part")
+            if file_digest(filename + ".part") != digest:
+                raise Exception("Stored copy is corrupted")
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(filename + ".part", filename)
+        except Exception, e:
+            print "Unable to use stored copy of %s: %s" % (filename, e)
+            if os.path.exists(filename + ".part"):
+                os.remove(filename + ".part")
+            return False
+
+        return True
+
+    def recv_offer(self):
+        """Waits for the remote's offer, and returns it"""
         self.status(_("Waiting for transfer to start"))
         for i in range(40):
             try:
@@ -152,8 +495,35 @@ class FileTransferSession(stateful.StatefulSession):
             self.status(_("No start block received!"))
             return None
 
-        size, = struct.unpack("I", data[:4])
-        name = data[4:]
+        return data
+
+    def send_start(self, resume=None):
+        try:
+            if resume:
+                print "Sending resume"
+                self.write("RESUME:%s" % resume)
+            else:
+                self.write("OK")
+        except base.SessionClosedError, e:
+            print "Session closed while sending start ack"
+            return False
+
+        return True
+
+    def recv_file(self, dir):
+        if self._proto >= base.PROTO_STREAM:
+            return self.recv_file_stream(dir)
+
+        offer = self.recv_offer()
+        if not offer:
+            return None
+
+        size, = struct.unpack("I", offer[:4])
+        name = offered_name(offer[4:])
+        if not name:
+            print "Refusing offer of `%s'" % offer[4:]
+            self.status(_("Invalid file name offered"))
+            return None
 
         if os.path.isdir(dir):
             filename = os.path.join(dir, name)
@@ -163,8 +533,11 @@ class FileTransferSession(stateful.StatefulSession):
         partfilename = filename + ".part"
 
         if os.path.exists(partfilename):
-            data = self.get_file_data(self, partfilename)
-            offset = os.path.getsize(partfilename)
+            # This holds the compressed data received so far
+            f = file(partfilename, "rb")
+            data = f.read()
+            f.close()
+            offset = len(data)
             print "Part file exists, resuming at %i" % offset
         else:
             data = ""
@@ -178,14 +551,11 @@ class FileTransferSession(stateful.StatefulSession):
         self.stats["total_size"] = size
         self.stats["start_time"] = time.time()
 
-        try:
-            if offset:
-                print "Sending resume at %i" % offset
-                self.write("RESUME:%i" % offset)
-            else:
-                self.write("OK")
-        except base.SessionClosedError, e:
-            print "Session closed while sending start ack"
+        if offset:
+            resume = "%i" % offset
+        else:
+            resume = None
+        if not self.send_start(resume):
             return None
 
         self.status(_("Waiting for first block"))
@@ -208,7 +578,9 @@ class FileTransferSession(stateful.StatefulSession):
                 os.remove(partfilename)
         except Exception, e:
             print "Failed to write transfer data: %s" % e
-            self.put_file_data(self, partfilename, data)
+            f = file(partfilename, "wb")
+            f.write(data)
+            f.close()
             return None
 
         if self.stats["recv_size"] != self.stats["total_size"]:
@@ -220,12 +592,152 @@ class FileTransferSession(stateful.StatefulSession):
             self.status(_("Complete"))
             return filename
 
+    def recv_file_stream(self, dir):
+        """Receives a file sent by send_file_stream().  Each chunk is
+        checked against its hash and written into place in a .part file,
+        and a ChunkIndex next to it records which chunks are done, so a
+        transfer that breaks only has to fetch the rest next time.  The
+        finished file is checked against the hash in the offer."""
+        offer = self.recv_offer()
+        if not offer or len(offer) < OFFER_SIZE:
+            return None
+
+        size, chunk_size, digest = struct.unpack(OFFER_FORMAT,
+                                                 offer[:OFFER_SIZE])
+        name = offered_name(offer[OFFER_SIZE:])
+        if not name:
+            print "Refusing offer of `%s'" % offer[OFFER_SIZE:]
+            self.status(_("Invalid file name offered"))
+            return None
+
+        if os.path.isdir(dir):
+            filename = os.path.join(dir, name)
+        else:
+            filename = dir
+
+        if self.take_from_store(digest, filename):
+            print "Already have %s, not receiving it again" % name
+            try:
+                self.write("HAVE")
+            except base.SessionClosedError, e:
+                print "Session closed while sending start ack"
+            self.stats["recv_size"] = self.stats["total_size"] = size
+            self.status(_("Complete") + " (" + _("already there") + ")")
+            return filename
+
+        partfilename = filename + ".part"
+
+        index = ChunkIndex(partfilename + ".idx", size, chunk_size, digest)
+        try:
+            part = index.open_part(partfilename)
+        except Exception, e:
+            print "Unable to open %s: %s" % (partfilename, e)
+            return None
+
+        self.status(_("Receiving file") + \
+                        " %s " % name + \
+                        _("of size") + \
+                        " %i" % size)
+        self.stats["start_time"] = time.time()
+
+        if index.have:
+            print "Part file has %i of %i chunks" % (len(index.have),
+                                                     index.chunks)
+            resume = encode_bitmap(index.have, index.chunks)
+        else:
+            resume = None
+        if not self.send_start(resume):
+            part.close()
+            return None
+
+        self.status(_("Waiting for first block"))
+
+        wanted = size - index.get_size()
+        received = 0
+        ok = True
+        buf = bytearray()
+
+        while ok:
+            try:
+                self.readinto(buf)
+            except base.SessionClosedError:
+                print "SESSION IS CLOSED"
+                break
+
+            # Take every whole chunk record out of what we have so far
+            while len(buf) >= CHUNK_HDR_SIZE:
+                i, zsize, chunk_digest = struct.unpack(\
+                    CHUNK_FORMAT, str(buf[:CHUNK_HDR_SIZE]))
+                if len(buf) < CHUNK_HDR_SIZE + zsize:
+                    break
+
+                zchunk = str(buf[CHUNK_HDR_SIZE:CHUNK_HDR_SIZE + zsize])
+                del buf[:CHUNK_HDR_SIZE + zsize]
+
+                try:
+                    if self._proto < base.PROTO_CODEC:
+                        codec = ddt2.CODEC_ZLIB
+                    elif zchunk:
+                        codec = ord(zchunk[0])
+                        zchunk = zchunk[1:]
+                    else:
+                        raise ChunkError("No codec")
+                    received += index.store(part, i, zchunk, chunk_digest,
+                                            codec)
+                except ChunkError, e:
+                    print "Dropping chunk %i: %s" % (i, e)
+                except Exception, e:
+                    print "Failed to write transfer data: %s" % e
+                    ok = False
+                    break
+
+            # The session counts compressed bytes; scale the total so the
+            # progress tracks the file
+            if received:
+                self.stats["total_size"] = \
+                    self.stats["recv_size"] * wanted / received
+            self.status(_("Receiving"))
+
+            if index.is_complete():
+                # Nothing more is coming, so don't wait for the sender
+                # to close (it might want to hear from us first)
+                break
+
+        part.close()
+
+        if not ok or not index.is_complete():
+            self.status(_("Failed to receive file (incomplete)"))
+            return None
+
+        if file_digest(partfilename) != digest:
+            print "Received file does not match its hash, starting over"
+            index.discard(partfilename)
+            self.status(_("Failed to receive file (corrupted)"))
+            return None
+
+        try:
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(partfilename, filename)
+            index.remove()
+        except Exception, e:
+            print "Failed to move %s into place: %s" % (partfilename, e)
+            return None
+
+        store = self.get_content_store()
+        if store:
+            store.add(filename, digest)
+
+        self.stats["recv_size"] = self.stats["total_size"] = size
+        self.status(_("Complete"))
+        return filename
+
     def get_file_data(self, filename):
         f = file(filename, "rb")
         data = f.read()
         f.close()
 
-        return zlib.compress(data, 9)
+        return deflate(data)
 
     def put_file_data(self, filename, zdata):
         try:
@@ -1,4 +1,186 @@
+import os
+import time
+import glob
+import hashlib
+
+from d_rats import transport
 from d_rats.sessions import base, file
 
+# A bundle is this line, a manifest with a "size name" line for each
+# form, a blank line, and then the forms themselves back to back
+BATCH_MAGIC = "D-RATS form batch 1\n"
+
+# How long (in half seconds) the sender waits for the receiver to say
+# which forms it took, once the bundle is across
+BATCH_ACK_TRIES = 120
+
+# Pieces of bundles that have been left this long are not coming back
+BATCH_MAX_AGE = 24 * 3600
+
+class BatchError(Exception):
+    pass
+
+def pack_forms(filenames, dir):
+    """Packs the forms into a bundle in dir, named for what is in it so
+    that another try at sending the same forms picks up where the last
+    one left off.  Returns the bundle's filename"""
+    manifest = BATCH_MAGIC
+    forms = []
+    for fn in filenames:
+        f = open(fn, "rb")
+        data = f.read()
+        f.close()
+
+        manifest += "%i %s\n" % (len(data), os.path.basename(fn))
+        forms.append(data)
+
+    data = manifest + "\n" + "".join(forms)
+    bundle = os.path.join(dir,
+                          "batch_%s" % hashlib.sha1(data).hexdigest()[:16])
+    f = open(bundle, "wb")
+    f.write(data)
+    f.close()
+
+    return bundle
+
+def unpack_forms(bundle):
+    """Returns a list of the (name, data) of the forms in bundle"""
+    f = open(bundle, "rb")
+    try:
+        if f.readline() != BATCH_MAGIC:
+            raise BatchError("Not a form batch")
+
+        manifest = []
+        while True:
+            line = f.readline()
+            if not line:
+                raise BatchError("Manifest is truncated")
+            elif line == "\n":
+                break
+
+            try:
+                size, name = line.rstrip("\n").split(" ", 1)
+                manifest.append((os.path.basename(name), int(size)))
+            except ValueError:
+                raise BatchError("Bad manifest line `%s'" % line.strip())
+
+        forms = []
+        for name, size in manifest:
+            data = f.read(size)
+            if len(data) != size:
+                raise BatchError("Form %s is truncated" % name)
+            forms.append((name, data))
+    finally:
+        f.close()
+
+    return forms
+
+def prune_batches(dir, age=BATCH_MAX_AGE):
+    """Removes what is left of bundles in dir that were never finished"""
+    for fn in glob.glob(os.path.join(dir, "batch_*")):
+        try:
+            if (time.time() - os.stat(fn).st_mtime) > age:
+                print "Removing stale batch file %s" % fn
+                os.remove(fn)
+        except OSError, e:
+            print "Unable to remove %s: %s" % (fn, e)
+
 class FormTransferSession(file.FileTransferSession):
     type = base.T_FORMXFER
+    priority = transport.PRI_FORM
+
+class FormBatchSession(FormTransferSession):
+    """Carries several forms bound for the same station in one bundle,
+    sent as a single file.  Once the receiver has filed the forms away
+    it says which of them it took, so each form can be accounted for on
+    its own.  Only peers that speak PROTO_BATCH know this session."""
+    type = base.T_FORMBATCH
+
+    def wait_for_acks(self, count):
+        """Waits for the remote to say which of the count forms it took.
+        Returns a string with a "1" (taken) or "0" for each, or None if
+        we didn't hear."""
+        resp = ""
+        for i in range(BATCH_ACK_TRIES):
+            try:
+                resp += self.read()
+            except base.SessionClosedError, e:
+                print "Session closed while waiting for form acks"
+                return None
+
+            if resp and not "ACK:".startswith(resp[:4]):
+                print "Got unknown form ack: `%s'" % resp
+                resp = ""
+            elif len(resp) >= len("ACK:") + count:
+                return resp[len("ACK:"):len("ACK:") + count]
+
+            time.sleep(0.5)
+
+        print "Did not get form acks"
+        return None
+
+    def send_forms(self, filenames, dir):
+        """Sends the forms as one bundle, packed in dir, and returns the
+        ones the remote took"""
+        try:
+            bundle = pack_forms(filenames, dir)
+        except Exception, e:
+            print "Unable to pack forms: %s" % e
+            self.close()
+            return []
+
+        acks = None
+        try:
+            if self.send_file_stream(bundle, close=False):
+                acks = self.wait_for_acks(len(filenames))
+        finally:
+            self.close()
+            if os.path.exists(bundle):
+                os.remove(bundle)
+
+        if not acks:
+            self.status(_("Failed to send forms (no acknowledgement)"))
+            return []
+
+        taken = [fn for fn, ack in zip(filenames, acks) if ack == "1"]
+        self.status(_("Complete") + " (%i/%i)" % (len(taken),
+                                                   len(filenames)))
+        return taken
+
+    def recv_forms(self, dir, store_fn):
+        """Receives a bundle of forms into dir, and hands each to
+        store_fn(name, data) to file away.  Tells the sender which ones
+        store_fn took (by returning True), and returns how many forms
+        there were, or None if we didn't get them."""
+        prune_batches(dir)
+
+        bundle = self.recv_file(dir)
+        if not bundle:
+            return None
+
+        try:
+            forms = unpack_forms(bundle)
+        except Exception, e:
+            print "Unable to unpack %s: %s" % (bundle, e)
+            forms = None
+        os.remove(bundle)
+
+        if forms is None:
+            self.status(_("Failed to receive forms (corrupted)"))
+            return None
+
+        acks = ""
+        for name, data in forms:
+            try:
+                taken = store_fn(name, data)
+            except Exception, e:
+                print "Unable to store form %s: %s" % (name, e)
+                taken = False
+            acks += taken and "1" or "0"
+
+        try:
+            self.write("ACK:" + acks)
+        except base.SessionClosedError, e:
+            print "Session closed while sending form acks"
+
+        return len(forms)
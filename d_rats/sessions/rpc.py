@@ -23,7 +23,7 @@ import sys
 
 import gobject
 
-from d_rats import ddt2, signals, emailgw, wl2k, gps
+from d_rats import ddt2, signals, emailgw, wl2k, gps, transport
 
 # This feels wrong
 from d_rats.ui import main_events
@@ -179,6 +179,10 @@ class RPCGetVersion(RPCJob):
     def do(self, rpcactions):
         return rpcactions.RPC_get_version(self)
 
+class RPCTransferQueue(RPCJob):
+    def do(self, rpcactions):
+        return rpcactions.RPC_xfer_queue(self)
+
 class RPCCheckMail(RPCJob):
     def do(self, rpcactions):
         return rpcactions.RPC_check_mail(self)
@@ -197,6 +201,7 @@ class RPCCheckMail(RPCJob):
 
 class RPCSession(gobject.GObject, stateless.StatelessSession):
     type = base.T_RPC
+    priority = transport.PRI_RPC
 
     T_RPCREQ = 0
     T_RPCACK = 1
@@ -303,7 +308,7 @@ class RPCSession(gobject.GObject, stateless.StatelessSession):
 
     def __worker(self):
         for id, (ts, att, job) in self.__jobs.items():
-            if job.frame and not job.frame.sent_event.isSet():
+            if job.frame and not job.frame.is_sent():
                 # Reset timer until the block is sent
                 self.__jobs[id] = (time.time(), att, job)
             elif (time.time() - ts) > self.__t_retry:
@@ -326,6 +331,7 @@ class RPCActionSet(gobject.GObject):
         "rpc-send-file" : signals.RPC_SEND_FILE,
         "rpc-send-form" : signals.RPC_SEND_FORM,
         "get-message-list" : signals.GET_MESSAGE_LIST,
+        "get-transfer-queue" : signals.GET_TRANSFER_QUEUE,
         "get-current-position" : signals.GET_CURRENT_POSITION,
         "user-send-chat" : signals.USER_SEND_CHAT,
         "event" : signals.EVENT,
@@ -520,6 +526,18 @@ class RPCActionSet(gobject.GObject):
 
         return result
 
+    def RPC_xfer_queue(self, job):
+        result = {}
+
+        jobs = self.emit("get-transfer-queue", self.__port)
+        for i, xfer in enumerate(jobs):
+            result["%02i" % (i + 1)] = str(xfer)
+
+        if not jobs:
+            result["rc"] = "No transfers queued"
+
+        return result
+
     def RPC_check_mail(self, job):
         def check_done(mt, success, message, job):
             result = { "rc"  : success and "0" or "-1",
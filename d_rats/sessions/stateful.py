@@ -16,9 +16,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import threading
+import struct
 import time
 
-from d_rats import transport
+from d_rats import transport, congestion
 from d_rats.ddt2 import DDT2EncodedFrame
 from d_rats.sessions import base
 
@@ -28,18 +29,171 @@ T_NAK    = 2
 T_DAT    = 4
 T_REQACK = 5
 
+SEQ_MOD16 = 1 << 16
+
+# Seconds a writer waits on a block before checking the session is still
+# there
+WAIT_SLICE = 1.0
+
+def encode_block_list(blocks):
+    """Packs a list of 16-bit block numbers as the first one, followed by
+    a bitmap of the offsets of all of them from it"""
+    if not blocks:
+        return ""
+
+    first = blocks[0]
+    offsets = [(b - first) % SEQ_MOD16 for b in blocks]
+    bitmap = [0] * (max(offsets) / 8 + 1)
+    for offset in offsets:
+        bitmap[offset / 8] |= 1 << (offset % 8)
+
+    return struct.pack("!H", first) + "".join([chr(x) for x in bitmap])
+
+def decode_block_list(data):
+    if len(data) < 2:
+        return []
+
+    first, = struct.unpack("!H", data[:2])
+    blocks = []
+    for i in range(2, len(data)):
+        bits = ord(data[i])
+        for bit in range(0, 8):
+            if bits & (1 << bit):
+                blocks.append((first + ((i - 2) * 8) + bit) % SEQ_MOD16)
+
+    return blocks
+
+class ReceiveRing(object):
+    """Blocks that arrived ahead of a gap, filed by their distance from
+    the next block we expect.  Filing a block, checking for one and
+    taking the ones that became in-order are all constant time per
+    block.  The ring grows if the remote gets further ahead than it has
+    room for."""
+
+    def __init__(self, modulus, size=16):
+        self.modulus = modulus
+        self._slots = [None] * size
+        self._head = 0 # Slot of the next expected block
+        self._next = 0 # Sequence number of the next expected block
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _offset(self, seq):
+        return (seq - self._next) % self.modulus
+
+    def _slot(self, offset):
+        return (self._head + offset) % len(self._slots)
+
+    def _grow(self, offset):
+        size = len(self._slots)
+        while size <= offset:
+            size *= 2
+
+        old = self._slots
+        self._slots = [None] * min(size, self.modulus)
+        for i in range(0, len(old)):
+            self._slots[i] = old[(self._head + i) % len(old)]
+        self._head = 0
+
+    def has(self, seq):
+        offset = self._offset(seq)
+        if offset >= len(self._slots):
+            return False
+        return self._slots[self._slot(offset)] is not None
+
+    def add(self, seq, block):
+        offset = self._offset(seq)
+        if offset >= len(self._slots):
+            self._grow(offset)
+
+        slot = self._slot(offset)
+        if self._slots[slot] is None:
+            self._count += 1
+        self._slots[slot] = block
+
+    def pop_ready(self):
+        """Removes and returns the blocks that are now in order"""
+        ready = []
+        while self._slots[self._head] is not None:
+            ready.append(self._slots[self._head])
+            self._slots[self._head] = None
+            self._head = (self._head + 1) % len(self._slots)
+            self._next = (self._next + 1) % self.modulus
+        self._count -= len(ready)
+
+        return ready
+
+    def keys(self):
+        return [(self._next + i) % self.modulus
+                for i in range(0, len(self._slots))
+                if self._slots[self._slot(i)] is not None]
+
+class ReadBuffer(object):
+    """Received bytes waiting for the reader.  Blocks go in as they come
+    into order and are read out in whatever sizes the reader wants,
+    without joining or splitting blocks on every read."""
+
+    # Give back the space of data already read once there is this much
+    COMPACT_SIZE = 1 << 16
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._buf) - self._pos
+
+    def append(self, data):
+        self._buf += data
+
+    def _end(self, count):
+        if count is None:
+            return len(self._buf)
+        else:
+            return min(self._pos + count, len(self._buf))
+
+    def _consume(self, end):
+        if end == len(self._buf):
+            self._buf = bytearray()
+            self._pos = 0
+        elif end >= self.COMPACT_SIZE:
+            del self._buf[:end]
+            self._pos = 0
+        else:
+            self._pos = end
+
+    def read(self, count=None):
+        """Returns up to count bytes (or all of them if count is None)"""
+        end = self._end(count)
+        data = str(self._buf[self._pos:end])
+        self._consume(end)
+
+        return data
+
+    def readinto(self, buf, count=None):
+        """Appends up to count bytes to the caller's bytearray, and
+        returns the number of bytes added"""
+        end = self._end(count)
+        size = end - self._pos
+        buf += buffer(self._buf, self._pos, size)
+        self._consume(end)
+
+        return size
+
 class StatefulSession(base.Session):
     stateless = False
     type = base.T_GENERAL
-
+    compress = True
 
     IDLE_TIMEOUT = 90
 
     def __init__(self, name, **kwargs):
         base.Session.__init__(self, name)
         self.outq = transport.BlockQueue()
-        self.oob_queue = {}
-        self.recv_list = []
+        self.oob_queue = None
+        self.received = set()
         self.outstanding = []
         self.waiting_for_ack = []
 
@@ -51,16 +205,23 @@ class StatefulSession(base.Session):
         self.iseq = -1
         self.oseq = 0
 
-        self.data = transport.BlockQueue()
+        self.data = ReadBuffer()
         self.data_waiting = threading.Condition()
 
         self.__attempts = 0
         self.__ack_timeout = 0
-        self.__full_acks = 0
+        self.__cc = None
 
         self._rtr = 0.0 # Round trip rate (bps)
         self._xmt = 0.0 # Transmit rate (bps)
         self._xms = 0.0 # Start of last transmit of self.outstanding[]
+        self._xme = 0.0 # End of it
+        self._timeout_left = 1.0
+
+        # Blocks of the last burst the transport hasn't sent yet
+        self._unsent = []
+        self._burst_retransmit = False
+        self._last_activity = time.time()
 
         self._rtt_measure = {
             "bnum"  : -1,
@@ -69,60 +230,111 @@ class StatefulSession(base.Session):
             "size"  :  0,
             }
 
-        self.event = threading.Event()
-        self.thread = threading.Thread(target=self.worker)
-        self.thread.setDaemon(True)
-        self.thread.start()
-
     def notify(self):
-        self.event.set()
+        self._last_activity = time.time()
+        if self._sm:
+            self._sm.scheduler.wake(self)
+
+    def set_state(self, state):
+        base.Session.set_state(self, state)
+
+        # Let a blocked reader see the change right away
+        self.data_waiting.acquire()
+        self.data_waiting.notifyAll()
+        self.data_waiting.release()
+
+    def get_congestion(self):
+        """Returns the congestion controller for this session, made from
+        the profile of the path it runs over"""
+        if self.__cc is None:
+            if not self._sm:
+                # Not registered with a session manager yet, so we don't
+                # know the path; don't keep this one
+                return congestion.PathProfile().make_controller(\
+                    self.bsize, self.out_limit)
+
+            self.__cc = self._sm.path_profile.make_controller(self.bsize,
+                                                              self.out_limit)
+
+        return self.__cc
+
+    def update_cc_stats(self):
+        # Bypass any per-key notification on self.stats
+        self.stats.update(self.get_congestion().get_stats())
+
+    def seq_modulus(self):
+        if self._proto >= base.PROTO_SACK16:
+            return SEQ_MOD16
+        else:
+            return 256
+
+    def pack_block_list(self, blocks):
+        if self._proto >= base.PROTO_SACK16:
+            return encode_block_list(blocks)
+        else:
+            return "".join([chr(x) for x in blocks])
+
+    def unpack_block_list(self, data):
+        if self._proto >= base.PROTO_SACK16:
+            return decode_block_list(data)
+        else:
+            return [ord(x) for x in data]
+
+    def get_oob_queue(self):
+        # Made on first use, because the protocol (and so the sequence
+        # space) is only settled once the session is open
+        if self.oob_queue is None:
+            self.oob_queue = ReceiveRing(self.seq_modulus())
+
+        return self.oob_queue
+
+    def is_received(self, seq):
+        if self._proto < base.PROTO_SACK16:
+            return seq in self.received
+
+        if self.get_oob_queue().has(seq):
+            return True
+        elif self.iseq < 0:
+            return False
+
+        # Anything in the half of the sequence space behind the last
+        # in-order block has already been delivered
+        return ((self.iseq - seq) % SEQ_MOD16) < (SEQ_MOD16 / 2)
 
     def close(self, force=False):
-        print "Got close request, joining thread..."
+        print "Got close request, leaving scheduler..."
         self.enabled = False
-        self.notify()
+        if self._sm:
+            self._sm.scheduler.remove(self)
 
         # Free up any block listeners
         if isinstance(self.outstanding, list):
             for b in self.outstanding:
-                b.sent_event.set()
-                b.sent_event.clear()
-                b.ackd_event.set()
+                b.set_sent()
+                b.clear_sent()
+                b.set_ackd()
                 
         elif self.outstanding:
             b.sent_event.set()                
 
-        self.thread.join()
-        print "Thread is done, continuing with close"
+        # Pipelined writers may be waiting on blocks that never made it
+        # out of the queue
+        for b in self.outq.dequeue_all():
+            b.set_sent()
+            b.clear_sent()
+            b.set_ackd()
+
+        print "Session is idle, continuing with close"
 
         base.Session.close(self, force)
 
     def queue_next(self):
-        if self.outstanding is None:
-            # This is a silly race condition because the worker thread is
-            # started in the init, which might run before we set our values
-            # after the superclass init
-            return
-
-        limit = self.out_limit
-        if self.__full_acks > 0:
-            limit += self.__full_acks
-        elif self.__full_acks < 0:
-            limit -= abs(self.__full_acks)
-
-        # Hard limit of 4KB outstanding (should be per-path!)
-        hardlimit = (1 << 12) / self.bsize
-
-        if limit < 2:
-            limit = 2
-        elif limit > hardlimit:
-            limit = hardlimit
+        limit = self.get_congestion().window()
 
         count = limit - len(self.outstanding)
-        print "New limit is %i (%i/%i), queueing %i" % (limit,
-                                                        self.out_limit,
-                                                        hardlimit,
-                                                        count)
+        print "New limit is %i (%i), queueing %i" % (limit,
+                                                     self.out_limit,
+                                                     count)
         if count < 0:
             # Need to requeue some blocks to shrink our window
             print "Need to requeue %i blocks to shrink window" % abs(count)
@@ -136,7 +348,8 @@ class StatefulSession(base.Session):
             for i in range(count):
                 b = self.outq.dequeue()
                 if b:
-                    if b.seq == 0 and self.outstanding:
+                    if b.seq == 0 and self.outstanding and \
+                            self._proto < base.PROTO_SACK16:
                         print "### Pausing at rollover boundary ###"
                         self.outq.requeue(b)
                         break
@@ -147,9 +360,15 @@ class StatefulSession(base.Session):
                     break
 
     def is_timeout(self):
+        self._timeout_left = 1.0
+
         if self._xms == 0:
             return True
 
+        if self._unsent:
+            # The transport is still working on the last burst
+            return False
+
         pending_size = 0
         for block in self.outstanding:
             pending_size += block._xmit_z
@@ -157,40 +376,40 @@ class StatefulSession(base.Session):
         if pending_size == 0:
             return True
 
-        if self._rtr != 0:
-            rate = self._rtr
+        cc = self.get_congestion()
+        timeout = cc.timeout(pending_size, self._rtr)
+        if cc.time_from_burst_end:
+            since = self._xme
         else:
-            # No measured rate yet so assume the minimum rate
-            rate = 80
-
-        timeout = (pending_size / rate) * 1.5
-        if timeout < 12:
-            # Don't allow small outgoing buffers to fool us into thinking
-            # there is no turnaround delay
-            timeout = 12
+            since = self._xms
 
         print "## Timeout for %i bytes @ %i bps: %.1f sec" % (pending_size,
-                                                              rate,
+                                                              self._rtr,
                                                               timeout)
-        print "##  Remaining: %.1f sec" % (timeout - (time.time() - self._xms))
+        print "##  Remaining: %.1f sec" % (timeout - (time.time() - since))
 
         if self.__attempts:
-            print "## Waiting for ACK, timeout in %i" % (self.__ack_timeout -
-                                                         time.time())
-            return (self.__ack_timeout - time.time()) <= 0
+            remaining = self.__ack_timeout - time.time()
+            print "## Waiting for ACK, timeout in %i" % remaining
         else:
-            return (timeout - (time.time() - self._xms)) <= 0
+            remaining = timeout - (time.time() - since)
+
+        self._timeout_left = remaining
+        return remaining <= 0
 
     def send_reqack(self, blocks):
         f = DDT2EncodedFrame()
         f.seq = 0
         f.type = T_REQACK
-        # FIXME: This needs to support 16-bit block numbers!
-        f.data = "".join([chr(x) for x in blocks])
+        # Not PRI_CONTROL: this has to go out behind the blocks it asks
+        # about, or the remote acks only the ones it has so far
+        f.data = self.pack_block_list(blocks)
 
         print "Requesting ack of blocks %s" % blocks
         self._sm.outgoing(self, f)
 
+        return f
+
     def send_blocks(self):
         if self.outstanding and not self.is_timeout():
             # Not time to try again yet
@@ -214,12 +433,12 @@ class StatefulSession(base.Session):
         if self.waiting_for_ack:
             print "Didn't get last ack, asking again"
             self.send_reqack(self.waiting_for_ack)
-            if self.__full_acks > 0:
-                self.__full_acks = 0
-            else:
-                self.__full_acks -= 1
+            cc = self.get_congestion()
+            cc.timed_out()
+            self.update_cc_stats()
             self.__attempts += 1
-            self.__ack_timeout = time.time() + 4 + (self.__attempts * 4)
+            self.__ack_timeout = time.time() + \
+                cc.ack_timeout(self.__attempts)
             return
 
         toack = []
@@ -229,40 +448,70 @@ class StatefulSession(base.Session):
 
         self._xms = time.time()
 
-        last_block = None
+        self._burst_retransmit = False
         for b in self.outstanding:
-            if b.sent_event.isSet():
+            if b.is_sent():
+                self._burst_retransmit = True
                 self.stats["retries"] += 1
-                b.sent_event.clear()
+                b.clear_sent()
 
             print "Sending %i" % b.seq
             self._sm.outgoing(self, b)
             toack.append(b.seq)
-            t = time.time()
 
-            if last_block:
-                last_block.sent_event.wait()
-                self.update_xmt(last_block)
-                self.stats["sent_wire"] += len(last_block.data)
+        # The burst isn't over until the REQACK is out too; on a busy port
+        # that can be a while after our last block
+        self._unsent = list(self.outstanding)
+        self._unsent.append(self.send_reqack(toack))
+        self.waiting_for_ack = toack
 
-            last_block = b
+    def account_sent(self):
+        """Accounts for the blocks of the last burst that the transport has
+        sent since we last looked.  Returns True if it is still sending."""
+        if not self._unsent:
+            return False
 
-        self.send_reqack(toack)
-        self.waiting_for_ack = toack
+        # The transport sends a session's blocks in order
+        while self._unsent and self._unsent[0].is_sent():
+            b = self._unsent.pop(0)
+            if b.type == T_DAT:
+                self.update_xmt(b)
+                self.stats["sent_wire"] += len(b.data)
+
+        if self._unsent:
+            return True
 
-        print "Waiting for block to be sent"
-        last_block.sent_event.wait()
         self._xme = time.time()
-        self.update_xmt(last_block)
-        self.stats["sent_wire"] += len(last_block.data)
-        self.ts = time.time()
-        print "Block sent after: %f" % (self.ts - t)
+        print "Burst sent after: %f" % (self._xme - self._xms)
+
+        size = 0
+        for b in self.outstanding:
+            size += b._xmit_z
+        cc = self.get_congestion()
+        if cc.time_from_burst_end:
+            start = self._xme
+        else:
+            start = self._xms
+        cc.sent(start, size, self._burst_retransmit)
+
+        return False
+
+    def estimate_unsent_time(self):
+        size = 0
+        for b in self._unsent:
+            size += len(b.data)
+
+        if self._xmt:
+            return size / self._xmt
+        else:
+            return 0.25
 
     def send_ack(self, blocks):
         f = DDT2EncodedFrame()
         f.seq = 0
         f.type = T_ACK
-        f.data = "".join([chr(x) for x in blocks])
+        f.priority = transport.PRI_CONTROL
+        f.data = self.pack_block_list(blocks)
 
         print "Acking blocks %s (%s)" % (blocks,
                                          {"" : f.data})
@@ -273,64 +522,66 @@ class StatefulSession(base.Session):
         blocks = self.inq.dequeue_all()
         blocks.reverse()
 
-        def next(i):
-            # FIXME: For 16 bit blocks
-            return (i + 1) % 256
-
-        def enqueue(_block):
-            self.data_waiting.acquire()
-            self.data.enqueue(_block.data)
-            self.iseq = _block.seq
-            self.data_waiting.notify()
-            self.data_waiting.release()
+        oob_queue = self.get_oob_queue()
 
         for b in blocks:
-            self._rtt_measure["size"] += len(b.get_packed())
+            self._rtt_measure["size"] += b._xmit_z
             if b.type == T_ACK:
-                self.__attempts = 0
-                self._rtt_measure["end"] = time.time()
-                self.waiting_for_ack = False
-                acked = [ord(x) for x in b.data]
+                # While the REQACK for our last burst is still queued, an
+                # ACK can only be answering an earlier one (one we asked
+                # for twice, say), so it says nothing about what is
+                # missing from this burst
+                stale = bool(self._unsent)
+                acked = self.unpack_block_list(b.data)
                 print "Acked blocks: %s (/%i)" % (acked, len(self.outstanding))
+                acked_size = 0
                 for block in self.outstanding[:]:
                     self._rtt_measure["size"] += block._xmit_z
                     if block.seq in acked:
-                        block.ackd_event.set()
+                        block.set_ackd()
+                        acked_size += len(block.data)
                         self.stats["sent_size"] += len(block.data)
                         self.outstanding.remove(block)
                     else:
                         print "Block %i outstanding, but not acked" % block.seq
+                cc = self.get_congestion()
                 if len(self.outstanding) == 0:
                     print "This ACKed every block"
-                    if self.__full_acks >= 0:
-                        self.__full_acks += 1
-                    else:
-                        self.__full_acks = 0
+                    # Nothing in flight, so new data can go right away
+                    self._xms = 0
+                elif stale:
+                    print "This answered an earlier REQACK"
+                    continue
                 else:
                     print "This was not a full ACK"
-                    if self.__full_acks > 0:
-                        self.__full_acks = 0
-                    else:
-                        self.__full_acks -= 1
+                    if cc.fast_retransmit:
+                        # The remote has seen our REQACK, so anything it
+                        # didn't ack was lost; resend it now
+                        self._xms = 0
+                self.__attempts = 0
+                self._rtt_measure["end"] = time.time()
+                self.waiting_for_ack = False
+                cc.acked(acked_size, len(self.outstanding) == 0)
+                self.update_cc_stats()
             elif b.type == T_DAT:
                 print "Got block %i" % b.seq
-                # FIXME: For 16-bit blocks
-                if b.seq == 0 and self.iseq == 255:
+                if b.seq == 0 and self.iseq == 255 and \
+                        self._proto < base.PROTO_SACK16:
                     # Reset received list, because remote will only send
                     # a block 0 following a block 255 if it has received
                     # our ack of the previous 0-255
-                    self.recv_list = []
+                    self.received.clear()
 
-                if b.seq not in self.recv_list:
-                    self.recv_list.append(b.seq)
+                if not self.is_received(b.seq):
+                    if self._proto < base.PROTO_SACK16:
+                        self.received.add(b.seq)
                     self.stats["recv_size"] += len(b.data)
-                    self.oob_queue[b.seq] = b
+                    oob_queue.add(b.seq, b)
             elif b.type == T_REQACK:
                 toack = []
 
-                # FIXME: This needs to support 16-bit block numbers!
-                for i in [ord(x) for x in b.data]:
-                    if i in self.recv_list:
+                for i in self.unpack_block_list(b.data):
+                    if self.is_received(i):
                         print "Acking block %i" % i
                         toack.append(i)
                     else:
@@ -340,16 +591,19 @@ class StatefulSession(base.Session):
             else:
                 print "Got unknown type: %i" % b.type
 
-        if self.oob_queue:
-            print "Waiting OOO blocks: %s" % self.oob_queue.keys()
-
         # Process any OOO blocks, if we should
-        while next(self.iseq) in self.oob_queue.keys():
-            block = self.oob_queue[next(self.iseq)]
-            print "Queuing now in-order block %i: %s" % (next(self.iseq),
-                                                         block)
-            del self.oob_queue[next(self.iseq)]
-            enqueue(block)            
+        ready = oob_queue.pop_ready()
+        if ready:
+            self.data_waiting.acquire()
+            for block in ready:
+                print "Queuing now in-order block %i: %s" % (block.seq, block)
+                self.data.append(block.data)
+            self.iseq = ready[-1].seq
+            self.data_waiting.notify()
+            self.data_waiting.release()
+
+        if oob_queue:
+            print "Waiting OOO blocks: %s" % oob_queue.keys()
 
     def update_xmt(self, block):
         self._xmt = (self._xmt + block.get_xmit_bps()) / 2.0
@@ -375,72 +629,77 @@ class StatefulSession(base.Session):
         self._rtt_measure["size"] = 0
         self._rtt_measure["bnum"] = -1
 
-    def worker(self):
-        while self.enabled:
-            self.send_blocks()
-            self.recv_blocks()
+    def service(self):
+        """Does whatever the session has to do right now and arms its
+        timers for the next time it needs to run.  This is called from
+        the session manager's scheduler when the session is woken or one
+        of its timers expires."""
+        if not self.enabled:
+            return
 
-            if self._rtt_measure["end"]:
-                self.calculate_rtt()
+        self.account_sent()
+        self.send_blocks()
+        self.recv_blocks()
 
-            if not self.outstanding and self.outq.peek():
-                print "Short-circuit"
-                continue # Short circuit because we have things to send
+        if self._rtt_measure["end"]:
+            self.calculate_rtt()
 
-            print "Session loop (%s:%s)" % (self._id, self.name)
+        if not self.enabled:
+            return
 
-            if self.outstanding:
-                print "Outstanding data, short sleep"
-                self.event.wait(1)
+        now = time.time()
+        sched = self._sm.scheduler
+
+        if not self.outstanding and self.outq.peek():
+            print "Short-circuit"
+            sched.wake(self) # Come straight back because we have things to send
+
+        if self._unsent:
+            # Check back when the transport should be done with the burst
+            sched.set_timer(self, "sent",
+                            now + min(1.0, max(0.05,
+                                               self.estimate_unsent_time())))
+        elif self.outstanding:
+            self.is_timeout()
+            if self.__attempts:
+                sched.cancel_timer(self, "rto")
+                sched.set_timer(self, "ack", now + self._timeout_left)
             else:
-                print "Deep sleep"
-                self.event.wait(self.IDLE_TIMEOUT)
-                if not self.event.isSet():
-                    print "Session timed out!"
-                    self.set_state(base.ST_CLSD)
-                    self.enabled = False                    
-                else:
-                    print "Awoke from deep sleep to some data"
-                    
-            self.event.clear()
-            
-    def _block_read_for(self, count):
-        waiting = self.data.peek_all()
+                sched.cancel_timer(self, "ack")
+                sched.set_timer(self, "rto", now + self._timeout_left)
+        else:
+            sched.cancel_timer(self, "rto")
+            sched.cancel_timer(self, "ack")
 
-        if not count and not waiting:
-            self.data_waiting.wait(1)
-            return
+        if self.outstanding or self._unsent or self.IDLE_TIMEOUT is None:
+            sched.cancel_timer(self, "idle")
+        elif (now - self._last_activity) >= self.IDLE_TIMEOUT:
+            print "Session timed out!"
+            self.set_state(base.ST_CLSD)
+            self.enabled = False
+        else:
+            sched.set_timer(self, "idle",
+                            self._last_activity + self.IDLE_TIMEOUT)
 
-        if count > len("".join(waiting)):
+    def _block_read_for(self, count):
+        if len(self.data) < (count or 1):
             self.data_waiting.wait(1)
-            return
 
-    def _read(self, count):
+    def _read(self, count, buf=None):
         self.data_waiting.acquire()
 
         self._block_read_for(count)
 
-        if count == None:
-            b = self.data.dequeue_all()
-            # BlockQueue.dequeue_all() returns the blocks in poppable order,
-            # which is newest first
-            b.reverse()
-            buf = "".join(b)
+        if buf is None:
+            result = self.data.read(count)
         else:
-            buf = ""
-            i = 0
-            while True:
-                next = self.data.peek() or ''
-                if len(next) > 0 and (len(next) + i) < count:
-                    buf += self.data.dequeue()
-                else:
-                    break
+            result = self.data.readinto(buf, count)
 
         self.data_waiting.release()
 
-        return buf
+        return result
 
-    def read(self, count=None):
+    def _wait_open(self):
         while self.get_state() == base.ST_SYNC:
             print "Waiting for session to open"
             self.wait_for_state_change(5)
@@ -448,6 +707,11 @@ class StatefulSession(base.Session):
         if self.get_state() != base.ST_OPEN:
             raise base.SessionClosedError("State is %i" % self.get_state())
 
+    def read(self, count=None):
+        """Returns up to count bytes of received data (all of it, if count
+        is None), waiting a little while if there isn't that much yet"""
+        self._wait_open()
+
         buf = self._read(count)
 
         if not buf and self.get_state() != base.ST_OPEN:
@@ -455,51 +719,91 @@ class StatefulSession(base.Session):
 
         return buf
 
-    def write(self, buf, timeout=0):
-        while self.get_state() == base.ST_SYNC:
-            print "Waiting for session to open"
-            self.wait_for_state_change(5)
+    def readinto(self, buf, count=None):
+        """Like read(), but appends the data to the caller's bytearray and
+        returns the number of bytes added"""
+        self._wait_open()
 
-        if self.get_state() != base.ST_OPEN:
-            raise base.SessionClosedError("State is %s" % self.get_state())
+        size = self._read(count, buf)
 
-        blocks = []
+        if not size and self.get_state() != base.ST_OPEN:
+            raise base.SessionClosedError()
 
-        while buf:
-            chunk = buf[:self.bsize]
-            buf = buf[self.bsize:]
+        return size
+
+    def queue_write(self, buf):
+        """Queues buf for sending and returns the blocks it was split into,
+        without waiting for any of them to go out"""
+        self._wait_open()
+
+        blocks = []
 
+        for i in range(0, len(buf), self.bsize):
             f = DDT2EncodedFrame()
             f.seq = self.oseq
             f.type = T_DAT
-            f.data = chunk
-            f.sent_event.clear()
+            f.data = buf[i:i + self.bsize]
+            f.set_compress(self.compress)
 
             self.outq.enqueue(f)
             blocks.append(f)
 
-            self.oseq = (self.oseq + 1) % 256
+            self.oseq = (self.oseq + 1) % self.seq_modulus()
 
-        self.queue_next()
-        self.event.set()
+        # The scheduler moves the blocks to the wire from here
+        self.notify()
+
+        return blocks
+
+    def _wait_event(self, event, timeout=None):
+        """Waits for event (for up to timeout seconds, or for as long as
+        the session lasts if None), a slice at a time so that a session
+        closed under us is noticed.  Raises SessionClosedError if it is."""
+        if timeout is not None:
+            end = time.time() + timeout
+
+        while not event.isSet():
+            if not self.enabled or self.get_state() == base.ST_CLSD:
+                raise base.SessionClosedError()
+
+            if timeout is None:
+                wait = WAIT_SLICE
+            else:
+                wait = min(WAIT_SLICE, end - time.time())
+                if wait <= 0:
+                    break
+
+            event.wait(wait)
+
+        return event.isSet()
+
+    def wait_written(self, blocks, timeout=0):
+        """Waits for each of blocks to be sent and then acked (for up to
+        timeout seconds each).  Returns True if they all were, and raises
+        SessionClosedError if the session goes away first."""
+        blocks = list(blocks)
 
-        while timeout is not None and \
-                blocks and \
-                self.get_state() != base.ST_CLSD:
+        while blocks and self.get_state() != base.ST_CLSD:
             block = blocks[0]
             del blocks[0]
 
             print "Waiting for block %i to be ack'd" % block.seq
-            block.sent_event.wait()
+            self._wait_event(block.sent_event)
             if block.sent_event.isSet():
                 print "Block %i is sent, waiting for ack" % block.seq
-                block.ackd_event.wait(timeout)
+                self._wait_event(block.ackd_event, timeout)
                 if block.ackd_event.isSet() and block.sent_event.isSet():
                     print "%i ACKED" % block.seq
                 else:
                     print "%i Not ACKED (probably canceled)" % block.seq
-                    break
+                    return False
             else:
                 print "Block %i not sent?" % block.seq
 
+        return not blocks
+
+    def write(self, buf, timeout=0):
+        blocks = self.queue_write(buf)
 
+        if timeout is not None:
+            self.wait_written(blocks, timeout)
@@ -39,6 +39,13 @@ USER_SEND_FORM = \
       gobject.TYPE_STRING))     # Session name
 RPC_SEND_FORM = USER_SEND_FORM
 
+USER_SEND_FORMS = \
+    (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+     (gobject.TYPE_STRING,      # Station
+      gobject.TYPE_STRING,      # Port Name
+      gobject.TYPE_PYOBJECT,    # List of filenames
+      gobject.TYPE_STRING))     # Session name
+
 USER_SEND_FILE = \
     (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
      (gobject.TYPE_STRING,      # Station
@@ -164,6 +171,16 @@ FORM_SENT = \
      (gobject.TYPE_INT,          # Session ID
       gobject.TYPE_STRING))      # Filename
 
+TRANSFER_QUEUE_UPDATE = \
+    (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+     (gobject.TYPE_INT,          # Job ID
+      gobject.TYPE_STRING,       # Message
+      gobject.TYPE_BOOLEAN))     # Job has left the queue
+
+GET_TRANSFER_QUEUE = \
+    (gobject.SIGNAL_ACTION, gobject.TYPE_PYOBJECT,
+     (gobject.TYPE_STRING,))     # Port Name
+
 GET_CHAT_PORT = \
     (gobject.SIGNAL_ACTION, gobject.TYPE_STRING,
      ())
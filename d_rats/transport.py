@@ -21,30 +21,43 @@ import time
 import random
 import traceback
 import sys
+import os
+import select
+import errno
+import fcntl
+import collections
 
 import utils
 import ddt2
 import comm
 
+# Outgoing block priorities, most urgent first
+PRI_CONTROL = 0 # Session control and ACKs
+PRI_CHAT    = 1
+PRI_RPC     = 2
+PRI_FORM    = 3 # Form transfers
+PRI_BULK    = 4 # Other stateful data (file and socket transfers)
+PRIORITIES = [PRI_CONTROL, PRI_CHAT, PRI_RPC, PRI_FORM, PRI_BULK]
+
 class BlockQueue(object):
     def __init__(self):
         self._lock = threading.Lock()
-        self._queue = []
+        self._queue = collections.deque()
 
     def enqueue(self, block):
         self._lock.acquire()
-        self._queue.insert(0, block)
+        self._queue.append(block)
         self._lock.release()
 
     def requeue(self, block):
         self._lock.acquire()
-        self._queue.append(block)
+        self._queue.appendleft(block)
         self._lock.release()
 
     def dequeue(self):
         self._lock.acquire()
         try:
-            b = self._queue.pop()
+            b = self._queue.popleft()
         except IndexError:
             b = None
         self._lock.release()
@@ -52,18 +65,21 @@ class BlockQueue(object):
         return b
 
     def dequeue_all(self):
+        # Returned in the historical order (newest first), so callers
+        # that pop() from the result get the oldest block first
         self._lock.acquire()
-        l = self._queue
-        self._queue = []
+        l = list(self._queue)
+        self._queue.clear()
         self._lock.release()
 
+        l.reverse()
         return l
 
     def peek(self):
         self._lock.acquire()
         try:
             el = self._queue[0]
-        except:
+        except IndexError:
             el = None
         self._lock.release()
         
@@ -71,11 +87,27 @@ class BlockQueue(object):
 
     def peek_all(self):
         self._lock.acquire()
-        q = self._queue
+        q = list(self._queue)
         self._lock.release()
 
+        q.reverse()
         return q
 
+    def flush(self, predicate):
+        """Atomically removes and returns every queued block for which
+        predicate(block) is true"""
+        self._lock.acquire()
+        flushed = [b for b in self._queue if predicate(b)]
+        if flushed:
+            self._queue = collections.deque([b for b in self._queue
+                                             if not predicate(b)])
+        self._lock.release()
+
+        return flushed
+
+    def __len__(self):
+        return len(self._queue)
+
     # BE CAREFUL WITH THESE!
 
     def lock(self):
@@ -84,12 +116,434 @@ class BlockQueue(object):
     def unlock(self):
         self._lock.release()
 
+def block_priority(block):
+    if block.priority is None:
+        return PRI_BULK
+    return block.priority
+
+class PriorityBlockQueue(BlockQueue):
+    """A BlockQueue that always hands out the most urgent block first.
+    Within a priority class each session has its own sub-queue, and the
+    sessions take turns, so one transfer can't starve another and a whole
+    session can be dropped in one step.  The turns are measured in bytes
+    (deficit round robin), so a session sending big blocks gets no more
+    of the channel than one sending small ones."""
+
+    QUANTUM = 256
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._classes = dict([(p, collections.OrderedDict())
+                              for p in PRIORITIES])
+        self._deficit = {}
+        self._count = 0
+
+    def _subqueue(self, block):
+        sessions = self._classes[block_priority(block)]
+        try:
+            return sessions[block.session]
+        except KeyError:
+            q = sessions[block.session] = collections.deque()
+            return q
+
+    def enqueue(self, block):
+        self._lock.acquire()
+        self._subqueue(block).append(block)
+        self._count += 1
+        self._lock.release()
+
+    def requeue(self, block):
+        self._lock.acquire()
+        self._subqueue(block).appendleft(block)
+        self._count += 1
+        self._lock.release()
+
+    def _next_session(self):
+        for p in PRIORITIES:
+            sessions = self._classes[p]
+            for session, q in sessions.iteritems():
+                return sessions, session, q
+        return None, None, None
+
+    def _dequeue(self):
+        while True:
+            sessions, session, q = self._next_session()
+            if q is None:
+                return None
+
+            key = (block_priority(q[0]), session)
+            size = len(q[0].data or "")
+            credit = self._deficit.get(key, self.QUANTUM)
+            if credit >= size or len(sessions) == 1:
+                break
+
+            # Not enough credit yet: wait for the next turn, with more
+            self._deficit[key] = credit + self.QUANTUM
+            del sessions[session]
+            sessions[session] = q
+
+        b = q.popleft()
+        self._count -= 1
+        credit = max(credit - size, 0)
+
+        if not q:
+            del sessions[session]
+            self._deficit.pop(key, None)
+        elif credit < len(q[0].data or ""):
+            # Move this session to the back of the line for its class
+            del sessions[session]
+            sessions[session] = q
+            self._deficit[key] = credit + self.QUANTUM
+        else:
+            self._deficit[key] = credit
+
+        return b
+
+    def dequeue(self):
+        self._lock.acquire()
+        b = self._dequeue()
+        self._lock.release()
+
+        return b
+
+    def dequeue_all(self):
+        self._lock.acquire()
+        l = []
+        while self._count:
+            l.append(self._dequeue())
+        self._lock.release()
+
+        l.reverse()
+        return l
+
+    def peek(self):
+        self._lock.acquire()
+        sessions, session, q = self._next_session()
+        self._lock.release()
+
+        return q and q[0] or None
+
+    def peek_all(self):
+        self._lock.acquire()
+        l = []
+        for p in PRIORITIES:
+            for q in self._classes[p].values():
+                l += list(q)
+        self._lock.release()
+
+        l.reverse()
+        return l
+
+    def flush_session(self, session):
+        """Removes and returns every queued block for a session"""
+        self._lock.acquire()
+        flushed = []
+        for p in PRIORITIES:
+            q = self._classes[p].pop(session, None)
+            self._deficit.pop((p, session), None)
+            if q:
+                flushed += list(q)
+        self._count -= len(flushed)
+        self._lock.release()
+
+        return flushed
+
+    def flush(self, predicate):
+        self._lock.acquire()
+        flushed = []
+        for p in PRIORITIES:
+            sessions = self._classes[p]
+            for session, q in sessions.items():
+                keep = collections.deque()
+                for b in q:
+                    if predicate(b):
+                        flushed.append(b)
+                    else:
+                        keep.append(b)
+                if keep:
+                    sessions[session] = keep
+                else:
+                    del sessions[session]
+        self._count -= len(flushed)
+        self._lock.release()
+
+        return flushed
+
+    def __len__(self):
+        return self._count
+
+FRAME_EVENT = "frame"
+GPS_EVENT = "gps"
+TEXT_EVENT = "text"
+
+GPS_NMEA_RE = \
+    re.compile("((?:\$GP[^\*]+\*[A-f0-9]{2}\r?\n?){1,2}.{8},.{20})")
+GPS_APRS_RE = re.compile("(\$\$CRC[A-z0-9]{4},[^\r]*\r)")
+
+def make_text_frame(string):
+    """Wraps raw text (GPS sentences, compat-mode data) as a chat frame"""
+    f = ddt2.DDT2RawData()
+    f.seq = 0
+    f.session = 1 # Chat (for now)
+    f.s_station = "CQCQCQ"
+    f.d_station = "CQCQCQ"
+    f.data = utils.filter_to_ascii(string)
+
+    return f
+
+class FrameScanner(object):
+    """Splits an incoming byte stream into encoded blocks, GPS sentences
+    and unconverted text.  The scan position is remembered between calls,
+    so data that has already been searched is never looked at again."""
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._sob = -1          # Offset of an unterminated [SOB], or -1
+        self._scan = 0          # Where the next marker search starts
+        self._gps_scan = 0      # Where the next GPS search starts
+        self._gps_dirty = False
+
+    def feed(self, data):
+        self._buf += data
+        self._gps_dirty = True
+
+    def get_buffer(self):
+        """Returns the receive buffer, so that a reader can append to it
+        directly (see DataPath.readinto()).  Call fed() afterwards."""
+        return self._buf
+
+    def fed(self):
+        self._gps_dirty = True
+
+    def _slice(self, start, end):
+        view = memoryview(self._buf)
+        data = view[start:end].tobytes()
+        del view
+
+        return data
+
+    def pending(self):
+        return len(self._buf)
+
+    def flush(self):
+        data = str(self._buf)
+        self._buf = bytearray()
+        self._sob = -1
+        self._scan = self._gps_scan = 0
+        self._gps_dirty = False
+
+        return data
+
+    def _match_gps(self, buf, start, end):
+        matches = [m for m in [GPS_NMEA_RE.search(buf, start, end),
+                               GPS_APRS_RE.search(buf, start, end)] if m]
+        if not matches:
+            return None
+
+        matches.sort(key=lambda m: m.start())
+        return matches[0]
+
+    def _text(self, events, start, end):
+        # Text in front of a block is complete, so anything in it that
+        # isn't a GPS sentence never will be
+        text = self._slice(start, end)
+        pos = 0
+        leftover = ""
+        while True:
+            m = self._match_gps(text, pos, len(text))
+            if not m:
+                break
+            leftover += text[pos:m.start()]
+            events.append((GPS_EVENT, m.group(1)))
+            pos = m.end()
+        leftover += text[pos:]
+
+        if leftover:
+            events.append((TEXT_EVENT, leftover))
+
+    def _tail_gps(self, events, start):
+        end = self._sob if self._sob >= 0 else len(self._buf)
+        pos = max(start, self._gps_scan)
+
+        while True:
+            dollar = self._buf.find("$", pos, end)
+            if dollar < 0:
+                self._gps_scan = end
+                break
+
+            # Sentences may still be incomplete, so retry from the first
+            # candidate next time around
+            self._gps_scan = dollar
+            m = self._match_gps(self._buf, dollar, end)
+            if not m:
+                break
+
+            events.append((GPS_EVENT, str(m.group(1))))
+            length = m.end() - m.start()
+            del self._buf[m.start():m.end()]
+            end -= length
+            if self._sob >= 0:
+                self._sob -= length
+            self._scan -= length
+            pos = m.start()
+
+    def scan(self):
+        """Returns a list of (kind, data) events found since the last call"""
+        events = []
+        start = 0
+        hlen = len(ddt2.ENCODED_HEADER)
+        tlen = len(ddt2.ENCODED_TRAILER)
+
+        while True:
+            if self._sob < 0:
+                s = self._buf.find(ddt2.ENCODED_HEADER, self._scan)
+                if s < 0:
+                    # Leave room for a header split across two reads
+                    self._scan = max(start, len(self._buf) - hlen + 1)
+                    break
+                self._sob = s
+                self._scan = s + hlen
+
+            e = self._buf.find(ddt2.ENCODED_TRAILER, self._scan)
+            if e < 0:
+                self._scan = max(self._sob + hlen, len(self._buf) - tlen + 1)
+                break
+            e += tlen
+
+            if self._sob > start:
+                self._text(events, start, self._sob)
+            events.append((FRAME_EVENT, self._slice(self._sob, e)))
+
+            start = self._scan = self._gps_scan = e
+            self._sob = -1
+
+        if self._gps_dirty:
+            self._tail_gps(events, start)
+            self._gps_dirty = False
+
+        if start:
+            del self._buf[:start]
+            self._scan -= start
+            self._gps_scan = max(0, self._gps_scan - start)
+            if self._sob >= 0:
+                self._sob -= start
+
+        return events
+
+class TransportLoop(object):
+    """Services many Transporters from a single thread, waking up when
+    one of their paths has input, when a frame is queued for sending, or
+    when one of them has a timed action (transmit delay, raw text flush)
+    due.  Paths without a selectable descriptor keep their own thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._transports = []
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in [self._wake_r, self._wake_w]:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def register(self, transport):
+        self._lock.acquire()
+        self._transports.append(transport)
+        self._lock.release()
+        self.wakeup()
+
+    def unregister(self, transport):
+        self._lock.acquire()
+        if transport in self._transports:
+            self._transports.remove(transport)
+        self._lock.release()
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self._wake_w, "!")
+        except OSError, e:
+            # The pipe being full means a wakeup is already pending
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wake_r, 512):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _run(self):
+        while True:
+            self._lock.acquire()
+            transports = list(self._transports)
+            self._lock.release()
+
+            now = time.time()
+            timeout = 1.0
+            fds = {}
+            wfds = []
+            for t in transports:
+                if t.reconnecting:
+                    # Out of the loop until its own thread has it back
+                    continue
+                fd = t.pipe.fileno()
+                if fd is not None:
+                    fds[fd] = t
+                    if t.wants_write():
+                        wfds.append(fd)
+                deadline = t.next_deadline()
+                if deadline:
+                    timeout = min(timeout, max(0, deadline - now))
+
+            try:
+                r, w, x = select.select(fds.keys() + [self._wake_r], wfds, [],
+                                        timeout)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                # One of the paths was closed underneath us; let them
+                # each find out on their own
+                r = fds.keys()
+
+            if self._wake_r in r:
+                self._drain_wakeup()
+
+            for fd in r:
+                if fd in fds:
+                    fds[fd].service_input()
+
+            for t in transports:
+                if t.enabled and not t.reconnecting:
+                    t.service_output()
+                if not t.enabled:
+                    self.unregister(t)
+
+_SHARED_LOOP = None
+
+def get_shared_loop():
+    """Returns the process-wide TransportLoop, or None if the platform
+    can't select() on arbitrary descriptors"""
+    global _SHARED_LOOP
+
+    if sys.platform == "win32":
+        return None
+
+    if not _SHARED_LOOP:
+        _SHARED_LOOP = TransportLoop()
+
+    return _SHARED_LOOP
+
 class Transporter(object):
     def __init__(self, pipe, inhandler=None, authfn=None, **kwargs):
         self.inq = BlockQueue()
-        self.outq = BlockQueue()
+        self.outq = PriorityBlockQueue()
         self.pipe = pipe
-        self.inbuf = ""
+        self.scanner = FrameScanner()
         self.enabled = True
         self.inhandler = inhandler
         self.compat = kwargs.get("compat", False)
@@ -99,15 +553,25 @@ class Transporter(object):
         self.compat_delay = kwargs.get("compat_delay", 5)
         self.msg_fn = kwargs.get("msg_fn", None)
         self.name = kwargs.get("port_name", "")
+        self.loop = kwargs.get("loop", None)
+
+        self.last_xmit = 0
+        self.last_recv = 0
+        self._xmit_after = 0
+        self._looped = False
+
+        # For the shared loop: bytes the path hasn't taken yet, as
+        # [data, offset, frame] entries, and whether a thread of our own
+        # is reconnecting the path
+        self._wpending = collections.deque()
+        self._reconnect_tries = 0
+        self.reconnecting = False
 
         self.thread = threading.Thread(target=self.worker,
                                        args=(authfn,))
         self.thread.setDaemon(True)
         self.thread.start()
 
-        self.last_xmit = 0
-        self.last_recv = 0
-
     def __send(self, data):
         for i in range(0, 10):
             try:
@@ -126,10 +590,9 @@ class Transporter(object):
         raise comm.DataPathIOError("Unable to reconnect")
 
     def __recv(self):
-        data = ""
         for i in range(0, 10):
             try:
-                return self.pipe.read_all_waiting()
+                return self.pipe.readinto(self.scanner.get_buffer())
             except comm.DataPathIOError, e:
                 if not self.pipe.can_reconnect:
                     break
@@ -144,9 +607,8 @@ class Transporter(object):
         raise comm.DataPathIOError("Unable to reconnect")
 
     def get_input(self):
-        chunk = self.__recv()
-        if chunk:
-            self.inbuf += chunk
+        if self.__recv():
+            self.scanner.fed()
             self.last_recv = time.time()
 
     def _handle_frame(self, frame):
@@ -155,77 +617,79 @@ class Transporter(object):
         else:
             self.inq.enqueue(frame)
 
-    def parse_blocks(self):
-        while ddt2.ENCODED_HEADER in self.inbuf and \
-                ddt2.ENCODED_TRAILER in self.inbuf:
-            s = self.inbuf.index(ddt2.ENCODED_HEADER)
-            e = self.inbuf.index(ddt2.ENCODED_TRAILER) + \
-                len(ddt2.ENCODED_TRAILER)
-
-            if e < s:
-                # Excise the extraneous end
-                _tmp = self.inbuf[:e-len(ddt2.ENCODED_TRAILER)] + \
-                    self.inbuf[e:]
-                self.inbuf = _tmp
-                continue
-
-            block = self.inbuf[s:e]
-            self.inbuf = self.inbuf[e:]
+    def _handle_block(self, block):
+        f = ddt2.DDT2EncodedFrame()
+        try:
+            if f.unpack(block):
+                print "Got a block: %s" % f
+                self._handle_frame(f)
+            elif self.compat:
+                self._send_text_block(block)
+            else:
+                print "Found a broken block (len:%i buf:%i)" % (\
+                    len(block), self.scanner.pending())
+                utils.hexprint(block)
+        except Exception, e:
+            print "Failed to process block:"
+            utils.log_exception()
+
+    def _handle_text(self, text):
+        if self.compat:
+            self._send_text_block(text)
+        else:
+            print "### Unconverted data: %s" % text
 
-            f = ddt2.DDT2EncodedFrame()
-            try:
-                if f.unpack(block):
-                    print "Got a block: %s" % f
-                    self._handle_frame(f)
-                elif self.compat:
-                    self._send_text_block(block)
-                else:
-                    print "Found a broken block (S:%i E:%i len(buf):%i" % (\
-                        s, e, len(self.inbuf))
-                    utils.hexprint(block)
-            except Exception, e:
-                print "Failed to process block:"
-                utils.log_exception()
+    def parse_blocks(self):
+        for kind, data in self.scanner.scan():
+            if kind == FRAME_EVENT:
+                self._handle_block(data)
+            elif kind == GPS_EVENT:
+                print "Found GPS string: %s" % repr(data)
+                self._send_text_block(data)
+            else:
+                self._handle_text(data)
 
-    def _match_gps(self):
-        # NMEA-style
-        m = re.search("((?:\$GP[^\*]+\*[A-f0-9]{2}\r?\n?){1,2}.{8},.{20})",
-                      self.inbuf)
-        if m:
-            return m.group(1)
+    def _send_text_block(self, string):
+        self._handle_frame(make_text_frame(string))
 
-        # GPS-A style
-        m = re.search("(\$\$CRC[A-z0-9]{4},[^\r]*\r)", self.inbuf)
-        if m:
-            return m.group(1)
-        if "$$CRC" in self.inbuf:
-            print "Didn't match:\n%s" % repr(self.inbuf)
+    def _get_xmit_delay(self):
+        if self.force_delay < 0:
+            # If force_delay is negative, wait between 0.5 and
+            # abs(force_delay) seconds before transmitting
+            return random.randint(5, abs(self.force_delay)*10)/10.0
+        else:
+            # If force_delay is positive, then wait exactly that
+            # long before transmitting
+            return self.force_delay
+
+    def _get_warmup(self):
+        if ((time.time() - self.last_xmit) > self.warmup_timeout) and \
+                (self.warmup_timeout > 0):
+            warmup_f = ddt2.DDT2EncodedFrame()
+            warmup_f.seq = 0
+            warmup_f.session = 0
+            warmup_f.type = 254
+            warmup_f.s_station = "!"
+            warmup_f.d_station = "!"
+            warmup_f.data = ("\x01" * self.warmup_length)
+            warmup_f.set_compress(False)
+            print "Sending warm-up: %s" % warmup_f
+            return warmup_f
 
         return None
 
-    def _send_text_block(self, string):
-        f = ddt2.DDT2RawData()
-        f.seq = 0
-        f.session = 1 # Chat (for now)
-        f.s_station = "CQCQCQ"
-        f.d_station = "CQCQCQ"
-        f.data = utils.filter_to_ascii(string)
-        
-        self._handle_frame(f)
-
-    def _parse_gps(self):
-        result = self._match_gps()
-        if result:
-            self.inbuf = self.inbuf.replace(result, "")
-            print "Found GPS string: %s" % repr(result)
-            self._send_text_block(result)
-        else:
-            return None
+    def _send_one(self, f):
+        warmup_f = self._get_warmup()
+        if warmup_f:
+            self.__send(warmup_f.get_packed())
+
+        print "Sending block: %s" % f
+        f._xmit_s = time.time()
+        self.__send(f.get_packed())
+        f._xmit_e = time.time()
+        f.set_sent()
+        self.last_xmit = time.time()
 
-    def parse_gps(self):
-        while self._match_gps():
-            self._parse_gps()
-            
     def send_frames(self):
         delayed = False
 
@@ -235,43 +699,174 @@ class Transporter(object):
                 break
 
             if self.force_delay and not delayed:
-                if self.force_delay < 0:
-                    # If force_delay is negative, wait between 0.5 and
-                    # abs(force_delay) seconds before transmitting
-                    delay = random.randint(5, abs(self.force_delay)*10)/10.0
-                else:
-                    # If force_delay is positive, then wait exactly that
-                    # long before transmitting
-                    delay = self.force_delay
-
+                delay = self._get_xmit_delay()
                 print "Waiting %.1f sec before transmitting" % delay
                 time.sleep(delay)
                 delayed = True
 
-            if ((time.time() - self.last_xmit) > self.warmup_timeout) and \
-                    (self.warmup_timeout > 0):
-                warmup_f = ddt2.DDT2EncodedFrame()
-                warmup_f.seq = 0
-                warmup_f.session = 0
-                warmup_f.type = 254
-                warmup_f.s_station = "!"
-                warmup_f.d_station = "!"
-                warmup_f.data = ("\x01" * self.warmup_length)
-                warmup_f.set_compress(False)
-                print "Sending warm-up: %s" % warmup_f
-                self.__send(warmup_f.get_packed())
-
-            print "Sending block: %s" % f
-            f._xmit_s = time.time()
-            self.__send(f.get_packed())
-            f._xmit_e = time.time()
-            f.sent_event.set()
-            self.last_xmit = time.time()
+            self._send_one(f)
 
     def compat_is_time(self):
         return (time.time() - self.last_recv) > self.compat_delay
 
-    def worker(self, authfn):
+    def _flush_text(self):
+        if self.scanner.pending() and self.compat_is_time():
+            self._handle_text(self.scanner.flush())
+
+    def next_deadline(self):
+        """Returns the time at which service_output() next has something
+        to do without new input, or None"""
+        deadlines = []
+        if self._xmit_after:
+            deadlines.append(self._xmit_after)
+        if self.scanner.pending():
+            deadlines.append(self.last_recv + self.compat_delay)
+
+        return deadlines and min(deadlines) or None
+
+    def _queue_output(self, f):
+        """The shared loop's _send_one(): queues the frame's bytes for
+        _write_pending() to give the path as fast as it takes them"""
+        warmup_f = self._get_warmup()
+        if warmup_f:
+            self._wpending.append([warmup_f.get_packed(), 0, None])
+
+        print "Sending block: %s" % f
+        f._xmit_s = time.time()
+        self._wpending.append([f.get_packed(), 0, f])
+
+    def _write_pending(self):
+        """Writes queued output until the path would block, and returns
+        True if all of it went"""
+        while self._wpending:
+            entry = self._wpending[0]
+            data, offset, f = entry
+            if offset:
+                n = self.pipe.write_some(buffer(data, offset))
+            else:
+                n = self.pipe.write_some(data)
+            if not n:
+                return False
+
+            self._reconnect_tries = 0
+            entry[1] += n
+            if entry[1] < len(data):
+                return False
+
+            self._wpending.popleft()
+            self.last_xmit = time.time()
+            if f:
+                f._xmit_e = self.last_xmit
+                f.set_sent()
+
+        return True
+
+    def wants_write(self):
+        return bool(self._wpending)
+
+    def _lost_path(self, e):
+        """Takes us out of the shared loop while the path is reconnected
+        from a thread of our own, so that one flapping port doesn't hold
+        up all the others"""
+        print "Data path IO error: %s" % e
+        if not self.pipe.can_reconnect:
+            self.enabled = False
+            return
+
+        self.reconnecting = True
+        t = threading.Thread(target=self._reconnect_worker)
+        t.setDaemon(True)
+        t.start()
+
+    def _reconnect_worker(self):
+        # The same ten tries with a growing pause as __send()/__recv(),
+        # counted until the path carries data again
+        while self.enabled and self._reconnect_tries < 10:
+            time.sleep(self._reconnect_tries)
+            self._reconnect_tries += 1
+            try:
+                print "Attempting reconnect..."
+                self.pipe.reconnect()
+            except comm.DataPathNotConnectedError:
+                continue
+
+            if self.pipe.fileno() is not None:
+                break
+        else:
+            print "Unable to reconnect %s" % self.pipe
+            self.enabled = False
+
+        # A frame cut off by the failure goes again from the start
+        if self._wpending:
+            self._wpending[0][1] = 0
+
+        self.reconnecting = False
+        self.loop.wakeup()
+
+    def service_input(self):
+        try:
+            n = self.pipe.readinto(self.scanner.get_buffer())
+        except comm.DataPathIOError, e:
+            self._lost_path(e)
+            return
+        except Exception, e:
+            print "Exception while getting input: %s" % e
+            utils.log_exception()
+            self.enabled = False
+            return
+
+        if n:
+            self.scanner.fed()
+            self.last_recv = time.time()
+            self._reconnect_tries = 0
+
+        self.parse_blocks()
+
+    def service_output(self):
+        self._flush_text()
+
+        try:
+            if not self._write_pending():
+                return
+        except comm.DataPathIOError, e:
+            self._lost_path(e)
+            return
+        except Exception, e:
+            print "Exception while sending frames: %s" % e
+            self.enabled = False
+            return
+
+        if self.outq.peek() is None:
+            return
+
+        # Same as send_frames(), but the transmit delay is a deadline for
+        # the loop instead of a sleep
+        if self.force_delay:
+            if not self._xmit_after:
+                delay = self._get_xmit_delay()
+                print "Waiting %.1f sec before transmitting" % delay
+                self._xmit_after = time.time() + delay
+            if time.time() < self._xmit_after:
+                return
+            self._xmit_after = 0
+
+        # One frame at a time, so that anything more urgent queued while
+        # the path is busy still goes next
+        try:
+            while True:
+                f = self.outq.dequeue()
+                if not f:
+                    break
+                self._queue_output(f)
+                if not self._write_pending():
+                    break
+        except comm.DataPathIOError, e:
+            self._lost_path(e)
+        except Exception, e:
+            print "Exception while sending frames: %s" % e
+            self.enabled = False
+
+    def _connect(self, authfn):
         if not self.pipe.is_connected():
             if self.msg_fn:
                 self.msg_fn("Connecting")
@@ -282,7 +877,7 @@ class Transporter(object):
                 if self.msg_fn:
                     self.msg_fn("Unable to connect (%s)" % e)
                 print "Comm %s did not connect: %s" % (self.pipe, e)
-                return
+                return False
 
         if authfn and not authfn(self.pipe):
             if self.msg_fn:
@@ -291,6 +886,18 @@ class Transporter(object):
         elif self.msg_fn:
             self.msg_fn("Connected")
 
+        return True
+
+    def worker(self, authfn):
+        if not self._connect(authfn):
+            return
+
+        if self.enabled and self.loop and self.pipe.fileno() is not None:
+            print "Handing %s to the shared I/O loop" % self.pipe
+            self._looped = True
+            self.loop.register(self)
+            return
+
         while self.enabled:
             try:
                 self.get_input()
@@ -301,14 +908,7 @@ class Transporter(object):
                 break
 
             self.parse_blocks()
-            self.parse_gps()
-
-            if self.inbuf and self.compat_is_time():
-                if self.compat:
-                    self._send_text_block(self.inbuf)
-                else:
-                    print "### Unconverted data: %s" % self.inbuf
-                self.inbuf = ""
+            self._flush_text()
 
             try:
                 self.send_frames()
@@ -321,28 +921,23 @@ class Transporter(object):
         self.inhandler = None
         self.enabled = False
         self.thread.join()
+        if self._looped:
+            self.loop.unregister(self)
         
     def send_frame(self, frame):
         if not self.enabled:
             print "Refusing to queue block for dead transport"
             return
         self.outq.enqueue(frame)
+        if self._looped:
+            self.loop.wakeup()
 
     def recv_frame(self):
         return self.inq.dequeue()
 
     def flush_blocks(self, id):
-        # This should really call a flush method in the blockqueue with a
-        # test function
-        self.outq.lock()
-        for b in self.outq._queue[:]:
-            if b.session == id:
-                print "Flushing block: %s" % b
-                try:
-                    self.outq._queue.remove(b)
-                except ValueError:
-                    print "Block disappeared while flushing?"
-        self.outq.unlock()
+        for b in self.outq.flush_session(id):
+            print "Flushing block: %s" % b
 
     def __str__(self):
         return str(self.pipe)
@@ -414,5 +1009,49 @@ def test_simple():
 
     t.disable()
 
+def test_scanner():
+    # GPS sentences inside a frame that is only partly here belong to
+    # the frame, wherever the read boundaries fall.  The frame in front
+    # gets the buffer trimmed up to the start of the second.
+    first = ddt2.DDT2EncodedFrame()
+    first.session = 1
+    first.s_station = "K7HIO"
+    first.d_station = "CQCQCQ"
+    first.data = "Checking in"
+
+    f = ddt2.DDT2EncodedFrame()
+    f.session = 1
+    f.s_station = "K7HIO"
+    f.d_station = "CQCQCQ"
+    f.set_compress(False)
+    f.data = "$GPGGA,180719,4531.529,N,12253.542,W,1,08,0.9,63.4," \
+        "M,-20.0,M,,*55\r\nK7HIO   ,Washington County ARES\r"
+    data = "Hello " + first.get_packed() + f.get_packed() + \
+        " $$CRC1234,K7HIO>APRS:!4531.52N/12253.54W>\r"
+
+    # The last read holds just the end of the second frame, so that
+    # the reads before it see all of its GPS text but not its end
+    eob = data.rindex(ddt2.ENCODED_TRAILER)
+
+    for split in range(0, eob + 1):
+        scanner = FrameScanner()
+        events = []
+        for part in [data[:split], data[split:eob], data[eob:]]:
+            scanner.feed(part)
+            events += scanner.scan()
+
+        kinds = [kind for kind, junk in events]
+        assert kinds.count(FRAME_EVENT) == 2, \
+            "Frame lost at split %i: %s" % (split, events)
+        frame = [d for kind, d in events if kind == FRAME_EVENT][1]
+        g = ddt2.DDT2EncodedFrame()
+        g.unpack(frame)
+        assert g.data == f.data, "Frame mangled at split %i" % split
+        assert kinds.count(GPS_EVENT) == 1, \
+            "GPS sentences wrong at split %i: %s" % (split, events)
+
+    print "Frame scanner OK"
+
 if __name__ == "__main__":
+    test_scanner()
     test_simple()
@@ -25,7 +25,6 @@ import gobject
 import gtk
 import pango
 
-from ConfigParser import ConfigParser,DuplicateSectionError
 from glob import glob
 
 from d_rats.ui.main_common import MainWindowElement, MainWindowTab
@@ -38,10 +37,9 @@ from d_rats import emailgw
 from d_rats.utils import log_exception, print_stack
 from d_rats import signals
 from d_rats import msgrouting
+from d_rats import msgindex
 from d_rats import wl2k
 
-_FOLDER_CACHE = {}
-
 BASE_FOLDERS = [_("Inbox"), _("Outbox"), _("Sent"), _("Trash"), _("Drafts")]
 
 
@@ -52,43 +50,25 @@ def mkmsgid(callsign):
 class MessageFolderInfo(object):
     def __init__(self, folder_path):
         self._path = folder_path
-
-        if _FOLDER_CACHE.has_key(folder_path):
-            self._config = _FOLDER_CACHE[folder_path]
-        else:
-            self._config = ConfigParser()
-            regpath = os.path.join(self._path, ".db")
-            if os.path.exists(regpath):
-                self._config.read(regpath)
-            self._save()
-            _FOLDER_CACHE[folder_path] = self._config
-
-    def _save(self):
-        regpath = os.path.join(self._path, ".db")
-        f = file(regpath, "w")
-        self._config.write(f)
-        f.close()
+        self._index = msgindex.find_index(folder_path)
 
     def name(self):
         """Return folder name"""
         return os.path.basename(self._path)
 
     def _setprop(self, filename, prop, value):
-        filename = os.path.basename(filename)
-
-        if not self._config.has_section(filename):
-            self._config.add_section(filename)
-
-        self._config.set(filename, prop, value)
-        self._save()
+        if prop == "read":
+            value = value == "True"
+        self._index.set_fields(filename, **{prop : value})
 
     def _getprop(self, filename, prop):
-        filename = os.path.basename(filename)
-
-        try:
-            return self._config.get(filename, prop)
-        except Exception:
+        info = self._index.get(filename)
+        if info is None or getattr(info, prop) is None:
             return _("Unknown")
+        elif prop == "read":
+            return str(info.read)
+        else:
+            return getattr(info, prop)
 
     def get_msg_subject(self, filename):
         return self._getprop(filename, "subject")
@@ -137,8 +117,11 @@ class MessageFolderInfo(object):
 
     def files(self):
         """Return a list of files contained in this folder"""
-        l = glob(os.path.join(self._path, "*"))
-        return [x for x in l if os.path.isfile(x) and not x.startswith(".")]
+        return [x.filename for x in self.messages()]
+
+    def messages(self):
+        """Return a MessageInfo for each message in this folder"""
+        return self._index.sync_folder(self._path)
     
     def get_subfolder(self, name):
         """Get a MessageFolderInfo object representing a named subfolder"""
@@ -162,24 +145,33 @@ class MessageFolderInfo(object):
         os.rmdir(self._path)
 
     def create_msg(self, name):
-        exists = os.path.exists(os.path.join(self._path, name))
-        try:
-            self._config.add_section(name)
-        except DuplicateSectionError, e:
-            if exists:
-                raise e
+        path = os.path.join(self._path, name)
+        if os.path.exists(path):
+            raise Exception("Message %s already exists" % path)
 
-        return os.path.join(self._path, name)
+        return path
 
     def delete(self, filename):
-        filename = os.path.basename(filename)
-        self._config.remove_section(filename)
-        os.remove(os.path.join(self._path, filename))
+        filename = os.path.join(self._path, os.path.basename(filename))
+        os.remove(filename)
+        msgindex.message_removed(filename)
+
+    def move_msg(self, filename, dest):
+        """Move a message into the folder @dest, keeping what we know
+        about it, and return its new filename"""
+        newfn = dest.create_msg(os.path.basename(filename))
+        print "Moving %s -> %s" % (filename, newfn)
+        shutil.copy(filename, newfn)
+        msgindex.message_moved(filename, newfn)
+        os.remove(filename)
+        return newfn
 
     def rename(self, new_name):
         newpath = os.path.join(os.path.dirname(self._path), new_name)
         print "Renaming %s -> %s" % (self._path, newpath)
         os.rename(self._path, newpath)
+        if self._index:
+            self._index.move_folder(self._path, newpath)
         self._path = newpath
 
     def __str__(self):
@@ -392,15 +384,7 @@ class MessageFolders(MainWindowElement):
                 dst.delete(os.path.basename(fn))
             except Exception:
                 pass
-            newfn = dst.create_msg(os.path.basename(fn))
-            shutil.copy(fn, newfn)
-            src.delete(fn)
-
-            dst.set_msg_read(fn, read == "True")
-            dst.set_msg_subject(fn, subj)
-            dst.set_msg_type(fn, type)
-            dst.set_msg_sender(fn, send)
-            dst.set_msg_recip(fn, recp)
+            src.move_msg(fn, dst)
 
     def _folder_rename(self, render, path, new_text, store):
         iter = store.get_iter(path)
@@ -422,6 +406,8 @@ class MessageFolders(MainWindowElement):
     def __init__(self, wtree, config):
         MainWindowElement.__init__(self, wtree, config, "msg")
 
+        msgindex.get_index(self._folders_path())
+
         folderlist, = self._getw("folderlist")
 
         store = gtk.TreeStore(gobject.TYPE_STRING, gobject.TYPE_OBJECT)
@@ -560,6 +546,8 @@ class MessageList(MainWindowElement):
     def __init__(self, wtree, config):
         MainWindowElement.__init__(self, wtree, config, "msg")
 
+        msgindex.get_index(self._config.form_store_dir())
+
         msglist, = self._getw("msglist")
 
         self.store = gtk.ListStore(gobject.TYPE_OBJECT,
@@ -654,31 +642,27 @@ class MessageList(MainWindowElement):
     def _update_message_info(self, iter, force=False):
         fn, = self.store.get(iter, ML_COL_FILE)
 
-        subj = self.current_info.get_msg_subject(fn)
-        read = self.current_info.get_msg_read(fn)
-        if subj == _("Unknown") or force:
-            # Not registered, so update the registry
-            form = formgui.FormFile(fn)
-            self.current_info.set_msg_type(fn, form.id)
-            self.current_info.set_msg_read(fn, read)
-            self.current_info.set_msg_subject(fn, form.get_subject_string())
-            self.current_info.set_msg_sender(fn, form.get_sender_string())
-            self.current_info.set_msg_recip(fn, form.get_recipient_string())
-
-        ts = os.stat(fn).st_ctime
-        read = self.current_info.get_msg_read(fn)
-        if read:
+        if force:
+            msgindex.message_saved(fn)
+
+        info = msgindex.find_index(fn).get(fn)
+        if info:
+            self._show_message_info(iter, info)
+
+    def _show_message_info(self, iter, info):
+        if info.read:
             icon = self.message_pixbuf
         else:
             icon = self.unread_pixbuf
+        unknown = lambda x: x is None and _("Unknown") or x
         self.store.set(iter,
                        ML_COL_ICON, icon,
-                       ML_COL_SEND, self.current_info.get_msg_sender(fn),
-                       ML_COL_RECP, self.current_info.get_msg_recip(fn),
-                       ML_COL_SUBJ, self.current_info.get_msg_subject(fn),
-                       ML_COL_TYPE, self.current_info.get_msg_type(fn),
-                       ML_COL_DATE, ts,
-                       ML_COL_READ, read)
+                       ML_COL_SEND, unknown(info.sender),
+                       ML_COL_RECP, unknown(info.recip),
+                       ML_COL_SUBJ, unknown(info.subject),
+                       ML_COL_TYPE, unknown(info.type),
+                       ML_COL_DATE, info.mtime or 0,
+                       ML_COL_READ, info.read)
 
     def iter_from_fn(self, fn):
         iter = self.store.get_iter_first()
@@ -694,10 +678,10 @@ class MessageList(MainWindowElement):
         """Refresh the current folder"""
         if fn is None:
             self.store.clear()
-            for msg in self.current_info.files():
+            for info in self.current_info.messages():
                 iter = self.store.append()
-                self.store.set(iter, ML_COL_FILE, msg)
-                self._update_message_info(iter)
+                self.store.set(iter, ML_COL_FILE, info.filename)
+                self._show_message_info(iter, info)
         else:
             iter = self.iter_from_fn(fn)
             if not iter:
@@ -728,15 +712,11 @@ class MessageList(MainWindowElement):
     def move_message(self, info, path, new_folder):
         dest = MessageFolderInfo(self._folder_path(new_folder))
         try:
-            newfn = dest.create_msg(os.path.basename(path))
+            newfn = info.move_msg(path, dest)
         except Exception:
             # Same folder, or duplicate message id
             return path
 
-        print "Moving %s -> %s" % (path, newfn)
-        shutil.copy(path, newfn)
-        info.delete(path)
-
         if info == self.current_info:
             self.refresh()
 
@@ -897,6 +877,7 @@ class MessagesTab(MainWindowTab):
         if fn:
             try:
                 os.remove(fn)
+                msgindex.message_removed(fn)
             except Exception, e:
                 print "Unable to delete %s: %s" % (fn, e)
             self._messages.refresh()
@@ -1129,10 +1110,7 @@ class MessagesTab(MainWindowTab):
         files = outbox.files()
         if fn in files:
             sent = self._folders.get_folder(_("Sent"))
-            newfn = sent.create_msg(os.path.basename(fn))
-            print "Moving %s -> %s" % (fn, newfn)
-            shutil.copy(fn, newfn)
-            outbox.delete(fn)
+            outbox.move_msg(fn, sent)
             self.refresh_if_folder(_("Outbox"))
             self.refresh_if_folder(_("Sent"))
         else:
@@ -1148,11 +1126,9 @@ class MessagesTab(MainWindowTab):
         info = MessageFolderInfo(os.path.join(path, shared))
 
         ret = []
-        for fn in info.files():
-            stamp = os.stat(fn).st_mtime
-            ffn = "%s/%s" % (shared, os.path.basename(fn))
-            form = formgui.FormFile(fn)
-            ret.append((form.get_subject_string(), stamp, ffn))
+        for msg in info.messages():
+            ffn = "%s/%s" % (shared, os.path.basename(msg.filename))
+            ret.append((msg.subject, msg.mtime, ffn))
 
         return ret
 
@@ -215,6 +215,23 @@ class StationsList(MainWindowTab):
             job = rpc.RPCGetVersion(station, "Version Request")
             job.connect("state-change", log_result)
             self.emit("submit-rpc-job", job, port)
+        elif action == "xferq":
+            def log_result(job, state, result):
+                if state != "complete":
+                    msg = "No transfer queue from %s" % job.get_dest()
+                elif result.has_key("rc"):
+                    msg = "%s: %s" % (job.get_dest(), result["rc"])
+                else:
+                    items = sorted(result.items())
+                    msg = "Transfer queue of %s: %s" % (\
+                        job.get_dest(),
+                        "; ".join([v for k, v in items]))
+                event = main_events.Event(None, msg)
+                self.emit("event", event)
+
+            job = rpc.RPCTransferQueue(station, "Transfer queue")
+            job.connect("state-change", log_result)
+            self.emit("submit-rpc-job", job, port)
         elif action == "mcheck":
             def log_result(job, state, result):
                 msg = "Mail check via %s: %s" % (job.get_dest(),
@@ -241,6 +258,7 @@ class StationsList(MainWindowTab):
     <menuitem action="reqpos"/>
     <menuitem action="sendfile"/>
     <menuitem action="version"/>
+    <menuitem action="xferq"/>
     <menuitem action="mcheck"/>
     <separator/>
     <menuitem action="remove"/>
@@ -260,6 +278,7 @@ class StationsList(MainWindowTab):
                    ("remove", _("Remove"), gtk.STOCK_DELETE),
                    ("reset", _("Reset"), gtk.STOCK_JUMP_TO),
                    ("version", _("Get version"), gtk.STOCK_ABOUT),
+                   ("xferq", _("Get transfer queue"), None),
                    ("mcheck", _("Request mail check"), None)]
 
         for action, label, stock in actions:
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import threading
+
+# Job priorities, most urgent first
+PRI_FORM = 0
+PRI_FILE = 1
+
+JOB_QUEUED = "queued"
+JOB_ACTIVE = "active"
+JOB_DONE   = "done"
+
+class TransferJob(object):
+    """A file or form waiting to be pushed to a station"""
+
+    def __init__(self, id, kind, dest, filename, name, priority):
+        self.id = id
+        self.kind = kind
+        self.dest = dest
+        self.filename = filename
+        self.name = name
+        self.priority = priority
+        self.state = JOB_QUEUED
+        self.queued_time = time.time()
+        self.start_time = None
+
+        # A batch of forms is a list of them
+        if isinstance(filename, list):
+            filenames = filename
+        else:
+            filenames = [filename]
+
+        self.size = 0
+        for fn in filenames:
+            try:
+                self.size += os.path.getsize(fn)
+            except OSError:
+                pass
+
+    def __str__(self):
+        if self.size > 1024:
+            size = "%i KB" % (self.size >> 10)
+        else:
+            size = "%i B" % self.size
+
+        return "%s %s to %s (%s, %s)" % (self.kind, self.name, self.dest,
+                                         size, self.state)
+
+class TransferScheduler(object):
+    """Decides which of the queued pushes on a port get a session.  At
+    most max_active transfers run at once, forms go before files, and
+    among jobs of the same priority the station that has been sent the
+    fewest bytes so far goes next, so one big push to a station doesn't
+    hold up everyone else.  start_fn(job) is called (outside our lock)
+    to start a job, and changed_fn(job) whenever one changes state."""
+
+    def __init__(self, start_fn, max_active=2, changed_fn=None):
+        self.start_fn = start_fn
+        self.changed_fn = changed_fn
+        self.max_active = max_active
+
+        self._lock = threading.Lock()
+        self._queued = []
+        self._active = []
+        self._served = {}
+        self._next_id = 1
+
+    def set_max_active(self, max_active):
+        self.max_active = max(1, max_active)
+        self._dispatch()
+
+    def _changed(self, job):
+        if self.changed_fn:
+            self.changed_fn(job)
+
+    def submit(self, kind, dest, filename, name, priority=PRI_FILE):
+        self._lock.acquire()
+        job = TransferJob(self._next_id, kind, dest, filename, name, priority)
+        self._next_id += 1
+        self._queued.append(job)
+        self._lock.release()
+
+        self._changed(job)
+        self._dispatch()
+
+        return job
+
+    def finished(self, job):
+        self._lock.acquire()
+        if job in self._active:
+            self._active.remove(job)
+        job.state = JOB_DONE
+
+        # Only stations with jobs still to go need their share counted
+        for other in self._active + self._queued:
+            if other.dest == job.dest:
+                break
+        else:
+            self._served.pop(job.dest, None)
+        self._lock.release()
+
+        self._changed(job)
+        self._dispatch()
+
+    def get_queue(self):
+        """Returns the running jobs followed by the waiting ones, in the
+        order they will be started"""
+        self._lock.acquire()
+        self._queued.sort(key=self._rank)
+        jobs = self._active + self._queued
+        self._lock.release()
+
+        return jobs
+
+    def _rank(self, job):
+        return (job.priority, self._served.get(job.dest, 0), job.id)
+
+    def _dispatch(self):
+        self._lock.acquire()
+        starting = []
+        while self._queued and len(self._active) < self.max_active:
+            job = min(self._queued, key=self._rank)
+            self._queued.remove(job)
+            self._active.append(job)
+            self._served[job.dest] = self._served.get(job.dest, 0) + \
+                max(job.size, 1)
+            job.state = JOB_ACTIVE
+            job.start_time = time.time()
+            starting.append(job)
+        self._lock.release()
+
+        for job in starting:
+            self._changed(job)
+            self.start_fn(job)
+
+def test_scheduler():
+    started = []
+    s = TransferScheduler(started.append, max_active=1)
+
+    a1 = s.submit("file", "A", "/nonexistent", "a1")
+    s.submit("file", "A", "/nonexistent", "a2")
+    s.submit("file", "B", "/nonexistent", "b1")
+    s.submit("form", "C", "/nonexistent", "c1", PRI_FORM)
+    assert [j.name for j in started] == ["a1"]
+
+    # The form jumps the queue, then B goes before A's second file
+    s.finished(a1)
+    assert started[-1].name == "c1"
+    s.finished(started[-1])
+    assert started[-1].name == "b1"
+    assert [j.name for j in s.get_queue()] == ["b1", "a2"]
+    assert "C" not in s._served
+
+    s.set_max_active(2)
+    assert [j.name for j in started] == ["a1", "c1", "b1", "a2"]
+    for job in started[2:]:
+        s.finished(job)
+    assert not s._served, "Finished stations are still counted"
+
+    print "Transfer scheduler OK"
+
+if __name__ == "__main__":
+    test_scheduler()
@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import re
 
 DEFAULT_BANNED = "\x11\x13\x1A\00\xFD\xFE\xFF"
 OFFSET = 64
@@ -54,15 +55,137 @@ def ydecode_buffer(buf):
 
     return out
 
+_DECODE_ESCAPED = dict([(chr((i + OFFSET) % 256), chr(i))
+                        for i in range(0, 256)])
+_DECODE_RE = re.compile("=(.)", re.DOTALL)
+
+def _ydecode_escape(match):
+    return _DECODE_ESCAPED[match.group(1)]
+
+class YEncoder(object):
+    """Bulk encoder producing the same output as yencode_buffer()"""
+
+    def __init__(self, banned=None):
+        if not banned:
+            banned = DEFAULT_BANNED
+
+        # "=" always has to go first, since every other escape adds one
+        self._banned = "=" + banned.replace("=", "")
+        self._escapes = [(c, "=" + chr((ord(c) + OFFSET) % 256))
+                         for c in self._banned]
+
+        # If escaping one banned character would produce another one
+        # (other than the "=" prefix), chained replace() calls would
+        # double-escape it, so fall back to a single regex pass
+        produced = "".join([e[1:] for _, e in self._escapes])
+        if [c for c in produced if c in self._banned[1:]]:
+            table = dict(self._escapes)
+            regex = re.compile("[%s]" % re.escape(self._banned))
+            self._sub = lambda buf: regex.sub(lambda m: table[m.group(0)],
+                                              buf)
+        else:
+            self._sub = None
+
+    def encode(self, buf):
+        if self._sub:
+            return self._sub(buf)
+
+        for char, escape in self._escapes:
+            if char in buf:
+                buf = buf.replace(char, escape)
+
+        return buf
+
+class YDecoder(object):
+    """Incremental decoder, which may be fed arbitrary partial buffers"""
+
+    def __init__(self):
+        self._pending = ""
+
+    def decode(self, buf):
+        buf = self._pending + buf
+        self._pending = ""
+
+        # A trailing run of an odd number of "=" characters ends in an
+        # escape whose second half hasn't arrived yet
+        run = len(buf) - len(buf.rstrip("="))
+        if run % 2:
+            self._pending = "="
+            buf = buf[:-1]
+
+        if "=" not in buf:
+            return buf
+
+        return _DECODE_RE.sub(_ydecode_escape, buf)
+
+    def flush(self):
+        if self._pending:
+            self._pending = ""
+            raise ValueError("Truncated escape sequence at end of buffer")
+
+        return ""
+
+_default_encoder = YEncoder()
+
+def yencode_fast(buf, banned=None):
+    if banned:
+        return YEncoder(banned).encode(buf)
+    else:
+        return _default_encoder.encode(buf)
+
+def ydecode_fast(buf):
+    decoder = YDecoder()
+    out = decoder.decode(buf)
+    decoder.flush()
+    return out
+
+def test_fast_codec(count=500):
+    import os
+    import random
+
+    for i in range(0, count):
+        data = os.urandom(random.randint(0, 1100)) + "=" * random.randint(0, 3)
+        enc = yencode_buffer(data)
+        if yencode_fast(data) != enc:
+            print "FAIL: encode mismatch"
+            return False
+        if ydecode_fast(enc) != data:
+            print "FAIL: decode mismatch"
+            return False
+
+        decoder = YDecoder()
+        out = ""
+        pos = 0
+        while pos < len(enc):
+            n = random.randint(1, 16)
+            out += decoder.decode(enc[pos:pos+n])
+            pos += n
+        decoder.flush()
+        if out != data:
+            print "FAIL: incremental decode mismatch"
+            return False
+
+    banned = "QS\x11"
+    data = "QS\x11\x91=" * 4
+    if ydecode_fast(yencode_fast(data, banned)) != data or \
+            yencode_fast(data, banned) != yencode_buffer(data, banned):
+        print "FAIL: custom banned set"
+        return False
+
+    print "PASS"
+    return True
+
 if __name__=="__main__":
-    import sys
+    if sys.argv[1] == "-t":
+        test_fast_codec()
+        sys.exit(0)
 
     f = file(sys.argv[2])
     inbuf = f.read()
 
     if sys.argv[1] == "-e":
-        sys.stdout.write(yencode_buffer(inbuf))
+        sys.stdout.write(yencode_fast(inbuf))
     else:
-        sys.stdout.write(ydecode_buffer(inbuf))
+        sys.stdout.write(ydecode_fast(inbuf))
 
     f.close()
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This pushes D-RATS frames through a TNC-AX25 data path whose "TNC" is
+# a loopback on the other end of a pty pair, and reports frames per
+# second.  Run it with "-h" to see a help screen
+
+import os
+import sys
+import time
+import select
+import struct
+import threading
+from optparse import OptionParser
+
+try:
+    from d_rats import comm, ddt2, transport
+except ImportError:
+    sys.path.append("..")
+    from d_rats import comm, ddt2, transport
+
+class LegacyAX25DataPath(comm.TNCAX25DataPath):
+    """Rebuilds the header and runs the Python FCS loop for every frame,
+    and fills the receive buffer a byte at a time, as the original did"""
+
+    def __init__(self, pathspec, **kwargs):
+        comm.TNCAX25DataPath.__init__(self, pathspec, **kwargs)
+        (port, rate, self._call, self._path) = pathspec
+
+    def write(self, buf):
+        spath = [self._call,] + self._path.split(",")
+        hdr = comm.ax25_encode_path("DRATS", spath)
+
+        fcs = comm.compute_fcs_table(hdr + buf)
+        data = hdr + buf + struct.pack(">H", fcs)
+
+        comm.TNCDataPath.write(self, data)
+
+    def read_all_waiting(self):
+        data = ""
+        for char in self._read_frames():
+            data += char
+
+        return data
+
+def loopback_tnc(fd, stop):
+    """Echo every KISS frame back, minus the FCS, like a TNC would"""
+    codec = comm.KISSCodec()
+    while not stop.isSet():
+        r, w, x = select.select([fd], [], [], 0.1)
+        if not r:
+            continue
+        for port, frame in codec.feed(os.read(fd, 4096)):
+            os.write(fd, codec.encode(frame[:-2], port))
+
+def run(cls, frames, size):
+    master, slave = os.openpty()
+    stop = threading.Event()
+    tnc = threading.Thread(target=loopback_tnc, args=(master, stop))
+    tnc.setDaemon(True)
+    tnc.start()
+
+    path = cls((os.ttyname(slave), 9600, "KK7DS", "WIDE1-1"))
+    path.connect()
+
+    f = ddt2.DDT2EncodedFrame()
+    f.s_station = "KK7DS"
+    f.d_station = "KI4IFW"
+    f.data = os.urandom(size)
+    packed = f.get_packed()
+
+    def writer():
+        for i in range(frames):
+            path.write(packed)
+
+    scanner = transport.FrameScanner()
+    received = 0
+
+    start = time.time()
+    w = threading.Thread(target=writer)
+    w.start()
+    while received < frames and (time.time() - start) < 60:
+        scanner.feed(path.read_all_waiting())
+        received += len([k for k, d in scanner.scan()
+                         if k == transport.FRAME_EVENT])
+    elapsed = time.time() - start
+    w.join()
+
+    stop.set()
+    tnc.join()
+    path.disconnect()
+    os.close(master)
+    os.close(slave)
+
+    return received, elapsed
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--frames",
+                  dest="frames",
+                  type="int",
+                  default=500,
+                  help="Number of frames to send (default: 500)")
+    op.add_option("-s", "--size",
+                  dest="size",
+                  type="int",
+                  default=256,
+                  help="Payload size of each frame (default: 256)")
+    (opts, args) = op.parse_args()
+
+    for name, cls in [("legacy", LegacyAX25DataPath),
+                      ("current", comm.TNCAX25DataPath)]:
+        received, elapsed = run(cls, opts.frames, opts.size)
+        print "%-8s %4i/%i frames in %6.2f sec: %7.1f frames/sec" % (\
+            name, received, opts.frames, elapsed, received / elapsed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This drains a queue of forms to one next hop over the simulated radio
+# channel from xferbench, first one form per session (as the router
+# used to send them) and then in batches, and compares how long it
+# takes and how much goes over the air.  Run it with "-h" to see a help
+# screen
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import threading
+from optparse import OptionParser
+
+import gettext
+gettext.install("D-RATS")
+
+from xferbench import NullWriter, RadioChannel, SimPort
+
+try:
+    from d_rats import congestion
+    from d_rats.sessions import form
+except ImportError:
+    sys.path.append("..")
+    from d_rats import congestion
+    from d_rats.sessions import form
+
+WORDS = "the net is up and all stations are checking in from the eoc " \
+    "shelter power water please send traffic to county hospital".split()
+
+def make_forms(tmp, count, size):
+    files = []
+    for i in range(0, count):
+        body = " ".join([random.choice(WORDS)
+                         for j in range(0, random.randint(size / 10,
+                                                          size / 3))])
+        fn = os.path.join(tmp, "form_%03i.xml" % i)
+        f = open(fn, "w")
+        f.write("<xml><form id=\"bench\"><path><src>KK7DS</src>" \
+                    "<dst>KE7JSS</dst><mid>%x</mid></path>" \
+                    "<field id=\"message\"><entry type=\"multiline\">" \
+                    "%s</entry></field></form></xml>" % (i, body))
+        f.close()
+        files.append(fn)
+
+    return files
+
+def transfer(ports, id, filenames, tmp, opts):
+    """Sends filenames in one session: a batch if there is more than
+    one, or else a single form.  Returns how many arrived"""
+    cls = len(filenames) > 1 and form.FormBatchSession or \
+        form.FormTransferSession
+    sender = cls("bench%i" % id, blocksize=opts.bsize,
+                 outlimit=opts.outlimit)
+    receiver = cls("bench%i" % id, blocksize=opts.bsize,
+                   outlimit=opts.outlimit)
+    ports[0].add(sender, id)
+    ports[1].add(receiver, id)
+
+    # Each end has its own place to pack and unpack bundles
+    sdir, rdir = os.path.join(tmp, "send"), os.path.join(tmp, "recv")
+
+    result = []
+    if cls == form.FormBatchSession:
+        def send():
+            result.extend(sender.send_forms(filenames, sdir))
+        recv = lambda: receiver.recv_forms(rdir, lambda n, d: True)
+    else:
+        def send():
+            if sender.send_file(filenames[0]):
+                result.extend(filenames)
+        recv = lambda: receiver.recv_file(os.path.join(rdir, "form.xml"))
+
+    t = threading.Thread(target=send)
+    t.setDaemon(True)
+    t.start()
+    recv()
+    t.join(120)
+
+    return len(result)
+
+def run(files, batch, tmp, opts):
+    channel = RadioChannel(opts.bps, opts.latency, opts.turnaround, opts.loss)
+    ports = []
+    for side in [0, 1]:
+        profile = congestion.PathProfile(max_window=opts.window)
+        ports.append(SimPort(channel, side, profile))
+    ports[0].peer, ports[1].peer = ports[1], ports[0]
+
+    start = time.time()
+    sent = 0
+    queue = list(files)
+    id = 4
+    while queue:
+        sent += transfer(ports, id, queue[:batch], tmp, opts)
+        queue = queue[batch:]
+        id += 1
+        if queue:
+            # The router only looks at the queue this often
+            time.sleep(opts.flush)
+
+    elapsed = time.time() - start
+
+    for port in ports:
+        port.stop()
+    channel.stop()
+
+    return elapsed, sent, channel
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--count",
+                  dest="count",
+                  type="int",
+                  default=20,
+                  help="Forms queued for the next hop (default: 20)")
+    op.add_option("-s", "--size",
+                  dest="size",
+                  type="int",
+                  default=1024,
+                  help="Rough bytes per form (default: 1024)")
+    op.add_option("-B", "--bps",
+                  dest="bps",
+                  type="int",
+                  default=1200,
+                  help="Link rate in bits/sec (default: 1200)")
+    op.add_option("-L", "--latency",
+                  dest="latency",
+                  type="float",
+                  default=0.2,
+                  help="Link latency in seconds (default: 0.2)")
+    op.add_option("-t", "--turnaround",
+                  dest="turnaround",
+                  type="float",
+                  default=1.0,
+                  help="Transmit turnaround in seconds (default: 1.0)")
+    op.add_option("-l", "--loss",
+                  dest="loss",
+                  type="float",
+                  default=0.02,
+                  help="Frame loss rate (default: 0.02)")
+    op.add_option("-b", "--blocksize",
+                  dest="bsize",
+                  type="int",
+                  default=512,
+                  help="Block size (default: 512)")
+    op.add_option("-o", "--outlimit",
+                  dest="outlimit",
+                  type="int",
+                  default=4,
+                  help="Initial pipeline blocks (default: 4)")
+    op.add_option("-w", "--window",
+                  dest="window",
+                  type="int",
+                  default=4096,
+                  help="Maximum bytes in flight (default: 4096)")
+    op.add_option("-f", "--flush",
+                  dest="flush",
+                  type="float",
+                  default=1.0,
+                  help="Seconds between routing passes (default: 1.0)")
+    op.add_option("-m", "--batch",
+                  dest="batches",
+                  default="5,20",
+                  help="Batch sizes to try (default: 5,20)")
+    op.add_option("-r", "--seed",
+                  dest="seed",
+                  type="int",
+                  default=0,
+                  help="Random seed (default: 0)")
+    (opts, args) = op.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        random.seed(opts.seed)
+        files = make_forms(tmp, opts.count, opts.size)
+        os.mkdir(os.path.join(tmp, "send"))
+        os.mkdir(os.path.join(tmp, "recv"))
+        size = sum([os.path.getsize(fn) for fn in files])
+
+        print "%i forms (%i KB) to one station at %i bps, %.0f%% loss" % (\
+            len(files), size >> 10, opts.bps, opts.loss * 100)
+
+        for batch in [1] + [int(x) for x in opts.batches.split(",")]:
+            random.seed(opts.seed)
+            # Sessions are very chatty on stdout
+            sys.stdout = NullWriter()
+            try:
+                elapsed, sent, channel = run(files, batch, tmp, opts)
+            finally:
+                sys.stdout = sys.__stdout__
+
+            if batch == 1:
+                label = "one at a time"
+            else:
+                label = "batches of %i" % batch
+
+            print "%-14s %s %7.1f sec, %5.2f sec/form, " \
+                "%4i frames (%i lost)" % (\
+                label,
+                sent == len(files) and "ok  " or "FAIL",
+                elapsed,
+                elapsed / len(files),
+                channel.frames,
+                channel.lost)
+    finally:
+        shutil.rmtree(tmp, True)
+
+if __name__ == "__main__":
+    main()
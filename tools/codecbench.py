@@ -0,0 +1,255 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This packs a corpus of frame payloads with each of the ddt2 codecs and
+# compression levels, and reports the CPU time taken to compress and
+# decompress them and the airtime of the resulting frames, next to what
+# every frame used to get (zlib at level 9, whether it helped or not).
+# The corpus is made up of filled-in forms, RPC calls and results,
+# session control and ack frames and already-compressed image data, or
+# the frames in a capture of what a port received (-f).  Run it with "-h"
+# to see a help screen
+
+import os
+import re
+import sys
+import glob
+import time
+import zlib
+import random
+import struct
+from optparse import OptionParser
+
+try:
+    from d_rats import ddt2, transport
+except ImportError:
+    sys.path.append("..")
+    from d_rats import ddt2, transport
+
+FORMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "..", "forms")
+
+# label : (codec, level), or None for the old behaviour
+METHODS = [
+    ("old",      None),
+    ("none",     (ddt2.CODEC_NONE, 6)),
+    ("zlib-1",   (ddt2.CODEC_ZLIB, 1)),
+    ("zlib-6",   (ddt2.CODEC_ZLIB, 6)),
+    ("zlib-9",   (ddt2.CODEC_ZLIB, 9)),
+    ("zdict-6",  (ddt2.CODEC_ZDICT, 6)),
+    ("zdict-9",  (ddt2.CODEC_ZDICT, 9)),
+    ]
+
+WORDS = "the net is up and all stations are checking in from the eoc " \
+    "shelter power water please send traffic to county hospital route " \
+    "road closed at bridge need two more radios for the evening shift " \
+    "report status every hour until further notice".split()
+
+CALLS = ["KK7DS", "KE7JSS", "W7ABC", "N7XYZ", "KD7QRS", "WA7EOC"]
+
+def sentence(n):
+    return " ".join([random.choice(WORDS) for i in range(0, n)])
+
+def fill_form(template):
+    """Makes something like a filled-in form as it is sent, from one of
+    the empty forms we ship"""
+    doc = template.replace("'", "\"")
+
+    def entry(m):
+        type = m.group(1)
+        if type == "multiline":
+            value = sentence(random.randint(20, 80))
+        elif type == "date":
+            value = "Oct 18, 2026"
+        elif type == "time":
+            value = "%02i:%02i:00" % (random.randint(0, 23),
+                                      random.randint(0, 59))
+        elif type == "numeric":
+            value = str(random.randint(1, 200))
+        elif type == "toggle":
+            value = random.choice(["True", "False"])
+        else:
+            value = sentence(random.randint(1, 5))
+        return "<entry type=\"%s\">%s</entry>" % (type, value)
+
+    doc = re.sub(r"<entry type=\"([a-z]+)\"/>", entry, doc)
+
+    path = "<path><src>%s</src><dst>%s</dst><e>%s</e></path>\n" % (\
+        random.choice(CALLS), random.choice(CALLS), random.choice(CALLS))
+    doc = re.sub(r"(<form id=\"[^\"]*\">\n)", r"\1" + path, doc)
+
+    return "<?xml version=\"1.0\"?>\n" + doc
+
+def encode_dict(d):
+    # As RPC does it
+    return "\x1e".join([k + "\x1f" + v for k, v in d.items()])
+
+def corpus_forms(count):
+    templates = [file(fn).read()
+                 for fn in sorted(glob.glob(os.path.join(FORMS_DIR, "*.xml")))]
+    if not templates:
+        return []
+
+    return [fill_form(random.choice(templates)) for i in range(0, count)]
+
+def corpus_rpc(count):
+    items = []
+    for i in range(0, count):
+        call = random.choice(CALLS)
+        items += [
+            "RPCFormListJob\x1d",
+            "RPCFileListJob\x1d",
+            "RPCPositionReport\x1d" + encode_dict({"st" : call}),
+            "RPCPullFormJob\x1d" + encode_dict({"fn" : "form_%i" % i}),
+            encode_dict({"rc" : "OK"}),
+            encode_dict(dict([("file%i.txt" % j,
+                               "%i KB (Oct 18 2026)" % random.randint(1, 99))
+                              for j in range(0, random.randint(1, 8))])),
+            encode_dict({"version" : "0.3.3", "os" : "Linux",
+                         "pyver" : "2.7.18", "pygtkver" : "2.24.0",
+                         "gtkver" : "2.24.33"}),
+            ]
+
+    return items
+
+def corpus_control(count):
+    items = []
+    for i in range(0, count):
+        # Session requests and acks, end of session, and block acks
+        items += [
+            chr(i % 256) + "File Transfer",
+            struct.pack("BB", i % 256, (i + 1) % 256),
+            str(i % 256),
+            struct.pack("!H", i) + chr(0xFF) * random.randint(1, 2),
+            ]
+
+    return items
+
+def corpus_image(count, size=512):
+    # Data that is compressed already, like a JPEG or a file chunk
+    return [zlib.compress(os.urandom(size)) for i in range(0, count)]
+
+def corpus_capture(filename):
+    """Returns the payloads of the frames in a capture of a port"""
+    scanner = transport.FrameScanner()
+    scanner.feed(file(filename, "rb").read())
+
+    items = []
+    for kind, data in scanner.scan():
+        if kind != transport.FRAME_EVENT:
+            continue
+        f = ddt2.DDT2EncodedFrame()
+        if f.unpack(data):
+            items.append(f.data)
+
+    return items
+
+def pack(data, method):
+    if method is None:
+        return ddt2.CODEC_ZLIB, zlib.compress(data, 9)
+
+    codec, level = method
+    ddt2.set_compress_level(level)
+    return ddt2.compress_smaller(data, codec)
+
+def wire_size(payload):
+    # The frame header goes over the air too, all of it yEncoded
+    raw = "\0" * struct.calcsize(ddt2.DDT2Frame.format) + payload
+    return len(ddt2.ENCODED_HEADER + ddt2.encode(raw) + ddt2.ENCODED_TRAILER)
+
+def measure(items, method, rounds):
+    packed = [pack(data, method) for data in items]
+
+    start = time.clock()
+    for i in range(0, rounds):
+        for data in items:
+            pack(data, method)
+    ctime = (time.clock() - start) / rounds
+
+    start = time.clock()
+    for i in range(0, rounds):
+        for codec, zdata in packed:
+            ddt2.decompress(zdata, codec)
+    dtime = (time.clock() - start) / rounds
+
+    for (codec, zdata), data in zip(packed, items):
+        if ddt2.decompress(zdata, codec) != data:
+            raise Exception("Data did not survive %s" % ddt2.CODECS[codec])
+
+    wire = sum([wire_size(zdata) for codec, zdata in packed])
+
+    return wire, ctime, dtime
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--count",
+                  dest="count",
+                  type="int",
+                  default=50,
+                  help="Items of each kind in the corpus (default: 50)")
+    op.add_option("-f", "--capture",
+                  dest="capture",
+                  default=None,
+                  help="Use the frames in this capture of a port instead")
+    op.add_option("-B", "--bps",
+                  dest="bps",
+                  type="int",
+                  default=1200,
+                  help="Link rate for airtime in bits/sec (default: 1200)")
+    op.add_option("-R", "--rounds",
+                  dest="rounds",
+                  type="int",
+                  default=20,
+                  help="Times to repeat for the CPU times (default: 20)")
+    op.add_option("-r", "--seed",
+                  dest="seed",
+                  type="int",
+                  default=0,
+                  help="Random seed (default: 0)")
+    (opts, args) = op.parse_args()
+
+    random.seed(opts.seed)
+
+    if opts.capture:
+        corpus = [("capture", corpus_capture(opts.capture))]
+    else:
+        corpus = [("forms", corpus_forms(opts.count)),
+                  ("rpc", corpus_rpc(opts.count)),
+                  ("control", corpus_control(opts.count)),
+                  ("image", corpus_image(opts.count))]
+    corpus.append(("all", sum([items for name, items in corpus], [])))
+
+    for name, items in corpus:
+        if not items:
+            continue
+
+        size = sum([len(data) for data in items])
+        print "%s: %i frames, %i bytes" % (name, len(items), size)
+
+        base = None
+        for label, method in METHODS:
+            wire, ctime, dtime = measure(items, method, opts.rounds)
+            airtime = wire * 10.0 / opts.bps
+            if base is None:
+                base = airtime
+            print "  %-8s %7i bytes %8.1f sec air (%+6.1f%%) " \
+                "%7.2f ms pack %6.2f ms unpack" % (\
+                label, wire, airtime, (airtime - base) * 100 / base,
+                ctime * 1000, dtime * 1000)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This runs a stateful session transfer over a simulated link with a
+# limited rate, latency, a turnaround delay when the direction of
+# traffic changes (like a half-duplex radio) and random frame loss, once
+# for each congestion control policy.  Run it with "-h" to see a help
+# screen
+
+import os
+import sys
+import time
+import random
+import threading
+import Queue
+from optparse import OptionParser
+
+try:
+    from d_rats import congestion, scheduler
+    from d_rats.sessions import base, stateful
+except ImportError:
+    sys.path.append("..")
+    from d_rats import congestion, scheduler
+    from d_rats.sessions import base, stateful
+
+# name : (bits/sec, latency, turnaround, loss)
+SCENARIOS = {
+    "radio" : (9600, 0.2, 0.5, 0.03),
+    "slow"  : (1200, 0.2, 1.0, 0.02),
+    "net"   : (0, 0.05, 0.0, 0.02),
+    }
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+class SimLink(object):
+    """A single shared channel: frames are sent one at a time, in the
+    order they were queued, at the link rate and in either direction.
+    They arrive after the latency unless they are lost."""
+
+    def __init__(self, bps, latency, turnaround, loss):
+        self.bps = bps
+        self.latency = latency
+        self.turnaround = turnaround
+        self.loss = loss
+
+        self.frames = 0
+        self.lost = 0
+
+        self._queue = Queue.Queue()
+        self._inflight = Queue.Queue()
+        self._last_dir = None
+
+        self._threads = []
+        for fn in [self._run, self._deliver]:
+            t = threading.Thread(target=fn)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def send(self, frame, direction, deliver):
+        self._queue.put((frame, direction, deliver))
+
+    def stop(self):
+        """Lets the frames already on the link finish, then stops it"""
+        self._queue.put(None)
+        self._threads[0].join()
+        self._inflight.put(None)
+        self._threads[1].join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            frame, direction, deliver = item
+            data = frame.get_packed()
+
+            delay = 0
+            if self._last_dir != direction:
+                delay += self.turnaround
+                self._last_dir = direction
+            if self.bps:
+                # 8N1 serial framing: ten bits on the air per byte
+                delay += len(data) * 10.0 / self.bps
+
+            frame._xmit_s = time.time()
+            time.sleep(delay)
+            frame._xmit_e = time.time()
+
+            self.frames += 1
+            if random.random() < self.loss:
+                self.lost += 1
+            else:
+                self._inflight.put((time.time() + self.latency,
+                                    deliver, frame.get_copy()))
+
+            frame.set_sent()
+
+    def _deliver(self):
+        # Every frame has the same latency, so they arrive in order
+        while True:
+            item = self._inflight.get()
+            if item is None:
+                break
+            due, deliver, frame = item
+            time.sleep(max(0, due - time.time()))
+            deliver(frame)
+
+class SimManager(object):
+    """Just enough of a SessionManager for a StatefulSession"""
+
+    def __init__(self, link, direction, profile):
+        self.link = link
+        self.direction = direction
+        self.path_profile = profile
+        self.content_store = None
+        self.scheduler = scheduler.SessionScheduler()
+        self.peer = None
+
+    def _deliver(self, frame):
+        self.peer.inq.enqueue(frame)
+        self.peer.notify()
+
+    def outgoing(self, session, block):
+        self.link.send(block, self.direction, self._deliver)
+
+    def stop_session(self, session):
+        pass
+
+def run(policy, scenario, size, bsize, outlimit, window):
+    link = SimLink(*SCENARIOS[scenario])
+
+    sender = stateful.StatefulSession("sender", blocksize=bsize,
+                                      outlimit=outlimit)
+    receiver = stateful.StatefulSession("receiver", blocksize=bsize,
+                                        outlimit=outlimit)
+
+    for i, s in enumerate([sender, receiver]):
+        profile = congestion.PathProfile(max_window=window, policy=policy)
+        s._sm = SimManager(link, i, profile)
+        s._id = 2
+        s._proto = base.PROTO_VERSION
+        s.set_state(base.ST_OPEN)
+
+    sender._sm.peer = receiver
+    receiver._sm.peer = sender
+
+    data = os.urandom(size)
+    start = time.time()
+
+    def write():
+        try:
+            sender.write(data)
+        except base.SessionClosedError:
+            pass
+
+    w = threading.Thread(target=write)
+    w.setDaemon(True)
+    w.start()
+
+    received = ""
+    while len(received) < len(data) and (time.time() - start) < 900:
+        received += receiver.read()
+    elapsed = time.time() - start
+
+    stats = dict(sender.stats)
+
+    # Shut everything down before returning, so that no thread is still
+    # delivering to a session when the interpreter exits
+    for s in [sender, receiver]:
+        s.close()
+        s._sm.scheduler.stop()
+    w.join()
+    link.stop()
+
+    return received == data, elapsed, stats, link
+
+def main():
+    op = OptionParser()
+    op.add_option("-S", "--scenario",
+                  dest="scenario",
+                  default="radio",
+                  help="Link to simulate: %s (default: radio)" % \
+                      ", ".join(sorted(SCENARIOS.keys())))
+    op.add_option("-s", "--size",
+                  dest="size",
+                  type="int",
+                  default=16384,
+                  help="Bytes to transfer (default: 16384)")
+    op.add_option("-b", "--blocksize",
+                  dest="bsize",
+                  type="int",
+                  default=512,
+                  help="Block size (default: 512)")
+    op.add_option("-o", "--outlimit",
+                  dest="outlimit",
+                  type="int",
+                  default=4,
+                  help="Initial pipeline blocks (default: 4)")
+    op.add_option("-w", "--window",
+                  dest="window",
+                  type="int",
+                  default=4096,
+                  help="Maximum bytes in flight (default: 4096)")
+    op.add_option("-l", "--loss",
+                  dest="loss",
+                  type="float",
+                  default=None,
+                  help="Override the frame loss rate of the scenario")
+    op.add_option("-r", "--seed",
+                  dest="seed",
+                  type="int",
+                  default=0,
+                  help="Random seed (default: 0)")
+    (opts, args) = op.parse_args()
+
+    if opts.scenario not in SCENARIOS:
+        op.error("Unknown scenario %s" % opts.scenario)
+    if opts.loss is not None:
+        bps, latency, turnaround, loss = SCENARIOS[opts.scenario]
+        SCENARIOS[opts.scenario] = (bps, latency, turnaround, opts.loss)
+
+    bps, latency, turnaround, loss = SCENARIOS[opts.scenario]
+    print "%s: %i bps, %.2f sec latency, %.1f sec turnaround, %.0f%% loss" % (\
+        opts.scenario, bps, latency, turnaround, loss * 100)
+    print "%i bytes in %i byte blocks" % (opts.size, opts.bsize)
+
+    for policy in [congestion.POLICY_LEGACY, congestion.POLICY_AIMD]:
+        random.seed(opts.seed)
+        # Sessions are very chatty on stdout
+        sys.stdout = NullWriter()
+        try:
+            ok, elapsed, stats, link = run(policy, opts.scenario,
+                                           opts.size, opts.bsize,
+                                           opts.outlimit, opts.window)
+        finally:
+            sys.stdout = sys.__stdout__
+
+        print "%-6s %s %6.1f sec %7.1f B/s, %3i frames (%i lost), " \
+            "%i retries, final window %i bytes" % (\
+            policy,
+            ok and "ok  " or "FAIL",
+            elapsed,
+            opts.size / elapsed,
+            link.frames,
+            link.lost,
+            stats["retries"],
+            stats.get("cwnd", 0))
+        if "srtt" in stats:
+            print "       srtt %.2f sec, rttvar %.2f sec, rto %.2f sec" % (\
+                stats["srtt"], stats["rttvar"], stats["rto"])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This feeds frames through the repeater's fan-out path: each is
+# unpacked as a port would receive it and repeated to every other port,
+# whose transports pack and "send" their copies.  It reports how many
+# frames per second get through, and the memory and objects each frame
+# and its copies take while they sit in the outgoing queues.  Run it
+# with "-h" to see a help screen
+
+import gc
+import os
+import imp
+import sys
+import time
+import random
+from optparse import OptionParser
+
+try:
+    from d_rats import ddt2
+except ImportError:
+    sys.path.append("..")
+    from d_rats import ddt2
+
+def load_repeater():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, "d-rats_repeater")
+    # Keep imp from leaving a d-rats_repeaterc next to the script
+    sys.dont_write_bytecode = True
+    return imp.load_source("drats_repeater", path)
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+class FakePath(object):
+    """A port that packs what it is given, as the transport does, and
+    keeps it if asked to"""
+
+    def __init__(self, name, keep=False):
+        self.name = name
+        self.enabled = True
+        self.keep = keep
+        self.queue = []
+        self.bytes = 0
+
+    def __str__(self):
+        return self.name
+
+    def send_frame(self, frame):
+        self.bytes += len(frame.get_packed())
+        frame.set_sent()
+        if self.keep:
+            self.queue.append(frame)
+
+    def disable(self):
+        self.enabled = False
+
+def make_wire(count, size, compress):
+    frames = []
+    for i in range(0, count):
+        f = ddt2.DDT2EncodedFrame()
+        f.s_station = "STN%i" % (i % 20)
+        f.d_station = "CQCQCQ"
+        f.session = 4
+        f.seq = i % 256
+        f.set_compress(compress)
+        f.data = " ".join(["word%i" % random.randint(0, 50)
+                           for j in range(0, size / 7)])[:size]
+        frames.append(f.get_packed())
+
+    return frames
+
+def footprint(obj, seen):
+    """Roughly the bytes held by obj and everything it refers to that
+    hasn't been counted already"""
+    if id(obj) in seen or obj is None or isinstance(obj, (int, bool, type)):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += footprint(item, seen)
+    elif isinstance(obj, dict):
+        for k, v in obj.items():
+            size += footprint(k, seen) + footprint(v, seen)
+    elif hasattr(obj, "__dict__") or hasattr(type(obj), "__slots__"):
+        if hasattr(obj, "__dict__"):
+            size += footprint(obj.__dict__, seen)
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                size += footprint(getattr(obj, name, None), seen)
+
+    return size
+
+def run(module, wire, ports, keep):
+    repeater = module.Repeater("BENCH")
+    paths = [FakePath("port%i" % i, keep) for i in range(0, ports)]
+    for path in paths:
+        repeater.paths.append(path)
+    repeat = repeater._Repeater__repeat
+
+    gc.collect()
+    objects = len(gc.get_objects())
+
+    start = time.time()
+    for data in wire:
+        f = ddt2.DDT2EncodedFrame()
+        f.unpack(data)
+        repeat(paths[0], f)
+    elapsed = time.time() - start
+
+    gc.collect()
+    objects = len(gc.get_objects()) - objects
+
+    seen = set()
+    # The payloads are the same whatever the frame looks like
+    for data in wire:
+        seen.add(id(data))
+    size = sum([footprint(p.queue, seen) for p in paths])
+
+    return elapsed, objects, size, sum([p.bytes for p in paths])
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--frames",
+                  dest="frames",
+                  type="int",
+                  default=5000,
+                  help="Frames to repeat (default: 5000)")
+    op.add_option("-p", "--ports",
+                  dest="ports",
+                  type="int",
+                  default=4,
+                  help="Ports on the repeater (default: 4)")
+    op.add_option("-s", "--size",
+                  dest="size",
+                  type="int",
+                  default=256,
+                  help="Payload size of each frame (default: 256)")
+    op.add_option("-r", "--seed",
+                  dest="seed",
+                  type="int",
+                  default=0,
+                  help="Random seed (default: 0)")
+    (opts, args) = op.parse_args()
+
+    module = load_repeater()
+
+    print "%i frames, %i byte payloads, %i ports" % (opts.frames, opts.size,
+                                                     opts.ports)
+    for compress in [False, True]:
+        random.seed(opts.seed)
+        wire = make_wire(opts.frames, opts.size, compress)
+        label = compress and "zlib" or "plain"
+
+        # The repeater is chatty about every frame it routes
+        sys.stdout = NullWriter()
+        try:
+            elapsed, objects, size, sent = run(module, wire,
+                                               opts.ports, False)
+            junk, objects, size, junk = run(module, wire, opts.ports, True)
+        finally:
+            sys.stdout = sys.__stdout__
+
+        copies = opts.frames * (opts.ports - 1)
+        print "%-6s %8.1f frames/sec, %7.1f KB/sec out, " \
+            "%5.1f objects and %5i bytes per queued copy" % (\
+            label, opts.frames / elapsed, sent / elapsed / 1024,
+            float(objects) / copies, size / copies)
+
+if __name__ == "__main__":
+    main()
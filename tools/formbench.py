@@ -0,0 +1,222 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This writes out a folder of filled-in forms, some with attachments,
+# and times how long it takes to get the subject, sender, recipient and
+# path of each one: with the streaming header reader, with a full DOM
+# and XPath lookups as FormFile does it (if libxml2 and gtk are here),
+# and with minidom, which stands in for the DOM when they aren't.  Run
+# it with "-h" to see a help screen
+
+import os
+import re
+import sys
+import glob
+import time
+import zlib
+import base64
+import random
+import shutil
+import tempfile
+from xml.dom import minidom
+from optparse import OptionParser
+
+import gettext
+gettext.install("D-RATS")
+
+try:
+    from d_rats import formheader
+except ImportError:
+    sys.path.append("..")
+    from d_rats import formheader
+
+try:
+    from d_rats import formgui
+except Exception, e:
+    print "FormFile is not available (%s), skipping it" % e
+    formgui = None
+
+FORMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "..", "forms")
+
+WORDS = "the net is up and all stations are checking in from the eoc " \
+    "shelter power water please send traffic to county hospital route " \
+    "road closed at bridge need two more radios for the evening shift " \
+    "report status every hour until further notice".split()
+
+CALLS = ["KK7DS", "KE7JSS", "W7ABC", "N7XYZ", "KD7QRS", "WA7EOC"]
+
+def sentence(n):
+    return " ".join([random.choice(WORDS) for i in range(0, n)])
+
+def fill_form(template, attsize):
+    """Fills in one of the forms we ship, with the path and any
+    attachment at the end, where FormFile puts them"""
+    def entry(m):
+        if m.group(1) == "multiline":
+            value = sentence(random.randint(20, 200))
+        else:
+            value = sentence(random.randint(1, 5))
+        return "<entry type=\"%s\">%s</entry>" % (m.group(1), value)
+
+    doc = re.sub(r"<entry type=['\"]([a-z]+)['\"]/>", entry, template)
+
+    tail = "<path><src>%s</src><dst>%s</dst><mid>%x</mid>" % (\
+        random.choice(CALLS), random.choice(CALLS), random.getrandbits(32))
+    tail += "".join(["<e>%s</e>" % random.choice(CALLS)
+                     for i in range(0, random.randint(1, 4))])
+    tail += "</path>"
+    if attsize:
+        data = base64.b64encode(zlib.compress(os.urandom(attsize), 9))
+        tail += "<att name=\"photo.jpg\">%s</att>" % data
+    doc = doc.replace("</form>", tail + "</form>")
+
+    return "<?xml version=\"1.0\"?>\n" + doc
+
+def make_forms(tmp, count, attsize, attrate):
+    templates = [file(fn).read()
+                 for fn in sorted(glob.glob(os.path.join(FORMS_DIR, "*.xml")))]
+
+    files = []
+    for i in range(0, count):
+        if random.random() < attrate:
+            size = attsize
+        else:
+            size = 0
+        fn = os.path.join(tmp, "form_%i.xml" % i)
+        f = file(fn, "w")
+        f.write(fill_form(random.choice(templates), size))
+        f.close()
+        files.append(fn)
+
+    return files
+
+def read_header(fn):
+    h = formheader.read_header(fn)
+    return (h.get_subject_string(), h.get_sender_string(),
+            h.get_recipient_string(), h.get_path())
+
+def read_formfile(fn):
+    form = formgui.FormFile(fn)
+    result = (form.get_subject_string(), form.get_sender_string(),
+              form.get_recipient_string(), form.get_path())
+    del form
+    return result
+
+def read_minidom(fn):
+    doc = minidom.parse(fn)
+    form = doc.getElementsByTagName("form")[0]
+
+    def text(node):
+        return "".join([n.data for n in node.childNodes
+                        if n.nodeType == n.TEXT_NODE]).strip()
+
+    fields = {}
+    for field in form.getElementsByTagName("field"):
+        for entry in field.getElementsByTagName("entry"):
+            fields[field.getAttribute("id")] = text(entry)
+
+    path = {"e" : []}
+    for node in form.getElementsByTagName("path"):
+        for child in node.childNodes:
+            if child.nodeType == child.ELEMENT_NODE:
+                if child.tagName == "e":
+                    path["e"].append(text(child))
+                else:
+                    path[child.tagName] = text(child)
+
+    def first(*names):
+        for name in names:
+            if fields.get(name, None) is not None:
+                return fields[name]
+        return "Unknown"
+
+    subj = first("_auto_subject", "subject")
+    if subj == "Unknown":
+        subj = "%s#%s" % (path.get("src", ""), first("_auto_number"))
+    result = (subj.replace("\r", "").replace("\n", ""),
+              path.get("src", "") or first("_auto_sender", "sender"),
+              path.get("dst", "") or first("_auto_recip", "recip",
+                                           "recipient"),
+              path["e"])
+    doc.unlink()
+    return result
+
+def measure(files, reader, rounds):
+    start = time.time()
+    for i in range(0, rounds):
+        results = [reader(fn) for fn in files]
+    elapsed = (time.time() - start) / rounds
+
+    return elapsed, results
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--count",
+                  dest="count",
+                  type="int",
+                  default=500,
+                  help="Number of forms (default: 500)")
+    op.add_option("-a", "--attachment",
+                  dest="attsize",
+                  type="int",
+                  default=32768,
+                  help="Size of attachments in bytes (default: 32768)")
+    op.add_option("-A", "--attachment-rate",
+                  dest="attrate",
+                  type="float",
+                  default=0.2,
+                  help="Fraction of forms with one (default: 0.2)")
+    op.add_option("-R", "--rounds",
+                  dest="rounds",
+                  type="int",
+                  default=3,
+                  help="Times to read the folder (default: 3)")
+    op.add_option("-r", "--seed",
+                  dest="seed",
+                  type="int",
+                  default=0,
+                  help="Random seed (default: 0)")
+    (opts, args) = op.parse_args()
+
+    random.seed(opts.seed)
+
+    methods = [("header", read_header)]
+    if formgui:
+        methods.append(("formfile", read_formfile))
+    methods.append(("minidom", read_minidom))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        files = make_forms(tmp, opts.count, opts.attsize, opts.attrate)
+        size = sum([os.path.getsize(fn) for fn in files])
+        print "%i forms, %i KB" % (len(files), size >> 10)
+
+        base = None
+        for label, reader in methods:
+            elapsed, results = measure(files, reader, opts.rounds)
+            if base is None:
+                base = results
+            elif results != base:
+                print "  %s disagrees with the header reader!" % label
+            print "  %-9s %8.3f ms/form %8.1f forms/sec" % (\
+                label, elapsed * 1000 / len(files), len(files) / elapsed)
+    finally:
+        shutil.rmtree(tmp, True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This replays a noisy input stream through the old string-based block
+# parser and the incremental FrameScanner, and reports the time taken by
+# each.  Run it with "-h" to see a help screen
+
+import re
+import sys
+import time
+import random
+from optparse import OptionParser
+
+try:
+    from d_rats import transport, ddt2
+except ImportError:
+    sys.path.append("..")
+    from d_rats import transport, ddt2
+
+class LegacyParser(object):
+    """The parse_blocks()/parse_gps() loop from the original Transporter"""
+
+    def __init__(self):
+        self.inbuf = ""
+        self.blocks = 0
+        self.gps = 0
+
+    def feed(self, data):
+        self.inbuf += data
+
+    def parse_blocks(self):
+        while ddt2.ENCODED_HEADER in self.inbuf and \
+                ddt2.ENCODED_TRAILER in self.inbuf:
+            s = self.inbuf.index(ddt2.ENCODED_HEADER)
+            e = self.inbuf.index(ddt2.ENCODED_TRAILER) + \
+                len(ddt2.ENCODED_TRAILER)
+
+            if e < s:
+                _tmp = self.inbuf[:e-len(ddt2.ENCODED_TRAILER)] + \
+                    self.inbuf[e:]
+                self.inbuf = _tmp
+                continue
+
+            self.inbuf = self.inbuf[e:]
+            self.blocks += 1
+
+    def _match_gps(self):
+        m = re.search("((?:\$GP[^\*]+\*[A-f0-9]{2}\r?\n?){1,2}.{8},.{20})",
+                      self.inbuf)
+        if m:
+            return m.group(1)
+
+        m = re.search("(\$\$CRC[A-z0-9]{4},[^\r]*\r)", self.inbuf)
+        if m:
+            return m.group(1)
+
+        return None
+
+    def parse_gps(self):
+        while True:
+            result = self._match_gps()
+            if not result:
+                break
+            self.inbuf = self.inbuf.replace(result, "")
+            self.gps += 1
+
+class ScannerParser(object):
+    def __init__(self):
+        self.scanner = transport.FrameScanner()
+        self.blocks = 0
+        self.gps = 0
+
+    def feed(self, data):
+        self.scanner.feed(data)
+
+    def parse_blocks(self):
+        for kind, data in self.scanner.scan():
+            if kind == transport.FRAME_EVENT:
+                self.blocks += 1
+            elif kind == transport.GPS_EVENT:
+                self.gps += 1
+
+    def parse_gps(self):
+        pass
+
+def make_stream(frames, size):
+    gps = ["$GPGGA,075519,4531.254,N,12259.400,W,1,3,0,0.0,M,0,M,,*55\r\n" +
+           "K7HIO   ,GPS Info\r",
+           "$$CRC6CD1,Hills-Water-Treat-Plt>APRATS,DSTAR*:@233208h4529.05N" +
+           "/12305.91W>Washington County ARES;Hills Water Treat Pl\r\n"]
+
+    buf = ""
+    for i in range(frames):
+        f = ddt2.DDT2EncodedFrame()
+        f.s_station = "SENDER"
+        f.d_station = "RECVR"
+        f.type = 1
+        f.seq = i % 256
+        f.session = 4
+        f.data = "".join([chr(random.randint(0, 255)) for _ in range(size)])
+
+        buf += "asg;sajd;jsadn[EOB]kbasdl;b" + f.get_packed() + "\r\n"
+        if i % 10 == 5:
+            buf += random.choice(gps)
+
+    return buf
+
+def replay(parser, stream, chunk):
+    start = time.time()
+    pos = 0
+    while pos < len(stream):
+        n = random.randint(1, chunk)
+        parser.feed(stream[pos:pos+n])
+        pos += n
+        parser.parse_blocks()
+        parser.parse_gps()
+
+    return time.time() - start
+
+def main():
+    op = OptionParser()
+    op.add_option("-f", "--file",
+                  dest="file",
+                  default=None,
+                  help="Replay a captured stream from this file")
+    op.add_option("-n", "--frames",
+                  dest="frames",
+                  type="int",
+                  default=500,
+                  help="Number of frames to generate (default: 500)")
+    op.add_option("-s", "--size",
+                  dest="size",
+                  type="int",
+                  default=512,
+                  help="Payload size of each frame (default: 512)")
+    op.add_option("-c", "--chunk",
+                  dest="chunk",
+                  type="int",
+                  default=4096,
+                  help="Maximum size of each simulated read (default: 4096)")
+    (opts, args) = op.parse_args()
+
+    if opts.file:
+        stream = file(opts.file, "rb").read()
+    else:
+        stream = make_stream(opts.frames, opts.size)
+
+    print "Replaying %i bytes in reads of up to %i bytes" % (len(stream),
+                                                            opts.chunk)
+
+    for name, parser in [("legacy", LegacyParser()),
+                         ("scanner", ScannerParser())]:
+        random.seed(0)
+        elapsed = replay(parser, stream, opts.chunk)
+        print "%-8s %4i blocks %3i GPS %8.3f sec" % (name,
+                                                      parser.blocks,
+                                                      parser.gps,
+                                                      elapsed)
+
+if __name__ == "__main__":
+    main()
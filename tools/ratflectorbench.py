@@ -0,0 +1,191 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This starts a repeater on localhost, connects a number of simulated
+# stations to it and has each of them broadcast frames, once with the
+# threaded accept loop and once with the evented server.  It reports
+# connect latency, delivered frames per second and delivery latency.
+# Run it with "-h" to see a help screen
+
+import os
+import imp
+import sys
+import time
+import socket
+import select
+from optparse import OptionParser
+
+try:
+    from d_rats import ddt2, transport
+except ImportError:
+    sys.path.append("..")
+    from d_rats import ddt2, transport
+
+def load_repeater():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, "d-rats_repeater")
+    # Keep imp from leaving a d-rats_repeaterc next to the script
+    sys.dont_write_bytecode = True
+    return imp.load_source("drats_repeater", path)
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def readline(sock, timeout=30):
+    data = ""
+    end = time.time() + timeout
+    while "\r\n" not in data and time.time() < end:
+        d = sock.recv(1)
+        if not d:
+            break
+        data += d
+    return data
+
+def connect_clients(port, count):
+    clients = []
+    latencies = []
+    for i in range(count):
+        start = time.time()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(("127.0.0.1", port))
+        readline(s)
+        latencies.append(time.time() - start)
+        clients.append(s)
+
+    return clients, latencies
+
+def make_frame(station, seq, size):
+    f = ddt2.DDT2EncodedFrame()
+    f.s_station = station
+    f.d_station = "CQCQCQ"
+    f.session = 4
+    f.seq = seq % 256
+    f.set_compress(False)
+    stamp = "%.6f " % time.time()
+    f.data = stamp + ("x" * max(0, size - len(stamp)))
+    return f.get_packed()
+
+def run(module, evented, nclients, frames, size, port):
+    repeater = module.Repeater("BENCH", evented=evented)
+    repeater.socket = repeater.listen_on(port)
+    repeater.repeat()
+
+    clients, conn_lat = connect_clients(port, nclients)
+    end = time.time() + 10
+    while len(repeater.paths) < nclients and time.time() < end:
+        time.sleep(0.01)
+
+    expected = frames * nclients * (nclients - 1)
+    scanners = dict([(s.fileno(), transport.FrameScanner()) for s in clients])
+    delays = []
+
+    start = time.time()
+    for i in range(frames):
+        for n, s in enumerate(clients):
+            s.sendall(make_frame("STN%i" % n, i, size))
+
+    for s in clients:
+        s.setblocking(False)
+
+    while len(delays) < expected and (time.time() - start) < 60:
+        r, w, x = select.select(clients, [], [], 1)
+        now = time.time()
+        for s in r:
+            scanner = scanners[s.fileno()]
+            try:
+                scanner.feed(s.recv(65536))
+            except socket.error:
+                continue
+            for kind, data in scanner.scan():
+                if kind != transport.FRAME_EVENT:
+                    continue
+                f = ddt2.DDT2EncodedFrame()
+                if f.unpack(data):
+                    delays.append(now - float(f.data.split(" ", 1)[0]))
+    elapsed = time.time() - start
+
+    for s in clients:
+        s.close()
+    repeater.stop()
+    repeater.socket.close()
+
+    return conn_lat, delays, expected, elapsed
+
+def main():
+    op = OptionParser()
+    op.add_option("-c", "--clients",
+                  dest="clients",
+                  type="int",
+                  default=20,
+                  help="Number of simulated stations (default: 20)")
+    op.add_option("-n", "--frames",
+                  dest="frames",
+                  type="int",
+                  default=25,
+                  help="Frames broadcast by each station (default: 25)")
+    op.add_option("-s", "--size",
+                  dest="size",
+                  type="int",
+                  default=256,
+                  help="Payload size of each frame (default: 256)")
+    op.add_option("-p", "--port",
+                  dest="port",
+                  type="int",
+                  default=19000,
+                  help="First TCP port to listen on (default: 19000)")
+    (opts, args) = op.parse_args()
+
+    module = load_repeater()
+
+    print "%i stations, %i frames each, %i byte payloads" % (opts.clients,
+                                                              opts.frames,
+                                                              opts.size)
+    for i, (name, evented) in enumerate([("threaded", False),
+                                         ("evented", True)]):
+        # The repeater is chatty about every frame it routes
+        sys.stdout = NullWriter()
+        try:
+            conn_lat, delays, expected, elapsed = run(module, evented,
+                                                      opts.clients,
+                                                      opts.frames,
+                                                      opts.size,
+                                                      opts.port + i)
+        finally:
+            sys.stdout = sys.__stdout__
+
+        print "%-8s connect p50 %6.1f ms p99 %6.1f ms" % (\
+            name,
+            percentile(conn_lat, 50) * 1000,
+            percentile(conn_lat, 99) * 1000)
+        print "%-8s %5i/%i frames in %6.2f sec: %7.1f frames/sec, " \
+            "latency p50 %6.1f ms p99 %6.1f ms" % (\
+            name, len(delays), expected, elapsed, len(delays) / elapsed,
+            percentile(delays, 50) * 1000,
+            percentile(delays, 99) * 1000)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This pushes a large burst of frames (like a ratflector catching a
+# station up) through a socketpair, and compares the old string-growing
+# receive path with DataPath.readinto() feeding the FrameScanner
+# buffer.  Run it with "-h" to see a help screen
+
+import os
+import sys
+import time
+import socket
+import select
+import threading
+from optparse import OptionParser
+
+try:
+    from d_rats import comm, ddt2, transport
+except ImportError:
+    sys.path.append("..")
+    from d_rats import comm, ddt2, transport
+
+class LegacyReceiver(object):
+    """read_all_waiting() and parse_blocks() as they used to be"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = ""
+        self.blocks = 0
+
+    def read_all_waiting(self):
+        self.sock.setblocking(False)
+
+        r, w, x = select.select([self.sock], [], [], 0.25)
+        if not r:
+            return ""
+
+        data = ""
+        while True:
+            try:
+                d = self.sock.recv(4096)
+            except Exception, e:
+                break
+            if not d:
+                raise comm.DataPathIOError("Socket disconnected")
+            data += d
+
+        return data
+
+    def receive(self):
+        self.inbuf += self.read_all_waiting()
+
+        while ddt2.ENCODED_HEADER in self.inbuf and \
+                ddt2.ENCODED_TRAILER in self.inbuf:
+            s = self.inbuf.index(ddt2.ENCODED_HEADER)
+            e = self.inbuf.index(ddt2.ENCODED_TRAILER) + \
+                len(ddt2.ENCODED_TRAILER)
+            block = self.inbuf[s:e]
+            self.inbuf = self.inbuf[e:]
+            self.blocks += 1
+
+class ScannerReceiver(object):
+    def __init__(self, sock):
+        self.path = comm.SocketDataPath(sock)
+        self.scanner = transport.FrameScanner()
+        self.blocks = 0
+
+    def receive(self):
+        if self.path.readinto(self.scanner.get_buffer()):
+            self.scanner.fed()
+
+        for kind, data in self.scanner.scan():
+            if kind == transport.FRAME_EVENT:
+                self.blocks += 1
+
+def make_burst(frames, size):
+    f = ddt2.DDT2EncodedFrame()
+    f.s_station = "KK7DS"
+    f.d_station = "CQCQCQ"
+    f.set_compress(False)
+    f.data = os.urandom(size)
+
+    return f.get_packed() * frames
+
+def run(cls, burst, frames):
+    a, b = [socket.socket(_sock=s) for s in socket.socketpair()]
+    a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, len(burst))
+
+    receiver = cls(b)
+
+    def sender():
+        a.sendall(burst)
+
+    start = time.time()
+    t = threading.Thread(target=sender)
+    t.start()
+    while receiver.blocks < frames and (time.time() - start) < 60:
+        receiver.receive()
+    elapsed = time.time() - start
+    t.join()
+
+    a.close()
+    b.close()
+
+    return receiver.blocks, elapsed
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--frames",
+                  dest="frames",
+                  type="int",
+                  default=2000,
+                  help="Number of frames in the burst (default: 2000)")
+    op.add_option("-s", "--size",
+                  dest="size",
+                  type="int",
+                  default=256,
+                  help="Payload size of each frame (default: 256)")
+    (opts, args) = op.parse_args()
+
+    burst = make_burst(opts.frames, opts.size)
+    print "Burst of %i frames, %i KB" % (opts.frames, len(burst) / 1024)
+
+    for name, cls in [("legacy", LegacyReceiver),
+                      ("readinto", ScannerReceiver)]:
+        blocks, elapsed = run(cls, burst, opts.frames)
+        print "%-8s %5i frames in %6.3f sec (%.1f MB/s)" % (\
+            name, blocks, elapsed, len(burst) / elapsed / (1 << 20))
+
+if __name__ == "__main__":
+    main()
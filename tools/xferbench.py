@@ -0,0 +1,391 @@
+#!/usr/bin/python
+#
+# Copyright 2009 Dan Smith <dsmith@danplanet.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This pushes several files at once to different stations over one
+# simulated half-duplex radio channel, first by starting every transfer
+# right away (as D-RATS used to) and then through the transfer
+# scheduler with a few limits on the number running at once, and
+# compares how long it takes for all of them to arrive.  Run it with
+# "-h" to see a help screen
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import threading
+import Queue
+from optparse import OptionParser
+
+import gettext
+gettext.install("D-RATS")
+
+try:
+    from d_rats import congestion, ddt2, scheduler, transport, xfersched
+    from d_rats.sessions import base, file
+except ImportError:
+    sys.path.append("..")
+    from d_rats import congestion, ddt2, scheduler, transport, xfersched
+    from d_rats.sessions import base, file
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+class RadioChannel(object):
+    """One half-duplex channel shared by two ports.  Each port has its
+    own PriorityBlockQueue, like a real transport.  The channel keeps
+    sending from one port until it runs dry, and pays the turnaround
+    delay whenever it switches to the other."""
+
+    def __init__(self, bps, latency, turnaround, loss):
+        self.bps = bps
+        self.latency = latency
+        self.turnaround = turnaround
+        self.loss = loss
+
+        self.frames = 0
+        self.lost = 0
+
+        self._queues = [transport.PriorityBlockQueue(),
+                        transport.PriorityBlockQueue()]
+        self._deliver_fns = [None, None]
+        self._cond = threading.Condition()
+        self._inflight = Queue.Queue()
+        self._dir = 0
+        self._stopped = False
+
+        self._threads = []
+        for fn in [self._run, self._deliver]:
+            t = threading.Thread(target=fn)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        """Drops whatever is still queued and stops the channel once the
+        frames in the air have arrived"""
+        self._cond.acquire()
+        self._stopped = True
+        self._cond.notify()
+        self._cond.release()
+        self._threads[0].join()
+
+        self._inflight.put(None)
+        self._threads[1].join()
+
+    def attach(self, side, deliver):
+        self._deliver_fns[side] = deliver
+
+    def send(self, side, frame):
+        self._cond.acquire()
+        self._queues[side].enqueue(frame)
+        self._cond.notify()
+        self._cond.release()
+
+    def flush_session(self, side, id):
+        self._queues[side].flush_session(id)
+
+    def _next_frame(self):
+        self._cond.acquire()
+        while not self._stopped:
+            for side in [self._dir, 1 - self._dir]:
+                frame = self._queues[side].dequeue()
+                if frame:
+                    self._cond.release()
+                    return side, frame
+            self._cond.wait()
+        self._cond.release()
+
+        return None, None
+
+    def _run(self):
+        while True:
+            side, frame = self._next_frame()
+            if frame is None:
+                break
+            data = frame.get_packed()
+
+            delay = len(data) * 10.0 / self.bps
+            if side != self._dir:
+                delay += self.turnaround
+                self._dir = side
+
+            frame._xmit_s = time.time()
+            time.sleep(delay)
+            frame._xmit_e = time.time()
+
+            self.frames += 1
+            if random.random() < self.loss:
+                self.lost += 1
+            else:
+                self._inflight.put((time.time() + self.latency,
+                                    self._deliver_fns[1 - side],
+                                    frame.get_copy()))
+
+            frame.set_sent()
+
+    def _deliver(self):
+        while True:
+            item = self._inflight.get()
+            if item is None:
+                break
+            due, deliver, frame = item
+            time.sleep(max(0, due - time.time()))
+            deliver(frame)
+
+class SimPort(object):
+    """Just enough of a SessionManager for the file transfer sessions of
+    one side of the channel"""
+
+    def __init__(self, channel, side, profile):
+        self.channel = channel
+        self.side = side
+        self.path_profile = profile
+        self.content_store = None
+        self.scheduler = scheduler.SessionScheduler()
+        self.sessions = {}
+        self.peer = None
+
+        channel.attach(side, self._incoming)
+
+    def add(self, session, id):
+        session._sm = self
+        session._id = id
+        session._proto = base.PROTO_VERSION
+        session.set_state(base.ST_OPEN)
+        self.sessions[id] = session
+
+    def _incoming(self, frame):
+        session = self.sessions.get(frame.session, None)
+        if session:
+            session.inq.enqueue(frame)
+            session.notify()
+
+    def get_codec(self, station, session=None):
+        return ddt2.CODEC_ZDICT
+
+    def outgoing(self, session, block):
+        block.session = session._id
+        if block.priority is None:
+            block.priority = session.priority
+        self.channel.send(self.side, block)
+
+    def stop_session(self, session):
+        # Stands in for the control session telling the other end
+        self.channel.flush_session(self.side, session._id)
+        self.sessions.pop(session._id, None)
+        peer = self.peer.sessions.get(session._id, None)
+        if peer:
+            peer.set_state(base.ST_CLSD)
+
+    def stop(self):
+        self.scheduler.stop()
+
+class Push(object):
+    """One file being sent to one station"""
+
+    def __init__(self, i, src, dst, ports, bsize, outlimit):
+        self.src = src
+        self.dst = dst
+        self.ok = False
+        self.done = None
+        self.retries = 0
+
+        self.sender = file.FileTransferSession("push%i" % i,
+                                               blocksize=bsize,
+                                               outlimit=outlimit)
+        self.receiver = file.FileTransferSession("push%i" % i,
+                                                 blocksize=bsize,
+                                                 outlimit=outlimit)
+        self.id = 4 + i
+        self.ports = ports
+
+    def run(self, start, finished_fn=None):
+        a, b = self.ports
+        a.add(self.sender, self.id)
+        b.add(self.receiver, self.id)
+
+        t = threading.Thread(target=self.sender.send_file, args=(self.src,))
+        t.setDaemon(True)
+        t.start()
+
+        fn = self.receiver.recv_file(self.dst)
+        t.join(60)
+
+        self.ok = fn == self.dst and \
+            open(self.src, "rb").read() == open(self.dst, "rb").read()
+        self.done = time.time() - start
+        self.retries = self.sender.stats["retries"]
+
+        if finished_fn:
+            finished_fn()
+
+def run(tmp, files, max_active, opts):
+    channel = RadioChannel(opts.bps, opts.latency, opts.turnaround, opts.loss)
+    ports = []
+    for side in [0, 1]:
+        profile = congestion.PathProfile(max_window=opts.window)
+        ports.append(SimPort(channel, side, profile))
+    ports[0].peer, ports[1].peer = ports[1], ports[0]
+
+    pushes = []
+    for i, src in enumerate(files):
+        dst = os.path.join(tmp, "recv-%i-%i" % (max_active, i))
+        pushes.append(Push(i, src, dst, ports, opts.bsize, opts.outlimit))
+
+    start = time.time()
+    threads = []
+
+    def start_push(push, finished_fn=None):
+        t = threading.Thread(target=push.run, args=(start, finished_fn))
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+
+    if max_active:
+        sched = None
+        def start_job(job):
+            push = pushes[job.id - 1]
+            start_push(push, lambda: sched.finished(job))
+        sched = xfersched.TransferScheduler(start_job, max_active)
+        for i, push in enumerate(pushes):
+            sched.submit("file", "STATION%i" % i, push.src, push.src)
+    else:
+        for push in pushes:
+            start_push(push)
+
+    while len([p for p in pushes if p.done is None]):
+        time.sleep(0.5)
+        if (time.time() - start) > 3600:
+            break
+
+    elapsed = time.time() - start
+
+    for port in ports:
+        port.stop()
+    channel.stop()
+
+    return elapsed, pushes, channel
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--count",
+                  dest="count",
+                  type="int",
+                  default=4,
+                  help="Number of simultaneous pushes (default: 4)")
+    op.add_option("-s", "--size",
+                  dest="size",
+                  type="int",
+                  default=2048,
+                  help="Bytes per file (default: 2048)")
+    op.add_option("-B", "--bps",
+                  dest="bps",
+                  type="int",
+                  default=1200,
+                  help="Link rate in bits/sec (default: 1200)")
+    op.add_option("-L", "--latency",
+                  dest="latency",
+                  type="float",
+                  default=0.2,
+                  help="Link latency in seconds (default: 0.2)")
+    op.add_option("-t", "--turnaround",
+                  dest="turnaround",
+                  type="float",
+                  default=1.0,
+                  help="Transmit turnaround in seconds (default: 1.0)")
+    op.add_option("-l", "--loss",
+                  dest="loss",
+                  type="float",
+                  default=0.02,
+                  help="Frame loss rate (default: 0.02)")
+    op.add_option("-b", "--blocksize",
+                  dest="bsize",
+                  type="int",
+                  default=512,
+                  help="Block size (default: 512)")
+    op.add_option("-o", "--outlimit",
+                  dest="outlimit",
+                  type="int",
+                  default=4,
+                  help="Initial pipeline blocks (default: 4)")
+    op.add_option("-w", "--window",
+                  dest="window",
+                  type="int",
+                  default=4096,
+                  help="Maximum bytes in flight (default: 4096)")
+    op.add_option("-m", "--max-active",
+                  dest="limits",
+                  default="1,2",
+                  help="Scheduler limits to try (default: 1,2)")
+    op.add_option("-r", "--seed",
+                  dest="seed",
+                  type="int",
+                  default=0,
+                  help="Random seed (default: 0)")
+    (opts, args) = op.parse_args()
+
+    limits = [0] + [int(x) for x in opts.limits.split(",")]
+
+    tmp = tempfile.mkdtemp()
+    files = []
+    for i in range(0, opts.count):
+        fn = os.path.join(tmp, "file%i" % i)
+        f = open(fn, "wb")
+        f.write(os.urandom(opts.size))
+        f.close()
+        files.append(fn)
+
+    print "%i pushes of %i bytes at %i bps, %.0f%% loss" % (\
+        opts.count, opts.size, opts.bps, opts.loss * 100)
+
+    try:
+        for max_active in limits:
+            random.seed(opts.seed)
+            # Sessions are very chatty on stdout
+            sys.stdout = NullWriter()
+            try:
+                elapsed, pushes, channel = run(tmp, files, max_active, opts)
+            finally:
+                sys.stdout = sys.__stdout__
+
+            if max_active:
+                label = "%i at once" % max_active
+            else:
+                label = "all at once"
+
+            done = [p.done for p in pushes if p.done is not None]
+            print "%-12s %s total %6.1f sec, mean %6.1f sec, " \
+                "%3i frames (%i lost), %i retries" % (\
+                label,
+                len([p for p in pushes if p.ok]) == len(pushes) and \
+                    "ok  " or "FAIL",
+                elapsed,
+                sum(done) / max(len(done), 1),
+                channel.frames,
+                channel.lost,
+                sum([p.retries for p in pushes]))
+    finally:
+        shutil.rmtree(tmp, True)
+
+if __name__ == "__main__":
+    main()